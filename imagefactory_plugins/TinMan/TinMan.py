@@ -14,6 +14,10 @@
 #   limitations under the License.
 
 import logging
+import os
+import os.path
+import urllib2
+import uuid
 import zope
 import oz.GuestFactory
 import oz.TDL
@@ -22,6 +26,8 @@ import subprocess
 import libxml2
 import traceback
 import ConfigParser
+import hashlib
+import json
 from os.path import isfile
 from time import *
 from tempfile import NamedTemporaryFile
@@ -29,10 +35,19 @@ from imgfac.ApplicationConfiguration import ApplicationConfiguration
 from imgfac.ImageFactoryException import ImageFactoryException
 from imgfac.ReservationManager import ReservationManager
 from imgfac.FactoryUtils import launch_inspect_and_mount, shutdown_and_close, remove_net_persist
+from imgfac.BaseImageCache import BaseImageCache
+from imgfac.InstallMediaPrefetcher import InstallMediaPrefetcher
+from imgfac.SingleFlightRegistry import IGNORED_PARAMETERS
+from imgfac.ImageOverlays import create_overlay
+from imgfac.PluginManager import PluginManager
 from imgfac.OSDelegate import OSDelegate
 from libvirt import libvirtError
 from oz.OzException import OzException
 
+# Kept next to the install media Oz caches, recording what it was made from
+SOURCE_EXT = '.source'
+SOURCE_CHECK_TIMEOUT = 30
+
 
 def subprocess_check_output(*popenargs, **kwargs):
     if 'stdout' in kwargs:
@@ -67,9 +82,14 @@ class TinMan(object):
 
         # populate our target_image bodyfile with the original base image
         # which we do not want to modify in place
-        self.activity("Copying BaseImage to modifiable TargetImage")
-        self.log.debug("Copying base_image file (%s) to new target_image file (%s)" % (builder.base_image.data, builder.target_image.data))
-        oz.ozutil.copyfile_sparse(builder.base_image.data, builder.target_image.data)
+        overlay = self.app_config.get('target_image_overlays', False)
+        if overlay:
+            self.activity("Creating TargetImage overlay on BaseImage")
+            create_overlay(builder.base_image, builder.target_image)
+        else:
+            self.activity("Copying BaseImage to modifiable TargetImage")
+            self.log.debug("Copying base_image file (%s) to new target_image file (%s)" % (builder.base_image.data, builder.target_image.data))
+            oz.ozutil.copyfile_sparse(builder.base_image.data, builder.target_image.data)
         self.image = builder.target_image.data
 
         # Merge together any TDL-style customizations requested via our plugin-to-plugin interface
@@ -98,6 +118,9 @@ class TinMan(object):
         self._init_oz()
 
         self.guest.diskimage = builder.target_image.data
+        if overlay:
+            # Oz describes the disk to libvirt as raw unless told otherwise
+            self.guest.image_type = 'qcow2'
 
         libvirt_xml = self.guest._generate_xml("hd", None)
 
@@ -225,11 +248,26 @@ class TinMan(object):
         config_obj = ApplicationConfiguration()
         self.app_config = config_obj.configuration
         self.res_mgr = ReservationManager()
+        self.base_image_cache = BaseImageCache()
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.parameters = None
         self.install_script_object = None
         self.guest = None
 
+    def _oz_config(self):
+        # populate a config object to pass to OZ; this allows us to specify our
+        # own output dir but inherit other Oz behavior
+        oz_config = ConfigParser.SafeConfigParser()
+        if oz_config.read("/etc/oz/oz.cfg") != []:
+            oz_config.set('paths', 'output_dir', self.app_config["imgdir"])
+            if "oz_data_dir" in self.app_config:
+                oz_config.set('paths', 'data_dir', self.app_config["oz_data_dir"])
+            if "oz_screenshot_dir" in self.app_config:
+                oz_config.set('paths', 'screenshot_dir', self.app_config["oz_screenshot_dir"])
+        else:
+            raise ImageFactoryException("No Oz config file found. Can't continue.")
+        return oz_config
+
     def _init_oz(self):
         # TODO: This is a convenience variable for refactoring - rename
         self.new_image_id = self.active_image.identifier
@@ -242,17 +280,7 @@ class TinMan(object):
         #   Oz now uses the tdlobject name property directly in several places so we must change it
         self.tdlobj.name = "factory-build-" + self.new_image_id
 
-        # populate a config object to pass to OZ; this allows us to specify our
-        # own output dir but inherit other Oz behavior
-        self.oz_config = ConfigParser.SafeConfigParser()
-        if self.oz_config.read("/etc/oz/oz.cfg") != []:
-            self.oz_config.set('paths', 'output_dir', self.app_config["imgdir"])
-            if "oz_data_dir" in self.app_config:
-                self.oz_config.set('paths', 'data_dir', self.app_config["oz_data_dir"])
-            if "oz_screenshot_dir" in self.app_config:
-                self.oz_config.set('paths', 'screenshot_dir', self.app_config["oz_screenshot_dir"])
-        else:
-            raise ImageFactoryException("No Oz config file found. Can't continue.")
+        self.oz_config = self._oz_config()
 
         # make this a property to enable quick cleanup on abort
         self.instance = None
@@ -280,13 +308,27 @@ class TinMan(object):
         # Used in the logging helper function above
         self.active_image = self.base_image
 
+        # Identical templates produce identical JEOS installs - reuse a cached one if we have it
+        # Users can force a fresh install by passing { "use_base_image_cache": False } in the parameters
+        cache_key = None
+        if self.base_image_cache.enabled and self.parameters.get("use_base_image_cache", True):
+            try:
+                cache_key = self._base_image_cache_key(template)
+                if self._base_image_from_cache(cache_key):
+                    return
+            except Exception as e:
+                self.log.warn("Base image cache lookup failed - doing a full install: %s" % (e))
+
         try:
             self._init_oz()
             self.guest.diskimage = self.base_image.data
             self.activity("Cleaning up any old Oz guest")
             self.guest.cleanup_old_guest()
             self.activity("Generating JEOS install media")
-            self.threadsafe_generate_install_media(self.guest)
+            hit = self.threadsafe_generate_install_media(self.guest)
+            if hit is not None:
+                InstallMediaPrefetcher().record(self._install_media_key(self.guest), template.xml, hit,
+                                                self._install_media_cache(self.guest))
             self.percent_complete=10
 
             # We want to save this later for use by RHEV-M and Condor clouds
@@ -301,8 +343,6 @@ class TinMan(object):
                 except AttributeError:
                     disksize = 10
                 self.guest.generate_diskimage(size = disksize)
-                # TODO: If we already have a base install reuse it
-                #  subject to some rules about updates to underlying repo
                 self.activity("Execute JEOS install")
                 libvirt_xml = self.guest.install(self.app_config["timeout"])
                 self.base_image.parameters['libvirt_xml'] = libvirt_xml
@@ -328,11 +368,85 @@ class TinMan(object):
             self.log.debug("Generated disk image (%s)" % (self.guest.diskimage))
             # OK great, we now have a customized KVM image
 
+            if cache_key:
+                self.activity("Adding base image to the cache")
+                try:
+                    self.base_image_cache.store(cache_key, self.guest.diskimage, icicle=self.base_image.icicle,
+                                                parameters={ 'libvirt_xml': libvirt_xml, 'diskimage': self.guest.diskimage })
+                except Exception as e:
+                    self.log.warn("Unable to add base image to the cache: %s" % (e))
+
         finally:
             pass
             # TODO: Create the base_image object representing this
             # TODO: Create the base_image object at the beginning and then set the diskimage accordingly
 
+    def _base_image_cache_key(self, template):
+        """
+        Hash of everything that determines the content of a JEOS install - the OS, install source,
+        packages, repositories, files and commands of the template, any parameters that change the
+        install and the plugin version.  Items whose order does not matter are sorted and the
+        template name and description are dropped so that cosmetically different templates share a key.
+        """
+        doc = libxml2.parseDoc(template.xml)
+        try:
+            def text(node, path):
+                found = node.xpathEval(path)
+                return found[0].getContent().strip() if len(found) > 0 else None
+
+            def props(node):
+                props = { }
+                prop = node.properties
+                while prop:
+                    props[prop.name] = prop.getContent().strip()
+                    prop = prop.next
+                return props
+
+            canonical = { }
+            for item in ('name', 'version', 'arch', 'rootpw', 'key'):
+                canonical['os.' + item] = text(doc, '/template/os/%s' % (item))
+            install = doc.xpathEval('/template/os/install')
+            if len(install) > 0:
+                canonical['os.install'] = [ props(install[0]), text(install[0], 'url'), text(install[0], 'iso') ]
+            canonical['disk.size'] = text(doc, '/template/disk/size')
+            canonical['packages'] = sorted([ [ props(package), text(package, 'repository'), text(package, 'file'),
+                                               text(package, 'args') ]
+                                             for package in doc.xpathEval('/template/packages/package') ])
+            canonical['repositories'] = sorted([ [ props(repository), text(repository, 'url'), text(repository, 'signed'),
+                                                   text(repository, 'persisted'), text(repository, 'sslverify') ]
+                                                 for repository in doc.xpathEval('/template/repositories/repository') ])
+            canonical['files'] = sorted([ [ props(file), file.getContent().strip() ]
+                                          for file in doc.xpathEval('/template/files/file') ])
+            # Commands run in document order - keep it
+            canonical['commands'] = [ [ props(command), command.getContent().strip() ]
+                                      for command in doc.xpathEval('/template/commands/command') ]
+        finally:
+            doc.freeDoc()
+
+        # Callback URLs and the like differ between clients asking for the same install
+        canonical['parameters'] = dict([ (key, value) for key, value in self.parameters.items()
+                                         if (key != 'use_base_image_cache') and (key not in IGNORED_PARAMETERS) ])
+        canonical['plugin_version'] = PluginManager().metadata_for_plugin('TinMan').get('version')
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str)).hexdigest()
+
+    def _base_image_from_cache(self, cache_key):
+        entry = self.base_image_cache.clone_to(cache_key, self.base_image.data)
+        if not entry:
+            self.log.debug("No cached base image for key (%s)" % (cache_key))
+            return False
+        self.activity("Reusing cached base image (%s)" % (cache_key))
+        cached_parameters = entry.get('parameters', { })
+        libvirt_xml = cached_parameters.get('libvirt_xml')
+        if libvirt_xml:
+            # The cached domain XML still points at the disk of the image it was built for
+            if cached_parameters.get('diskimage'):
+                libvirt_xml = libvirt_xml.replace(cached_parameters['diskimage'], self.base_image.data)
+            self.base_image.parameters['libvirt_xml'] = libvirt_xml
+        if entry.get('icicle'):
+            self.base_image.icicle = entry['icicle']
+        self.percent_complete = 50
+        return True
+
     def init_guest(self):
         # Use the factory function from Oz directly
         # This raises an exception if the TDL contains an unsupported distro or version
@@ -364,18 +478,116 @@ class TinMan(object):
         self.log.debug(traceback.format_exc())
         self.active_image.status_detal['error'] = traceback.format_exc()
 
+    def _install_media_key(self, guest):
+        tdl = guest.tdl
+        return "%s-%s-%s-%s" % (tdl.distro, tdl.update, tdl.arch, tdl.installtype)
+
+    def _install_media_cache(self, guest):
+        # The install media Oz keeps between builds - the original as downloaded and, once
+        # modified for an unattended install, the modified copy
+        return [ path for path in [ getattr(guest, attribute, None) for attribute in ('orig_iso', 'modified_iso_cache') ] if path ]
+
+    def _install_media_source(self, guest):
+        # Where the install media comes from and, for an ISO served over HTTP, its size and
+        # modification time - a change to any of them makes the cached media stale
+        tdl = guest.tdl
+        url = getattr(tdl, tdl.installtype, None)
+        source = { 'url': url }
+        if (tdl.installtype == 'iso') and url and url.startswith(('http://', 'https://')):
+            request = urllib2.Request(url)
+            request.get_method = lambda: 'HEAD'
+            try:
+                headers = urllib2.urlopen(request, timeout=SOURCE_CHECK_TIMEOUT).info()
+                source['size'] = headers.getheader('Content-Length')
+                source['modified'] = headers.getheader('Last-Modified')
+            except Exception, e:
+                self.log.warning("Unable to check install media (%s) - trusting the cached copy: %s" % (url, e))
+        return source
+
+    def _install_media_current(self, guest, source):
+        # True if the install media is cached and was made from source
+        cache = self._install_media_cache(guest)
+        present = [ path for path in cache if os.path.exists(path) ]
+        if not present:
+            return False
+        if getattr(guest, 'cache_modified_media', False) and (len(present) < len(cache)):
+            # Oz would write the missing modified media - only safe under the exclusive lock
+            return False
+        if (len(present) == 2) and (os.path.getmtime(present[1]) < os.path.getmtime(present[0])):
+            # The modified media predates the original it should have been made from
+            return False
+        try:
+            with open(cache[0] + SOURCE_EXT) as source_file:
+                recorded = json.load(source_file)
+        except (IOError, ValueError):
+            return False
+        for key, value in source.items():
+            if recorded.get(key) != value:
+                return False
+        return True
+
+    def _record_install_media_source(self, guest, source):
+        path = self._install_media_cache(guest)[0] + SOURCE_EXT
+        with open(path + '.tmp', 'w') as source_file:
+            json.dump(source, source_file)
+        os.rename(path + '.tmp', path)
+
     def threadsafe_generate_install_media(self, guest):
         # Oz caching of install media and modified install media is not thread safe
-        # Make it safe here using some locks
-        # We can only have one active generate_install_media() call for each unique tuple:
+        # Make it safe here using a reader/writer lock for each unique tuple:
         #  (OS, update, architecture, installtype)
+        # Generating the cached media takes the lock exclusively.  Builds that find it cached, and
+        # made from what their template points at, only copy it and share the lock.
+        # Returns True if the cached media was current, False if it was generated and None if
+        # it is not cached in a way that can be checked
+
+        queue_name = self._install_media_key(guest)
+        if not self._install_media_cache(guest):
+            # No cache we know how to check - every call may write it
+            self.res_mgr.get_named_lock(queue_name)
+            try:
+                guest.generate_install_media(force_download=False)
+            finally:
+                self.res_mgr.release_named_lock(queue_name)
+            return None
+
+        source = self._install_media_source(guest)
+        if self._install_media_current(guest, source):
+            self.res_mgr.get_named_lock(queue_name, shared=True)
+            try:
+                # It may have been regenerated for another template before the lock was taken
+                if self._install_media_current(guest, source):
+                    guest.generate_install_media(force_download=False)
+                    return True
+            finally:
+                self.res_mgr.release_named_lock(queue_name)
 
-        tdl = guest.tdl
-        queue_name = "%s-%s-%s-%s" % (tdl.distro, tdl.update, tdl.arch, tdl.installtype)
         self.res_mgr.get_named_lock(queue_name)
         try:
-            guest.generate_install_media(force_download=False)
+            # Another build may have regenerated it while this one waited
+            stale = not self._install_media_current(guest, source)
+            if stale:
+                self.log.info("Cached install media for (%s) is missing or stale - generating it" % (queue_name))
+            guest.generate_install_media(force_download=stale)
+            if stale:
+                self._record_install_media_source(guest, source)
+            return not stale
         finally:
             self.res_mgr.release_named_lock(queue_name)
 
+    ## Called by the InstallMediaPrefetcher
+    def prefetch_install_media(self, template):
+        # Cache the install media of the template as a build of it would, without the build
+        tdlobj = oz.TDL.TDL(xmlstring=template.xml, rootpw_required=False)
+        # Keep the copy Oz makes of the cached media apart from those of builds
+        tdlobj.name = "factory-prefetch-" + str(uuid.uuid4())
+        guest = oz.GuestFactory.guest_factory(tdlobj, self._oz_config(), None)
+        try:
+            hit = self.threadsafe_generate_install_media(guest)
+        finally:
+            guest.cleanup_install()
+        if hit is not None:
+            InstallMediaPrefetcher().record(self._install_media_key(guest), template.xml, hit,
+                                            self._install_media_cache(guest), prefetch=True)
+
 
@@ -115,6 +115,12 @@ class ApplicationConfiguration(Singleton):
 
             cmd_list = subparsers.add_parser('images', help='List images of a given type or get details of an image.')
             cmd_list.add_argument('fetch_spec', help='JSON formatted string of key/value pairs')
+            cmd_list.add_argument('--fields', help='Comma separated list of the metadata to show for each image. (default: all)')
+            cmd_list.add_argument('--limit', type=int, help='Show at most this many images and the cursor to continue from.')
+            cmd_list.add_argument('--cursor', help='Continue a listing after the image with this uuid.')
+            for key in ('created', 'modified'):
+                cmd_list.add_argument('--%s-since' % key, type=float, help='Only images %s at or after this time, in seconds since the epoch.' % key)
+                cmd_list.add_argument('--%s-until' % key, type=float, help='Only images %s before this time, in seconds since the epoch.' % key)
 
             cmd_delete = subparsers.add_parser('delete', help='Delete an image.')
             cmd_delete.add_argument('id', help='UUID of the image to delete')
@@ -125,6 +131,8 @@ class ApplicationConfiguration(Singleton):
 
             cmd_plugins = subparsers.add_parser('plugins', help='List active plugins or get details of a specific plugin.')
             cmd_plugins.add_argument('--id')
+
+            subparsers.add_parser('migrate_storage', help='Move the image files of a file store into the sharded layout.')
         return argparser
 
     def __parse_arguments(self):
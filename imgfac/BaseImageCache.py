@@ -0,0 +1,240 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import json
+import time
+from threading import BoundedSemaphore
+from Singleton import Singleton
+from ApplicationConfiguration import ApplicationConfiguration
+from ReservationManager import ReservationManager
+
+CACHE_PATH = '/var/lib/imagefactory/base_image_cache'
+METADATA_EXT = '.meta'
+BODY_EXT = '.body'
+
+
+class BaseImageCache(Singleton):
+    """
+    Content addressed store of completed BaseImage bodies.
+
+    OS plugins compute a key from everything that determines the content of a BaseImage
+    (normally a canonical form of the template plus the plugin version).  A build whose
+    key is already present can clone the cached body instead of doing a fresh install.
+
+    The cache holds its own copies so that deleting a user's BaseImage never invalidates it.
+    Entries are evicted least recently used first whenever the configured size cap,
+    base_image_cache_size, or the free space tracked by the ReservationManager requires it.
+    A size of 0, the default, disables the cache.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        appconfig = ApplicationConfiguration().configuration
+        self.max_size = int(appconfig.get('base_image_cache_size', 0))
+        self.cache_path = appconfig.get('base_image_cache_path', CACHE_PATH)
+        self.res_mgr = ReservationManager()
+        self._lock = BoundedSemaphore()
+        self._entries = { }
+        # Entries whose bodies are still being copied in - they count against the cap but are
+        # not handed out until complete
+        self._pending = { }
+        self._in_use = { }
+        if self.enabled:
+            if not os.path.exists(self.cache_path):
+                os.makedirs(self.cache_path)
+            self._load_entries()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @property
+    def size(self):
+        """Bytes of disk used by all cache entries, including those still being stored."""
+        return sum([ entry['size'] for entry in self._entries.values() + self._pending.values() ])
+
+    def _path_for_key(self, key, ext):
+        return os.path.join(self.cache_path, key + ext)
+
+    def _load_entries(self):
+        for filename in os.listdir(self.cache_path):
+            if not filename.endswith(METADATA_EXT):
+                continue
+            key = filename[:-len(METADATA_EXT)]
+            try:
+                with open(self._path_for_key(key, METADATA_EXT), 'r') as mdf:
+                    entry = json.load(mdf)
+                if os.path.isfile(self._path_for_key(key, BODY_EXT)):
+                    self._entries[key] = entry
+                else:
+                    self.log.warn("Cache entry (%s) has no body - discarding" % (key))
+                    os.remove(self._path_for_key(key, METADATA_EXT))
+            except Exception as e:
+                self.log.warn("Could not load base image cache entry (%s): %s" % (key, e))
+        self.log.debug("Loaded %d cached base images (%d bytes) from (%s)" % (len(self._entries), self.size, self.cache_path))
+
+    def _clone_file(self, source, destination):
+        # FactoryUtils pulls in guestfs - only import it when a body is copied
+        from FactoryUtils import clone_file
+        clone_file(source, destination)
+
+    def _save_entry(self, key, entry):
+        with open(self._path_for_key(key, METADATA_EXT), 'w') as mdf:
+            json.dump(entry, mdf)
+
+    def _remove_entry(self, key):
+        # Caller must hold _lock
+        self._entries.pop(key, None)
+        self._pending.pop(key, None)
+        for ext in (METADATA_EXT, BODY_EXT):
+            try:
+                os.remove(self._path_for_key(key, ext))
+            except OSError as e:
+                self.log.warn("Unable to remove cache file: %s" % (e))
+        # Callers evict until a new entry fits - the space must show up at once
+        self.res_mgr.space_freed(self.cache_path)
+
+    def _evict_for(self, needed):
+        # Caller must hold _lock
+        # Drop least recently used entries until needed more bytes fit under the cap
+        # Entries being cloned from right now are never evicted
+        candidates = sorted([ key for key in self._entries if not self._in_use.get(key) ],
+                            key=lambda key: self._entries[key]['last_used'])
+        while (self.size + needed > self.max_size) and (len(candidates) > 0):
+            key = candidates.pop(0)
+            self.log.debug("Evicting cached base image (%s) to make room" % (key))
+            self._remove_entry(key)
+        return self.size + needed <= self.max_size
+
+    def evict_lru(self):
+        """
+        Remove the least recently used entry that is not in use.
+
+        @return The number of bytes freed, 0 if there was nothing to remove
+        """
+        self._lock.acquire()
+        try:
+            candidates = sorted([ key for key in self._entries if not self._in_use.get(key) ],
+                                key=lambda key: self._entries[key]['last_used'])
+            if len(candidates) == 0:
+                return 0
+            size = self._entries[candidates[0]]['size']
+            self._remove_entry(candidates[0])
+            return size
+        finally:
+            self._lock.release()
+
+    def clone_to(self, key, destination):
+        """
+        If an entry exists for key, clone its body to destination.
+
+        @param key The cache key computed by the plugin
+        @param destination Path of the new image body
+
+        @return The entry dict, including any 'icicle' and 'parameters' stored with it, or None on a miss
+        """
+        if not self.enabled:
+            return None
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+        try:
+            self.log.debug("Cloning cached base image (%s) to (%s)" % (key, destination))
+            self._clone_file(self._path_for_key(key, BODY_EXT), destination)
+            self._lock.acquire()
+            try:
+                entry['last_used'] = time.time()
+                entry['hits'] = entry.get('hits', 0) + 1
+                self._save_entry(key, entry)
+                return dict(entry)
+            finally:
+                self._lock.release()
+        finally:
+            self._lock.acquire()
+            self._in_use[key] -= 1
+            if self._in_use[key] == 0:
+                del self._in_use[key]
+            self._lock.release()
+
+    def store(self, key, source, icicle=None, parameters=None):
+        """
+        Add a completed BaseImage body to the cache.  Failure to cache is never fatal.
+
+        @param key The cache key computed by the plugin
+        @param source Path of the completed image body
+        @param icicle The ICICLE of the completed image
+        @param parameters Any image parameters that should be restored on a hit, e.g. libvirt_xml
+
+        @return True if the image was cached
+        """
+        if not self.enabled:
+            return False
+        body_path = self._path_for_key(key, BODY_EXT)
+        # Sparse images only consume the blocks actually allocated
+        source_stat = os.stat(source)
+        size = min(source_stat.st_size, source_stat.st_blocks * 512)
+
+        self._lock.acquire()
+        try:
+            if (key in self._entries) or (key in self._pending):
+                return True
+            if not self._evict_for(size):
+                self.log.debug("Base image (%s) of %d bytes will not fit in the cache" % (key, size))
+                return False
+            # Honor the minimum free space of the ReservationManager as well as our own cap
+            while not self.res_mgr.reserve_space_for_file(size, body_path):
+                candidates = [ k for k in self._entries if not self._in_use.get(k) ]
+                if len(candidates) == 0:
+                    self.log.debug("Not enough free space to cache base image (%s)" % (key))
+                    return False
+                self._remove_entry(min(candidates, key=lambda k: self._entries[k]['last_used']))
+            # Claim the space now so that concurrent stores account for it
+            entry = {'size': size, 'created': time.time(), 'last_used': time.time(), 'hits': 0,
+                     'icicle': icicle, 'parameters': parameters if parameters else { }}
+            self._pending[key] = entry
+        finally:
+            self._lock.release()
+
+        try:
+            self._clone_file(source, body_path)
+            self._save_entry(key, entry)
+            self._lock.acquire()
+            try:
+                # Only now may clone_to() hand it out
+                self._entries[key] = self._pending.pop(key)
+            finally:
+                self._lock.release()
+            self.log.debug("Cached base image (%s) of %d bytes" % (key, size))
+            return True
+        except Exception as e:
+            self.log.warn("Unable to cache base image (%s): %s" % (key, e))
+            self._lock.acquire()
+            try:
+                self._remove_entry(key)
+            finally:
+                self._lock.release()
+            return False
+        finally:
+            self.res_mgr.cancel_reservation_for_file(body_path)
@@ -16,6 +16,8 @@ import logging
 from imgfac.Singleton import Singleton
 from Builder import Builder
 from imgfac.NotificationCenter import NotificationCenter
+from imgfac.BuildWorkerPool import BuildWorkerPool
+from imgfac.PersistentImage import TERMINAL_STATUSES
 from threading import BoundedSemaphore
 
 class BuildDispatcher(Singleton):
@@ -24,11 +26,13 @@ class BuildDispatcher(Singleton):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.builders = dict()
         self.builders_lock = BoundedSemaphore()
+        # All Builder work runs on this pool - see max_concurrent_builds and max_queued_builds
+        self.worker_pool = BuildWorkerPool()
         NotificationCenter().add_observer(self, 'handle_state_change', 'image.status')
 
     def handle_state_change(self, notification):
         status = notification.user_info['new_status']
-        if(status in ('COMPLETED', 'FAILED', 'DELETED', 'DELETEFAILED')):
+        if(status in TERMINAL_STATUSES):
             self.builders_lock.acquire()
             image_id = notification.sender.identifier
             if(image_id in self.builders):
@@ -36,9 +40,20 @@ class BuildDispatcher(Singleton):
                 self.log.debug('Removed builder from BuildDispatcher on notification from image %s: %s' % (image_id, status))
             self.builders_lock.release()
 
-    def builder_for_base_image(self, template, parameters=None):
-        builder = Builder()
-        builder.build_image_from_template(template, parameters=parameters)
+    def queue_depths(self):
+        return self.worker_pool.queue_depths()
+
+    def wait_times(self):
+        return self.worker_pool.wait_times()
+
+    def builder_for_base_image(self, template, parameters=None, client=None):
+        self.worker_pool.check_admission(1)
+        try:
+            builder = Builder()
+            builder.client = client
+            builder.build_image_from_template(template, parameters=parameters)
+        finally:
+            self.worker_pool.release_admission()
         self.builders_lock.acquire()
         try:
             self.builders[builder.base_image.identifier] = builder
@@ -46,9 +61,15 @@ class BuildDispatcher(Singleton):
             self.builders_lock.release()
         return builder
 
-    def builder_for_target_image(self, target, image_id=None, template=None, parameters=None):
-        builder = Builder()
-        builder.customize_image_for_target(target, image_id, template, parameters)
+    def builder_for_target_image(self, target, image_id=None, template=None, parameters=None, client=None):
+        # Building from a template queues a BaseImage job as well
+        self.worker_pool.check_admission(1 if image_id else 2)
+        try:
+            builder = Builder()
+            builder.client = client
+            builder.customize_image_for_target(target, image_id, template, parameters)
+        finally:
+            self.worker_pool.release_admission()
         self.builders_lock.acquire()
         try:
             self.builders[builder.target_image.identifier] = builder
@@ -56,9 +77,17 @@ class BuildDispatcher(Singleton):
             self.builders_lock.release()
         return builder
 
-    def builder_for_provider_image(self, provider, credentials, target, image_id=None, template=None, parameters=None, my_image_id=None):
-        builder = Builder()
-        builder.create_image_on_provider(provider, credentials, target, image_id, template, parameters, my_image_id)
+    def builder_for_provider_image(self, provider, credentials, target, image_id=None, template=None, parameters=None, my_image_id=None, client=None):
+        if(image_id or (parameters and parameters.get('snapshot', False))):
+            self.worker_pool.check_admission(1)
+        else:
+            self.worker_pool.check_admission(3)
+        try:
+            builder = Builder()
+            builder.client = client
+            builder.create_image_on_provider(provider, credentials, target, image_id, template, parameters, my_image_id)
+        finally:
+            self.worker_pool.release_admission()
         self.builders_lock.acquire()
         try:
             self.builders[builder.provider_image.identifier] = builder
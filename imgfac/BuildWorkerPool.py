@@ -0,0 +1,278 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from threading import Thread, Condition, Event, currentThread
+from Singleton import Singleton
+from ApplicationConfiguration import ApplicationConfiguration
+from ImageFactoryException import ImageFactoryException
+from FairQueue import FairTags, WaitStats
+
+DEFAULT_MAX_WORKERS = 8
+# Lower numbers are run first - finishing work that is already underway beats starting new work
+DEFAULT_PRIORITIES = { 'delete': 0, 'provider_image': 1, 'snapshot': 1, 'target_image': 2, 'base_image': 3 }
+
+
+class BuildQueueFullException(ImageFactoryException):
+    """ Raised when a build is refused because the worker pool queue is at max_queued_builds """
+    pass
+
+
+class BuildJob(object):
+    """
+    A unit of work for the BuildWorkerPool.
+
+    Builder hands these out in place of the threads it used to start, so they support the
+    parts of the Thread interface that callers rely on - getName(), isAlive() and join().
+    """
+
+    def __init__(self, name, kind, target, kwargs=None, image_id=None, client=None):
+        self.name = name
+        self.kind = kind
+        self.image_id = image_id
+        self.client = client
+        self.queued_at = None
+        self.state = 'QUEUED'
+        self._target = target
+        self._kwargs = kwargs if kwargs else { }
+        self._finished = Event()
+
+    def getName(self):
+        return self.name
+
+    def isAlive(self):
+        return not self._finished.isSet()
+
+    def join(self, timeout=None):
+        self._finished.wait(timeout)
+
+    def run(self):
+        self.state = 'RUNNING'
+        try:
+            self._target(**self._kwargs)
+        finally:
+            self.state = 'DONE'
+            self._finished.set()
+
+
+class BuildWorkerPool(Singleton):
+    """
+    A fixed number of worker threads fed from a priority queue.
+
+    Jobs of the same priority are taken in weighted fair order across the clients that asked
+    for them, so one client queueing many builds does not hold up everybody else - see
+    client_weights.
+
+    Jobs that depend on another job (a TargetImage build waiting for its BaseImage, for example)
+    are held back until that job finishes, so that a worker is never tied up waiting on a job
+    that is still sitting in the queue behind it.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        appconfig = ApplicationConfiguration().configuration
+        self.max_workers = max(1, int(appconfig.get('max_concurrent_builds', DEFAULT_MAX_WORKERS)))
+        # Zero means no limit
+        self.max_queued = int(appconfig.get('max_queued_builds', 0))
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        self.priorities.update(appconfig.get('build_priorities', { }))
+        self._queue = [ ]
+        self._held = defaultdict(list)
+        self._jobs_by_image = { }
+        # Thread -> jobs admitted by check_admission() that it has not submitted yet
+        self._admitted = { }
+        self._running = defaultdict(int)
+        self._sequence = itertools.count()
+        self._tags = FairTags(appconfig.get('client_weights', { }))
+        self._waits = WaitStats()
+        self._condition = Condition()
+        self._workers = [ ]
+
+    def _start_workers(self):
+        # Caller must hold _condition
+        while len(self._workers) < self.max_workers:
+            worker = Thread(target=self._work, name='build-worker-%d' % len(self._workers))
+            # Workers idle forever waiting for jobs - do not let them keep the process alive
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _enqueue(self, job):
+        # Caller must hold _condition
+        job.queued_at = time.time()
+        heapq.heappush(self._queue, (self.priorities.get(job.kind, max(self.priorities.values()) + 1),
+                                     self._tags.stamp(job.client), self._sequence.next(), job))
+        self._condition.notify()
+
+    def queued_count(self):
+        self._condition.acquire()
+        try:
+            return len(self._queue) + sum([ len(jobs) for jobs in self._held.values() ])
+        finally:
+            self._condition.release()
+
+    def _admit(self, job_count):
+        # Caller must hold _condition
+        if not self.max_queued:
+            return
+        waiting = len(self._queue) + sum([ len(jobs) for jobs in self._held.values() ]) + sum(self._admitted.values())
+        if (waiting + job_count) > self.max_queued:
+            raise BuildQueueFullException("Build queue is full (%d jobs waiting) - try again later" % (self.max_queued))
+
+    def check_admission(self, job_count=1):
+        """
+        Admit job_count jobs that the calling thread is about to submit, or raise
+        BuildQueueFullException if that would exceed max_queued_builds.
+        This is checked before any image is created so that a refused request leaves nothing behind.
+        The jobs count against max_queued_builds from now on, so that a request submitting several
+        jobs is never refused part way through - call release_admission() once they are submitted.
+
+        @param job_count The number of jobs the request will submit
+        """
+        self._condition.acquire()
+        try:
+            self._admit(job_count)
+            if self.max_queued:
+                thread = currentThread()
+                self._admitted[thread] = self._admitted.get(thread, 0) + job_count
+        finally:
+            self._condition.release()
+
+    def release_admission(self):
+        """
+        Forget the jobs admitted for the calling thread that it did not submit.
+        """
+        self._condition.acquire()
+        try:
+            self._admitted.pop(currentThread(), None)
+        finally:
+            self._condition.release()
+
+    def submit(self, job, depends_on=None, limited=True):
+        """
+        Queue a job.
+        A job that the calling thread was not admitted for by check_admission() is refused with
+        BuildQueueFullException if the queue is full.
+
+        @param job The BuildJob to run
+        @param depends_on An optional BuildJob that must finish before this job is started
+        @param limited If False, queue the job even when max_queued_builds is reached
+        """
+        self._condition.acquire()
+        try:
+            thread = currentThread()
+            if self._admitted.get(thread):
+                self._admitted[thread] -= 1
+                if not self._admitted[thread]:
+                    del self._admitted[thread]
+            elif limited:
+                self._admit(1)
+            self._start_workers()
+            if job.image_id:
+                self._jobs_by_image[job.image_id] = job
+            if depends_on and depends_on.isAlive():
+                self.log.debug("Holding job (%s) until job (%s) finishes" % (job.name, depends_on.name))
+                self._held[depends_on].append(job)
+            else:
+                self._enqueue(job)
+        finally:
+            self._condition.release()
+
+    def job_for_image(self, image_id):
+        """
+        The unfinished job, if any, that is producing the image with the given identifier.
+
+        @param image_id The identifier of the image
+
+        @return A BuildJob or None
+        """
+        self._condition.acquire()
+        try:
+            job = self._jobs_by_image.get(image_id)
+        finally:
+            self._condition.release()
+        return job if (job and job.isAlive()) else None
+
+    def queue_depths(self):
+        """
+        Queued and running job counts for each kind of job.
+
+        @return A dict keyed by job kind
+        """
+        self._condition.acquire()
+        try:
+            depths = dict([ (kind, {'priority': priority, 'queued': 0, 'held': 0, 'running': self._running[kind]})
+                            for kind, priority in self.priorities.items() ])
+            for priority, finish, sequence, job in self._queue:
+                depths.setdefault(job.kind, {'priority': priority, 'queued': 0, 'held': 0, 'running': 0})['queued'] += 1
+            for jobs in self._held.values():
+                for job in jobs:
+                    depths.setdefault(job.kind, {'priority': None, 'queued': 0, 'held': 0, 'running': 0})['held'] += 1
+            return depths
+        finally:
+            self._condition.release()
+
+    def wait_times(self):
+        """
+        How long jobs waited in the queue for a worker, overall and for each client.  Time spent
+        held back waiting on another job is not counted.
+
+        @return A dict of the number of jobs started and their total and longest wait in seconds
+        """
+        self._condition.acquire()
+        try:
+            return self._waits.report()
+        finally:
+            self._condition.release()
+
+    def _work(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while len(self._queue) == 0:
+                    self._condition.wait()
+                priority, finish, sequence, job = heapq.heappop(self._queue)
+                self._tags.served(finish)
+                self._waits.record(job.client, time.time() - job.queued_at)
+                self._running[job.kind] += 1
+            finally:
+                self._condition.release()
+
+            self.log.debug("Starting job (%s) of kind (%s)" % (job.name, job.kind))
+            # Builds have always logged under a per-build thread name - keep doing so
+            worker_name = currentThread().getName()
+            currentThread().setName(job.name)
+            try:
+                job.run()
+            except Exception as e:
+                self.log.error("Exception escaped build job (%s)" % (job.name))
+                self.log.exception(e)
+            finally:
+                currentThread().setName(worker_name)
+
+            self._condition.acquire()
+            try:
+                self._running[job.kind] -= 1
+                if self._jobs_by_image.get(job.image_id) is job:
+                    del self._jobs_by_image[job.image_id]
+                for held_job in self._held.pop(job, [ ]):
+                    self._enqueue(held_job)
+            finally:
+                self._condition.release()
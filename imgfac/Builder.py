@@ -16,7 +16,8 @@
 
 import uuid
 import logging
-from threading import Thread
+import os.path
+from contextlib import contextmanager
 from props import prop
 from NotificationCenter import NotificationCenter
 from Template import Template
@@ -28,7 +29,17 @@ from TargetImage import TargetImage
 from ProviderImage import ProviderImage
 from ImageFactoryException import ImageFactoryException
 from CallbackWorker import CallbackWorker
-from time import sleep
+from CompletionRegistry import CompletionRegistry
+from BuildWorkerPool import BuildWorkerPool, BuildJob, BuildQueueFullException
+from PersistentImage import TERMINAL_STATUSES
+from SingleFlightRegistry import SingleFlightRegistry, flight_key, sharing_image_ids
+from FactoryUtils import clone_file
+from PersistenceQueue import PersistenceQueue
+from ImageOverlays import flatten, dependent_image_ids, ImageInUseException
+from ReservationManager import ReservationManager
+
+# How often to re-fetch an image that is being built by some other process
+PENDING_POLL_INTERVAL = 5
 
 class Builder(object):
     """ TODO: Docstring for Builder  """
@@ -47,6 +58,12 @@ class Builder(object):
         self.app_config = ApplicationConfiguration().configuration
         self.notification_center = NotificationCenter()
         self.pim = PersistentImageManager.default_manager()
+        self.completion_registry = CompletionRegistry()
+        self.worker_pool = BuildWorkerPool()
+        self.flights = SingleFlightRegistry()
+        self.persistence_queue = PersistenceQueue()
+        # Who asked for the work - jobs and resource slots are shared fairly between clients
+        self.client = None
         self._os_plugin = None
         self._cloud_plugin = None
         self._base_image = None
@@ -56,10 +73,15 @@ class Builder(object):
         self._provider_image = None
         self._provider_image_cbws = [ ]
         self._deletion_cbws = []
+        # These hold the BuildJobs queued with the BuildWorkerPool for each stage
+        # They support the subset of the Thread interface that callers use, such as join()
         self.base_thread = None
         self.target_thread = None
         self.push_thread = None
         self.snapshot_thread = None
+        # Keys describing what our base and target stages produce - see _lead_or_follow()
+        self._base_flight_key = None
+        self._target_flight_key = None
         try:
             from imgfac.secondary.SecondaryDispatcher import SecondaryDispatcher
             from imgfac.secondary.SecondaryPlugin import SecondaryPlugin
@@ -79,25 +101,127 @@ class Builder(object):
             self.notification_center.add_observer(worker, 'status_notifier', 'image.status', sender = image)
 
     def _shutdown_callback_workers(self, image, callbackworkers):
+        # With asynchronous dispatch our final status change may not have reached the workers yet
+        if callbackworkers:
+            self.notification_center.flush()
         for worker in callbackworkers:
             self.notification_center.remove_observer(worker, 'status_notifier', 'image.status', sender = image)
             worker.shut_down()
 
+    def _queue_job(self, kind, target, kwargs, image, depends_on=None, limited=True):
+        job = BuildJob(name=str(uuid.uuid4())[0:8], kind=kind, target=target, kwargs=kwargs, image_id=image.identifier, client=self.client)
+        try:
+            self.worker_pool.submit(job, depends_on=depends_on, limited=limited)
+        except BuildQueueFullException, e:
+            # The image exists already - give it a final status so that nothing waits on it forever
+            image.status_detail = {'activity': 'Image build refused.', 'error': str(e)}
+            image.status = "FAILED"
+            self.persistence_queue.save(image)
+            raise
+        return job
+
+    @contextmanager
+    def _resources(self, kind, *plugins):
+        # Hold the slots of the resource classes the plugins declare for this kind of job
+        plugin_mgr = PluginManager(self.app_config['plugins'])
+        needs = { }
+        for plugin in plugins:
+            for resource_class, count in plugin_mgr.resources_for(plugin, kind).items():
+                needs[resource_class] = max(count, needs.get(resource_class, 0))
+        res_mgr = ReservationManager()
+        res_mgr.enter_queues(needs, self.client)
+        try:
+            yield
+        finally:
+            res_mgr.exit_queues(needs)
+
+#####  SINGLE-FLIGHT HELPERS
+    def _lead_or_follow(self, key, image):
+        # Returns the in-flight image we should copy from, or None if we must do the build ourselves
+        if not self.app_config.get('coalesce_builds', True):
+            return None
+        return self.flights.lead_or_follow(key, image)
+
+    def _template_xml(self, template):
+        return template.xml if isinstance(template, Template) else template
+
+    def _queue_follower(self, kind, image, leader, callbackworkers):
+        image.status_detail = { 'activity': 'Waiting for identical build of image (%s)' % (leader.identifier), 'error': None }
+        image.status = "PENDING"
+        # Hold our job until the leader is done so that we never occupy a worker while waiting
+        leader_job = self.worker_pool.job_for_image(leader.identifier)
+        thread_kwargs = {'image':image, 'leader':leader, 'callbackworkers':callbackworkers}
+        return self._queue_job(kind, self._follow_image, thread_kwargs, image, depends_on=leader_job)
+
+    def _follow_image(self, image, leader, callbackworkers):
+        try:
+            leader = self._wait_for_final_status(leader)
+            if leader.status != "COMPLETE":
+                raise ImageFactoryException("The identical build (%s) that this image was attached to ended with status (%s)" % (leader.identifier, leader.status))
+            if leader.data and os.path.isfile(leader.data):
+                clone_file(leader.data, image.data)
+            # A ProviderImage shares the image on the provider with its leader - deleting
+            # either leaves it in place while the other refers to it
+            for key in leader.metadata():
+                if key in ('identifier', 'data', 'template', 'status', 'status_detail', 'parameters',
+                           'base_image_id', 'target_image_id'):
+                    continue
+                if hasattr(leader, key):
+                    setattr(image, key, getattr(leader, key))
+            # Keep our own request parameters but pick up anything the plugins recorded during the build
+            parameters = dict(leader.parameters)
+            parameters.update(image.parameters)
+            if leader.data and ('libvirt_xml' in parameters):
+                # The domain XML refers to the disk of the image it was generated for
+                parameters['libvirt_xml'] = parameters['libvirt_xml'].replace(leader.data, image.data)
+            image.parameters = parameters
+            image.status_detail = { 'activity': 'Image copied from identical build (%s)' % (leader.identifier), 'error': None }
+            image.status = "COMPLETE"
+            self.persistence_queue.save(image)
+        except Exception, e:
+            image.status_detail = {'activity': 'Image build failed with exception.', 'error': str(e)}
+            image.status = "FAILED"
+            self.persistence_queue.save(image)
+            self.log.error("Exception encountered in _follow_image thread")
+            self.log.exception(e)
+        finally:
+            # We only shut the workers down after a known-final state change
+            self._shutdown_callback_workers(image, callbackworkers)
+
+#####  OVERLAY HELPERS
+    def _flatten_for_plugin(self, image, plugin):
+        # Cloud plugins work on image bodies directly and, unless they say otherwise, expect a raw file
+        if not getattr(plugin, 'supports_overlay_images', False):
+            flatten(image)
+
 #####  PENDING BUILD HELPERS
     def _wait_for_final_status(self, image):
         image_id = image.identifier
         self.log.debug("Waiting for image of type (%s) and id (%s) to enter a final status" % (str(type(image)), image_id ) )
         # Wait forever - Short of a factory crash, we have timeouts elsewhere that should ensure
         #                that the pending images eventually hit success or failure
-        while(True):
-            # Our local image object isn't necessarily the one that is being actively updated
-            # In fact, we know it isn't.  It has been created out of a PIM retrieval.
-            # To update its metadata, we just re-fetch it.
-            image = self.pim.image_with_id(image_id)
-            if image.status not in [ 'NEW','PENDING' ]:
-                self.log.debug("Image of type (%s) entered final status of (%s)" % (str(type(image)), image.status) )
-                return image
-            sleep(5)
+        # Register before the first status check so that a terminal status change between the
+        # check and the wait cannot be missed
+        future = self.completion_registry.future_for_image(image_id)
+        try:
+            while(True):
+                # Our local image object isn't necessarily the one that is being actively updated
+                # In fact, we know it isn't.  It has been created out of a PIM retrieval.
+                # If the image is being built in this process, look at that object directly.
+                # Otherwise we have no choice but to re-fetch it from the PIM.
+                current_image = self.completion_registry.live_image(image_id)
+                if not current_image:
+                    current_image = self.pim.image_with_id(image_id)
+                if current_image.status in TERMINAL_STATUSES:
+                    image = current_image
+                    break
+                if future.wait(PENDING_POLL_INTERVAL):
+                    image = future.image
+                    break
+        finally:
+            self.completion_registry.discard_future(future)
+        self.log.debug("Image of type (%s) entered final status of (%s)" % (str(type(image)), image.status) )
+        return image
 
 #####  BUILD IMAGE
     def build_image_from_template(self, template, parameters=None):
@@ -114,31 +238,37 @@ class Builder(object):
         if parameters:
             self.base_image.parameters = parameters
         self.pim.add_image(self.base_image)
+        self.persistence_queue.watch(self.base_image)
         if parameters and ('callbacks' in parameters):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(self.base_image, parameters['callbacks'], self._base_image_cbws)
 
-        thread_name = str(uuid.uuid4())[0:8]
+        self._base_flight_key = flight_key('base_image', self._template_xml(template), parameters)
+        leader = self._lead_or_follow(self._base_flight_key, self.base_image)
+        if leader:
+            self.base_thread = self._queue_follower('base_image', self.base_image, leader, self._base_image_cbws)
+            return
+
         thread_kwargs = {'template':template, 'parameters':parameters}
-        self.base_thread = Thread(target=self._build_image_from_template, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.base_thread.start()
+        self.base_thread = self._queue_job('base_image', self._build_image_from_template, thread_kwargs, self.base_image)
 
     def _build_image_from_template(self, template, parameters=None):
         try:
             template = template if(isinstance(template, Template)) else Template(template)
             plugin_mgr = PluginManager(self.app_config['plugins'])
             self.os_plugin = plugin_mgr.plugin_for_target((template.os_name, template.os_version, template.os_arch))
-            self.base_image.status="BUILDING"
-            self.os_plugin.create_base_image(self, template, parameters)
+            with self._resources('base_image', self.os_plugin):
+                self.base_image.status="BUILDING"
+                self.os_plugin.create_base_image(self, template, parameters)
             # This implies a convention where the plugin can never dictate completion and must indicate failure
             # via an exception
             self.base_image.status_detail = { 'activity': 'Base Image build complete', 'error':None }
             self.base_image.status="COMPLETE"
-            self.pim.save_image(self.base_image)
+            self.persistence_queue.save(self.base_image)
         except Exception, e:
             self.base_image.status_detail = {'activity': 'Base Image build failed with exception.', 'error': str(e)}
             self.base_image.status="FAILED"
-            self.pim.save_image(self.base_image)
+            self.persistence_queue.save(self.base_image)
             self.log.error("Exception encountered in _build_image_from_template thread")
             self.log.exception(e)
         finally:
@@ -163,7 +293,8 @@ class Builder(object):
         self.target_image.template = template
         if parameters:
             self.target_image.parameters = parameters
-        self.pim.add_image(self.target_image)        
+        self.pim.add_image(self.target_image)
+        self.persistence_queue.watch(self.target_image)
         if parameters and ('callbacks' in parameters):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(self.target_image, parameters['callbacks'], self._target_image_cbws)
@@ -184,12 +315,18 @@ class Builder(object):
             raise ImageFactoryException("Asked to create a TargetImage without a BaseImage or a template")
 
         # Both base_image and target_image exist at this point and have IDs and status
-        # We can now launch our thread and return to the caller
-        
-        thread_name = str(uuid.uuid4())[0:8]
+        # We can now queue our job and return to the caller
+        # If the base image is still being built in this process, hold our job back until that is done
+        # Identical TargetImages share a key whether they name the same BaseImage or an identical template
+        self._target_flight_key = flight_key('target_image', self._base_flight_key or image_id, target, parameters)
+        leader = self._lead_or_follow(self._target_flight_key, self.target_image)
+        if leader:
+            self.target_thread = self._queue_follower('target_image', self.target_image, leader, self._target_image_cbws)
+            return
+
+        base_job = self.base_thread if self.base_thread else self.worker_pool.job_for_image(image_id)
         thread_kwargs = {'target':target, 'image_id':image_id, 'template':template, 'parameters':parameters}
-        self.target_thread = Thread(target=self._customize_image_for_target, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.target_thread.start()
+        self.target_thread = self._queue_job('target_image', self._customize_image_for_target, thread_kwargs, self.target_image, depends_on=base_job)
 
     def _customize_image_for_target(self, target, image_id=None, template=None, parameters=None):
         try:
@@ -202,7 +339,7 @@ class Builder(object):
                 self.log.debug("BaseImage builder thread (%s) finished - continuing with TargetImage tasks" % (threadname))
 
             # If we were called against an ongoing base_image build, wait for a terminal status on it
-            if self.base_image.status in [ "NEW", "PENDING" ]:
+            if self.base_image.status not in TERMINAL_STATUSES:
                 self.target_image.status="PENDING"
                 self.base_image = self._wait_for_final_status(self.base_image)
 
@@ -227,25 +364,27 @@ class Builder(object):
             if not self.cloud_plugin:
                 self.log.warn("Unable to find cloud plugin for target (%s)" % (target))
 
-            self.target_image.status = "BUILDING"
-            if(hasattr(self.cloud_plugin, 'builder_should_create_target_image')):
-                _should_create = self.cloud_plugin.builder_should_create_target_image(self, target, image_id, template, parameters)
-            else:
-                _should_create = True
-            if(_should_create and hasattr(self.cloud_plugin, 'builder_will_create_target_image')):
-                self.cloud_plugin.builder_will_create_target_image(self, target, image_id, template, parameters)
-            if(_should_create):
-                if(hasattr(self.os_plugin, 'create_target_image')):
-                    self.os_plugin.create_target_image(self, target, image_id, parameters)
-                if(hasattr(self.cloud_plugin, 'builder_did_create_target_image')):
-                    self.cloud_plugin.builder_did_create_target_image(self, target, image_id, template, parameters)
+            with self._resources('target_image', self.os_plugin, self.cloud_plugin):
+                self.target_image.status = "BUILDING"
+                if(hasattr(self.cloud_plugin, 'builder_should_create_target_image')):
+                    _should_create = self.cloud_plugin.builder_should_create_target_image(self, target, image_id, template, parameters)
+                else:
+                    _should_create = True
+                if(_should_create and hasattr(self.cloud_plugin, 'builder_will_create_target_image')):
+                    self.cloud_plugin.builder_will_create_target_image(self, target, image_id, template, parameters)
+                if(_should_create):
+                    if(hasattr(self.os_plugin, 'create_target_image')):
+                        self.os_plugin.create_target_image(self, target, image_id, parameters)
+                    if(hasattr(self.cloud_plugin, 'builder_did_create_target_image')):
+                        self._flatten_for_plugin(self.target_image, self.cloud_plugin)
+                        self.cloud_plugin.builder_did_create_target_image(self, target, image_id, template, parameters)
             self.target_image.status_detail = { 'activity': 'Target Image build complete', 'error':None }
             self.target_image.status = "COMPLETE"
-            self.pim.save_image(self.target_image)
+            self.persistence_queue.save(self.target_image)
         except Exception, e:
             self.target_image.status_detail={'activity': 'Target Image build failed with exception', 'error': str(e)}
             self.target_image.status = "FAILED"
-            self.pim.save_image(self.target_image)
+            self.persistence_queue.save(self.target_image)
             self.log.error("Exception encountered in _customize_image_for_target thread")
             self.log.exception(e)
         finally:
@@ -279,6 +418,7 @@ class Builder(object):
         self.provider_image.target_image_id = image_id
         self.provider_image.template = template
         self.pim.add_image(self.provider_image)
+        self.persistence_queue.watch(self.provider_image)
         if parameters and ('callbacks' in parameters):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(self.provider_image, parameters['callbacks'], self._provider_image_cbws)
@@ -306,10 +446,18 @@ class Builder(object):
         else:
             raise ImageFactoryException("Asked to create a ProviderImage without a TargetImage or a template")
 
-        thread_name = str(uuid.uuid4())[0:8]
+        # If the target image is still being built in this process, hold our job back until that is done
+        # Secondaries are handed the ProviderImage id to use - never coalesce those
+        if not my_image_id:
+            key = flight_key('provider_image', self._target_flight_key or image_id, provider, credentials, target, parameters)
+            leader = self._lead_or_follow(key, self.provider_image)
+            if leader:
+                self.push_thread = self._queue_follower('provider_image', self.provider_image, leader, self._provider_image_cbws)
+                return
+
+        target_job = self.target_thread if self.target_thread else self.worker_pool.job_for_image(image_id)
         thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_id':image_id, 'template':template, 'parameters':parameters}
-        self.push_thread = Thread(target=self._push_image_to_provider, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.push_thread.start()
+        self.push_thread = self._queue_job('provider_image', self._push_image_to_provider, thread_kwargs, self.provider_image, depends_on=target_job)
 
     def _push_image_to_provider(self, provider, credentials, target, image_id, template, parameters):
         try:
@@ -322,7 +470,7 @@ class Builder(object):
                 self.log.debug("TargetImage builder thread (%s) finished - continuing with ProviderImage tasks" % (threadname))
 
             # If we were called against an ongoing target_image build, wait for a terminal status on it
-            if self.target_image.status in [ "NEW", "PENDING" ]:
+            if self.target_image.status not in TERMINAL_STATUSES:
                 self.provider_image.status = "PENDING"
                 self.target_image = self._wait_for_final_status(self.target_image) 
 
@@ -351,15 +499,17 @@ class Builder(object):
                 plugin_mgr = PluginManager(self.app_config['plugins'])
                 if not self.cloud_plugin:
                     self.cloud_plugin = plugin_mgr.plugin_for_target(target)
-            self.provider_image.status="BUILDING"
-            self.cloud_plugin.push_image_to_provider(self, provider, credentials, target, image_id, parameters)
+            with self._resources('provider_image', self.cloud_plugin):
+                self.provider_image.status="BUILDING"
+                self._flatten_for_plugin(self.target_image, self.cloud_plugin)
+                self.cloud_plugin.push_image_to_provider(self, provider, credentials, target, image_id, parameters)
             self.provider_image.status_detail = { 'activity': 'Provider Image build complete', 'error':None }
             self.provider_image.status="COMPLETE"
-            self.pim.save_image(self.provider_image)
+            self.persistence_queue.save(self.provider_image)
         except Exception, e:
             self.provider_image.status_detail={'activity': 'Provider Image build failed with exception', 'error': str(e)}
             self.provider_image.status="FAILED"
-            self.pim.save_image(self.provider_image)
+            self.persistence_queue.save(self.provider_image)
             self.log.error("Exception encountered in _push_image_to_provider thread")
             self.log.exception(e)
         finally:
@@ -387,6 +537,7 @@ class Builder(object):
         self.provider_image.target_image_id = image_id
         self.provider_image.template = template
         self.pim.add_image(self.provider_image)
+        self.persistence_queue.watch(self.provider_image)
         if parameters and ('callbacks' in parameters):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(self.provider_image, parameters['callbacks'], self._provider_image_cbws)
@@ -394,10 +545,15 @@ class Builder(object):
         if not template:
             raise ImageFactoryException("Must specify a template when requesting a snapshot-style build")
 
-        thread_name = str(uuid.uuid4())[0:8]
+        if not my_image_id:
+            key = flight_key('snapshot', self._template_xml(template), provider, credentials, target, parameters)
+            leader = self._lead_or_follow(key, self.provider_image)
+            if leader:
+                self.snapshot_thread = self._queue_follower('snapshot', self.provider_image, leader, self._provider_image_cbws)
+                return
+
         thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_id':image_id, 'template':template, 'parameters':parameters}
-        self.snapshot_thread = Thread(target=self._snapshot_image, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.snapshot_thread.start()
+        self.snapshot_thread = self._queue_job('snapshot', self._snapshot_image, thread_kwargs, self.provider_image)
 
     def _snapshot_image(self, provider, credentials, target, image_id, template, parameters):
         try:
@@ -412,16 +568,17 @@ class Builder(object):
             else:    
                 plugin_mgr = PluginManager(self.app_config['plugins'])
                 self.cloud_plugin = plugin_mgr.plugin_for_target(target)
-            self.provider_image.status="BUILDING"
-            self.cloud_plugin.snapshot_image_on_provider(self, provider, credentials, target, template, parameters)
+            with self._resources('snapshot', self.cloud_plugin):
+                self.provider_image.status="BUILDING"
+                self.cloud_plugin.snapshot_image_on_provider(self, provider, credentials, target, template, parameters)
             self.provider_image.status_detail = { 'activity': 'Provider Image build complete', 'error':None }
             self.provider_image.status="COMPLETE"
-            self.pim.save_image(self.provider_image)
+            self.persistence_queue.save(self.provider_image)
         except Exception, e:
             self.provider_image.status_detail = {'activity': 'Provider Image build failed with exception',
                                                  'error': str(e)}
             self.provider_image.status="FAILED"
-            self.pim.save_image(self.provider_image)
+            self.persistence_queue.save(self.provider_image)
             self.log.error("Exception encountered in _snapshot_image thread")
             self.log.exception(e)
         finally:
@@ -442,14 +599,18 @@ class Builder(object):
 
         @return TODO
         """
+        # Refused up front so that an image still in use keeps its status
+        dependents = dependent_image_ids(self.pim, image_object.identifier)
+        if dependents:
+            raise ImageInUseException("Image (%s) backs the TargetImage overlays (%s) - delete those first" % (image_object.identifier, ', '.join(dependents)))
+
         if parameters and ('callbacks' in parameters):
             # This ensures we have workers in place before any potential state changes
             self._init_callback_workers(image_object, parameters['callbacks'], self._deletion_cbws)
 
-        thread_name = str(uuid.uuid4())[0:8]
         thread_kwargs = {'provider':provider, 'credentials':credentials, 'target':target, 'image_object':image_object, 'parameters':parameters}
-        self.delete_thread = Thread(target=self._delete_image, name=thread_name, args=(), kwargs=thread_kwargs)
-        self.delete_thread.start()
+        # Deleting frees resources - it is never refused for a full queue
+        self.delete_thread = self._queue_job('delete', self._delete_image, thread_kwargs, image_object, limited=False)
 
 
     def _delete_image(self, provider, credentials, target, image_object, parameters):
@@ -459,16 +620,36 @@ class Builder(object):
                 self.provider_image = image_object
                 plugin_mgr = PluginManager(self.app_config['plugins'])
                 self.cloud_plugin = plugin_mgr.plugin_for_target(target)
-                self.cloud_plugin.delete_from_provider(self, provider, credentials, target, parameters)
-            self.pim.delete_image_with_id(image_object.identifier)
+                self._delete_provider_image(image_object, provider, credentials, target, parameters)
+            else:
+                self.pim.delete_image_with_id(image_object.identifier)
             image_object.status_detail = {'activity': 'Image deleted.', 'error': None}
             image_object.status = "DELETED"
         except Exception, e:
             image_object.status_detail = {'activity': 'Failed to delete image.', 'error': str(e)}
             image_object.status="DELETEFAILED"
-            self.pim.save_image(image_object)
+            self.persistence_queue.save(image_object)
             self.log.error("Exception encountered in _delete_image_on_provider thread")
             self.log.exception(e)
         finally:
             # We only shut the workers down after a known-final state change
             self._shutdown_callback_workers(image_object, self._deletion_cbws)
+
+    def _delete_provider_image(self, image_object, provider, credentials, target, parameters):
+        # Coalesced pushes share one image on the provider - only the last ProviderImage
+        # referring to it deletes it.  Held until the metadata is gone so that two deletes
+        # cannot each see the other and both leave the image behind.
+        lock_name = 'provider-image-%s' % (image_object.identifier_on_provider)
+        res_mgr = ReservationManager()
+        res_mgr.get_named_lock(lock_name)
+        try:
+            sharing = sharing_image_ids(self.pim, image_object)
+            if sharing:
+                self.log.debug("Image (%s) on the provider is still used by (%s) - only deleting ProviderImage (%s)" %
+                               (image_object.identifier_on_provider, ', '.join(sharing), image_object.identifier))
+            else:
+                with self._resources('delete', self.cloud_plugin):
+                    self.cloud_plugin.delete_from_provider(self, provider, credentials, target, parameters)
+            self.pim.delete_image_with_id(image_object.identifier)
+        finally:
+            res_mgr.release_named_lock(lock_name)
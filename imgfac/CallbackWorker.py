@@ -1,5 +1,5 @@
 
-# Callable class that is used to launch a thread
+# Status callbacks for images - see CallbackWorker and CallbackDeliveryService
 import threading
 import time
 import logging
@@ -7,22 +7,223 @@ import httplib2
 import json
 import re
 import base64
+import urlparse
+from collections import deque
+from Singleton import Singleton
+from ApplicationConfiguration import ApplicationConfiguration
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 2
+
+class CallbackDeliveryService(Singleton):
+    """
+    Delivers image status callbacks for every CallbackWorker on a fixed set of threads.
+
+    Updates are queued per (callback URL, image) and only the latest one is kept, so an image
+    that changes status faster than its callback URL accepts PUTs simply skips the
+    intermediate states.  Updates for the same URL and image are never sent concurrently or out
+    of order.  Failed deliveries (connection errors and 5xx responses) are retried with an
+    exponential backoff unless a newer update has arrived in the meantime.
+
+    callback_max_in_flight caps the number of PUTs outstanding at once.  Each delivery thread
+    borrows an httplib2.Http object for the target host from a pool so that connections to
+    the same host are kept alive and reused.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        appconfig = ApplicationConfiguration().configuration
+        self.max_in_flight = max(1, int(appconfig.get('callback_max_in_flight', DEFAULT_MAX_IN_FLIGHT)))
+        self.retries = int(appconfig.get('callback_retries', DEFAULT_RETRIES))
+        self.retry_delay = float(appconfig.get('callback_retry_delay', DEFAULT_RETRY_DELAY))
+        # (url, image_id) -> dict(headers, body, attempt, not_before) - the newest undelivered update
+        self._pending = { }
+        # Keys with a pending update in the order they became ready
+        self._ready = deque()
+        # Keys with a PUT currently outstanding
+        self._in_flight = set()
+        # host -> idle httplib2.Http objects
+        self._connections = { }
+        self._condition = threading.Condition()
+        self._workers = [ ]
+        self.delivered = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def _start_workers(self):
+        # Caller must hold _condition
+        while len(self._workers) < self.max_in_flight:
+            worker = threading.Thread(target=self._work, name='callback-worker-%d' % len(self._workers))
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def enqueue(self, url, image_id, headers, body):
+        """
+        Queue an update, replacing any update for the same URL and image that has not been sent yet.
+
+        @param url The callback URL
+        @param image_id The identifier of the image the update describes
+        @param headers Dict of HTTP headers
+        @param body Dict to be sent as JSON
+        """
+        key = (url, image_id)
+        self._condition.acquire()
+        try:
+            self._start_workers()
+            if key in self._pending:
+                self.coalesced += 1
+            elif key not in self._in_flight:
+                self._ready.append(key)
+            # If the key is in flight it is made ready again once that PUT finishes
+            self._pending[key] = dict(headers=headers, body=body, attempt=0, not_before=0)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def is_idle(self, url, image_id):
+        self._condition.acquire()
+        try:
+            key = (url, image_id)
+            return (key not in self._pending) and (key not in self._in_flight)
+        finally:
+            self._condition.release()
+
+    def wait_for_delivery(self, url, image_ids, timeout=None):
+        """
+        Block until nothing is queued or in flight for url and any of image_ids.
+
+        @return True if everything was delivered (or given up on), False on timeout
+        """
+        deadline = (time.time() + timeout) if timeout else None
+        self._condition.acquire()
+        try:
+            while [ image_id for image_id in image_ids if ((url, image_id) in self._pending) or ((url, image_id) in self._in_flight) ]:
+                remaining = (deadline - time.time()) if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+        finally:
+            self._condition.release()
+
+    def _next_update(self):
+        # Caller must hold _condition
+        # Returns (key, update) for the first ready key whose backoff has expired, or the number
+        # of seconds until one will be
+        now = time.time()
+        soonest = None
+        for i in range(len(self._ready)):
+            key = self._ready[i]
+            update = self._pending[key]
+            if update['not_before'] <= now:
+                del self._ready[i]
+                del self._pending[key]
+                self._in_flight.add(key)
+                return key, update
+            wait = update['not_before'] - now
+            soonest = wait if (soonest is None) else min(soonest, wait)
+        return None, soonest
+
+    def _work(self):
+        while True:
+            self._condition.acquire()
+            try:
+                key, update = self._next_update()
+                while not key:
+                    self._condition.wait(update)
+                    key, update = self._next_update()
+            finally:
+                self._condition.release()
+
+            delivered = self._deliver(key[0], update)
+
+            self._condition.acquire()
+            try:
+                self._in_flight.discard(key)
+                if key in self._pending:
+                    # A newer update arrived while we were sending - it supersedes any retry
+                    self._ready.append(key)
+                elif not delivered and (update['attempt'] < self.retries):
+                    update['attempt'] += 1
+                    update['not_before'] = time.time() + (self.retry_delay * (2 ** (update['attempt'] - 1)))
+                    self.log.debug("Retrying callback to (%s) in %d seconds" % (key[0], update['not_before'] - time.time()))
+                    self._pending[key] = update
+                    self._ready.append(key)
+                elif not delivered:
+                    self.failed += 1
+                    self.log.warn("Giving up on callback to (%s) for image (%s)" % (key[0], key[1]))
+                else:
+                    self.delivered += 1
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+
+    def _borrow_connection(self, url):
+        host = urlparse.urlparse(url)[1]
+        self._condition.acquire()
+        try:
+            idle = self._connections.get(host)
+            connection = idle.pop() if idle else None
+        finally:
+            self._condition.release()
+        return host, (connection if connection else httplib2.Http())
+
+    def _return_connection(self, host, connection):
+        self._condition.acquire()
+        try:
+            self._connections.setdefault(host, [ ]).append(connection)
+        finally:
+            self._condition.release()
+
+    def _deliver(self, url, update):
+        self.log.debug("Updated image is: (%s)" % (str(update['body'])))
+        if url == "debug":
+            self.log.debug("Executing a debug callback - sleeping 5 seconds - no actual PUT sent")
+            time.sleep(5)
+            return True
+        self.log.debug("PUTing update to URL (%s)" % (url))
+        host, connection = self._borrow_connection(url)
+        try:
+            resp, content = connection.request(url, "PUT", body=json.dumps(update['body']), headers=update['headers'])
+        except Exception, e:
+            # A connection in an unknown state is not worth keeping
+            self.log.debug("Caught exception (%s) when attempting to PUT callback" % (str(e)))
+            return False
+        self._return_connection(host, connection)
+        if resp.status >= 500:
+            self.log.debug("Callback URL (%s) returned status (%d)" % (url, resp.status))
+            return False
+        # Anything else is the receiver's final answer - a 4xx will not improve on retry
+        return True
+
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return { 'pending': len(self._pending), 'in_flight': len(self._in_flight), 'delivered': self.delivered,
+                     'coalesced': self.coalesced, 'failed': self.failed }
+        finally:
+            self._condition.release()
+
 
 class CallbackWorker():
+    """
+    Observer that sends the full object JSON for each status change of an image to a callback URL.
+    The sending itself is done by the shared CallbackDeliveryService.
+    """
 
     def __init__(self, callback_url):
         # callback_url - the URL to which we will send the full object JSON for each STATUS update
-        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))        
-        self.callback_queue = [ ]
-        self.queue_lock = threading.BoundedSemaphore()
-        self.queue_not_empty = threading.Event()
-        self.httplib = httplib2.Http()
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.delivery = CallbackDeliveryService()
+        self.image_ids = set()
         # TODO: A more flexible approach than simply supporting basic auth embedded in the URL
         url_regex = r"^(\w*://)([^:/]+)(:)([^:/]+)(@)(.*)$"
         sr = re.search(url_regex, callback_url)
         if sr:
             self.callback_url = sr.group(1) + sr.group(6)
-            auth = base64.encodestring( sr.group(2) + ':' + sr.group(4) )
+            auth = base64.encodestring( sr.group(2) + ':' + sr.group(4) ).strip()
             self.headers = {'content-type':'application/json', 'Authorization' : 'Basic ' + auth}
         else:
             self.callback_url = callback_url
@@ -30,34 +231,15 @@ class CallbackWorker():
         self.shutdown = False
 
     def start(self):
-        self.thread = threading.Thread(target=self)
-        self.thread.start()
-        return self.thread
+        # Nothing to start - kept so that callers can treat us like the thread we used to be
+        pass
 
     def shut_down(self, blocking=False):
         # At this point the caller has promised us that they will not enqueue anything else
+        # Updates already queued are still delivered
         self.shutdown = True
-        self.queue_lock.acquire()
-        ### QUEUE LOCK ###
-        # The queue cannot grow at this point
-        # The worker thread at this point can be:
-        # 1) Sleeping due to empty 
-        # 2) Woken up but not yet acquired lock in _get_next_callback()
-        # 3) Woken up and past QUEUE LOCK in _get_next_callback() (including remainder of main loop)
-        #
-        # We wish to avoid a situation where the worker thread lingers forever because it is sleeping
-        # on an empty queue
-        # In case 2 the queue may end up empty but that will be caught in the main loop
-        # In case 3 the queue may already be empty but this _should_ always be caught by the main loop
-        # Case 1 is only possible if the queue is already empty (I think)
-        # So, here we check if the queue is empty and, if it is, we inaccurately set queue_not_empty
-        # to wake up the worker thread.  _get_next_thing will detect this and fall through to the 
-        # bottom of the main loop which will, in turn, break out and exit
-        if len(self.callback_queue) == 0:
-            self.queue_not_empty.set()
-        self.queue_lock.release()
         if blocking:
-            self.thread.join()
+            self.delivery.wait_for_delivery(self.callback_url, self.image_ids)
 
     def status_notifier(self, notification):
         image = notification.sender
@@ -71,66 +253,10 @@ class CallbackWorker():
         for key in image.metadata():
             if key not in ('identifier', 'data', 'base_image_id', 'target_image_id'):
                 callback_body[typemap[_type]][key] = getattr(image, key, None)
-        self._enqueue(callback_body)
+        self._enqueue(image.identifier, callback_body)
 
-    def _enqueue(self, status_update):
-        # This is, in short, a request to enqueue a task
+    def _enqueue(self, image_id, status_update):
         if self.shutdown:
-            raise Exception("Attempt made to add work to a terminating worker thread")
-        self.queue_lock.acquire()
-        ### QUEUE LOCK ###
-        self.callback_queue.append(status_update)
-        self.queue_not_empty.set()
-        ### END QUEUE LOCK ###
-        self.queue_lock.release()
-
-    def _wait_for_callback(self):
-        # Called at the start of the main loop if the queue is empty
-        # self.queue_not_empty is set anytime an item is added to the queue
-        # or if the shutdown method is called on an empty queue (which prevents us
-        # waiting here forever)
-        self.log.debug("Entering blocking non-empty queue call")
-        self.queue_not_empty.wait()
-        self.log.debug("Leaving blocking non-empty queue call")
-
-    def _get_next_callback(self):
-        self.queue_lock.acquire()
-        ### QUEUE LOCK ###
-        if len(self.callback_queue) == 0:
-            # Can potentially happen if worker is shutdown without doing anything
-            self.queue_lock.release()
-            return None
-        next_callback = self.callback_queue.pop(0)
-        if len(self.callback_queue) == 0:
-            self.queue_not_empty.clear()
-        ### END QUEUE LOCK ###
-        self.queue_lock.release()
-        return next_callback
-
-    def _do_next_callback(self):
-        self._wait_for_callback()
-        next_callback = self._get_next_callback()
-        if next_callback:
-            self.log.debug("Updated image is: (%s)" % (str(next_callback)))
-            if self.callback_url == "debug":
-                self.log.debug("Executing a debug callback - sleeping 5 seconds - no actual PUT sent")
-                time.sleep(5)
-            else:
-                self.log.debug("PUTing update to URL (%s)" % (self.callback_url))
-                try:
-                    resp, content = self.httplib.request(self.callback_url, 
-                                                         "PUT", body=json.dumps(next_callback), 
-                                                         headers=self.headers )
-                except Exception, e:
-                    # We treat essentially every potential error here as non-fatal and simply move on to the next update
-                    # TODO: Configurable retries?
-                    self.log.debug("Caught exception (%s) when attempting to PUT callback - Ignoring" % (str(e)))
-
-    def __call__(self):
-        while True:
-            self._do_next_callback()
-            if self.shutdown and len(self.callback_queue) == 0:
-                break
-    
-    
-
+            raise Exception("Attempt made to add work to a terminating callback worker")
+        self.image_ids.add(image_id)
+        self.delivery.enqueue(self.callback_url, image_id, self.headers, status_update)
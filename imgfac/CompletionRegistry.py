@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import weakref
+from collections import defaultdict
+from threading import BoundedSemaphore, Event
+from Singleton import Singleton
+from NotificationCenter import NotificationCenter
+from PersistentImage import TERMINAL_STATUSES
+
+
+class CompletionFuture(object):
+    """ Handed out by CompletionRegistry - set once the image it was created for reaches a terminal status """
+
+    def __init__(self, image_id):
+        self.image_id = image_id
+        self.image = None
+        self._event = Event()
+
+    def done(self):
+        return self._event.isSet()
+
+    def wait(self, timeout=None):
+        """
+        Block until the image reaches a terminal status or until timeout seconds have passed.
+
+        @param timeout Seconds to wait or None to wait forever
+
+        @return True if the image reached a terminal status, False on timeout
+        """
+        self._event.wait(timeout)
+        return self._event.isSet()
+
+    def _set_result(self, image):
+        self.image = image
+        self._event.set()
+
+
+class CompletionRegistry(Singleton):
+    """
+    Wakes threads waiting on another image's build as soon as that image posts a terminal
+    'image.status' notification, rather than having them poll the PersistentImageManager.
+
+    Notifications are only posted by the image objects that are actively being built in this
+    process.  Those objects are tracked here (weakly) so that waiters can inspect them directly.
+    Images being built by another process never post here, so waiters on them must still fall
+    back to re-fetching the image from the PersistentImageManager.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self._futures = defaultdict(list)
+        self._live_images = weakref.WeakValueDictionary()
+        self._lock = BoundedSemaphore()
+        NotificationCenter().add_observer(self, 'handle_state_change', 'image.status')
+
+    def handle_state_change(self, notification):
+        image = notification.sender
+        image_id = image.identifier
+        self._lock.acquire()
+        try:
+            self._live_images[image_id] = image
+            if notification.user_info['new_status'] in TERMINAL_STATUSES:
+                futures = self._futures.pop(image_id, [ ])
+            else:
+                futures = [ ]
+        finally:
+            self._lock.release()
+
+        for future in futures:
+            future._set_result(image)
+        if len(futures) > 0:
+            self.log.debug("Woke %d waiter(s) for image (%s)" % (len(futures), image_id))
+
+    def future_for_image(self, image_id):
+        """
+        Register interest in the given image reaching a terminal status.
+        Callers must release the future with discard_future() once they are done with it.
+
+        @param image_id The identifier of the image to wait on
+
+        @return A CompletionFuture
+        """
+        future = CompletionFuture(image_id)
+        self._lock.acquire()
+        try:
+            self._futures[image_id].append(future)
+        finally:
+            self._lock.release()
+        return future
+
+    def discard_future(self, future):
+        self._lock.acquire()
+        try:
+            futures = self._futures.get(future.image_id)
+            if futures and (future in futures):
+                futures.remove(future)
+                if len(futures) == 0:
+                    del self._futures[future.image_id]
+        finally:
+            self._lock.release()
+
+    def live_image(self, image_id):
+        """
+        The image object being actively built for image_id in this process, if any.
+
+        @param image_id The identifier of the image
+
+        @return A PersistentImage or None
+        """
+        return self._live_images.get(image_id)
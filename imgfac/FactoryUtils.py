@@ -97,6 +97,13 @@ def subprocess_check_output_pty(*popenargs, **kwargs):
         raise ImageFactoryException("'%s' failed(%d): %s" % (cmd, retcode, stderr))
     return (stdout, stderr, retcode)
 
+def clone_file(source, destination):
+    """
+    Copy source to destination, sharing extents where the filesystem supports reflinks
+    and preserving holes in sparse images everywhere else.
+    """
+    return subprocess_check_output(['cp', '--reflink=auto', '--sparse=always', source, destination])
+
 def ssh_execute_command(guestaddr, sshprivkey, command, timeout=10, user='root', prefix=None):
     """
     Function to execute a command on the guest using SSH and return the output.
@@ -0,0 +1,164 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import heapq
+import itertools
+import time
+from threading import Condition
+
+# Clients that are not named share this one
+DEFAULT_CLIENT = 'default'
+
+
+class FairTags(object):
+    """
+    Self-clocked weighted fair queueing tags.
+
+    Each unit of work a client asks for is stamped with a virtual finish time: the later of the
+    current virtual time and the client's previous finish time, plus its cost divided by the
+    weight of the client.  Serving work in finish time order gives each busy client a share in
+    proportion to its weight, however much any one of them has queued.  The virtual time
+    follows the finish time of the work last served.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights if weights else { }
+        self.virtual_time = 0.0
+        self._finish = { }
+
+    def stamp(self, client, cost=1):
+        """
+        @param client The client asking for the work
+        @param cost The amount of work
+
+        @return The virtual finish time of the work
+        """
+        client = client or DEFAULT_CLIENT
+        weight = max(float(self.weights.get(client, 1)), 0.001)
+        finish = max(self.virtual_time, self._finish.get(client, 0.0)) + (cost / weight)
+        self._finish[client] = finish
+        return finish
+
+    def served(self, finish):
+        """
+        Advance the virtual time to that of work being served.
+
+        @param finish The virtual finish time given by stamp()
+        """
+        self.virtual_time = max(self.virtual_time, finish)
+        # Clients behind the virtual time start from it anyway
+        for client in [ client for client, tag in self._finish.items() if tag <= self.virtual_time ]:
+            del self._finish[client]
+
+
+class WaitStats(object):
+    """ Counts of how often and how long things waited, overall and for each client """
+
+    def __init__(self):
+        self.total = self._empty()
+        self.clients = { }
+
+    def _empty(self):
+        return {'entered': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+    def record(self, client, wait):
+        for stats in (self.total, self.clients.setdefault(client or DEFAULT_CLIENT, self._empty())):
+            stats['entered'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+
+    def report(self):
+        report = dict(self.total)
+        report['clients'] = dict([ (client, dict(stats)) for client, stats in self.clients.items() ])
+        return report
+
+
+class FairQueue(object):
+    """
+    A counting semaphore of size slots that hands slots to its waiters in weighted fair order
+    across clients rather than first come, first served.
+
+    A waiter that needs more slots than are free holds up those behind it, so that asking for
+    several slots at once never starves.
+    """
+
+    def __init__(self, name, size, weights=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.name = name
+        self.size = size
+        self.in_use = 0
+        self.stats = WaitStats()
+        self._tags = FairTags(weights)
+        self._waiting = [ ]
+        self._sequence = itertools.count()
+        self._condition = Condition()
+
+    def enter(self, client=None, count=1):
+        """
+        Take count slots, waiting until it is the turn of this client and they are free.
+
+        @param client The client the slots are for
+        @param count The number of slots
+
+        @return The number of seconds spent waiting
+        """
+        if count > self.size:
+            self.log.warn("Asked for %d slots of queue (%s), which only has %d - taking them all" % (count, self.name, self.size))
+            count = self.size
+        started = time.time()
+        self._condition.acquire()
+        try:
+            waiter = (self._tags.stamp(client, count), self._sequence.next(), count)
+            heapq.heappush(self._waiting, waiter)
+            while (self._waiting[0] is not waiter) or (self.in_use + count > self.size):
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._tags.served(waiter[0])
+            self.in_use += count
+            wait = time.time() - started
+            self.stats.record(client, wait)
+            # The next waiter may fit in what is left
+            self._condition.notifyAll()
+            return wait
+        finally:
+            self._condition.release()
+
+    def exit(self, count=1):
+        """
+        Give back slots taken with enter()
+
+        @param count The number of slots
+        """
+        self._condition.acquire()
+        try:
+            self.in_use -= min(count, self.size)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def report(self):
+        """
+        @return A dict of the size of the queue, the slots in use, the number of waiters and
+        their wait times, overall and for each client
+        """
+        self._condition.acquire()
+        try:
+            report = self.stats.report()
+            report.update(size=self.size, in_use=self.in_use, waiting=len(self._waiting))
+            return report
+        finally:
+            self._condition.release()
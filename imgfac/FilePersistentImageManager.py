@@ -15,26 +15,72 @@
 #   limitations under the License.
 
 import logging
-import re
 import os
 import os.path
 import stat
 import json
+import tempfile
+import time
+import bisect
+import hashlib
+import re
+from copy import deepcopy
+from collections import defaultdict
 from props import prop
 from ImageFactoryException import ImageFactoryException
 from PersistentImageManager import PersistentImageManager
+from PersistentImage import BLOB_METADATA, TERMINAL_STATUSES
+from MetadataJournal import MetadataJournal, DEFAULT_SNAPSHOT_INTERVAL
 from threading import BoundedSemaphore
 
 STORAGE_PATH = '/var/lib/imagefactory/storage'
 METADATA_EXT = '.meta'
 BODY_EXT = '.body'
+TEMP_EXT = '.tmp'
+# Metadata writes for different images only contend when they hash to the same lock
+METADATA_LOCK_STRIPES = 64
+# Metadata keys for which we maintain a value -> identifiers lookup table
+INDEXED_KEYS = ('type', 'base_image_id', 'target_image_id', 'status', 'target', 'provider', 'backing_image_id')
+# Copies of an image body kept next to it - they move with the body
+BODY_COMPANION_EXTS = ('.gz', '.gz-factory-compressed')
+# Sharded stores keep the files of an image two directories down, in ab/cd/ named for the start
+# of the MD5 of its identifier, so that no one directory holds more than a few hundred images.
+# Stores written by earlier releases keep every file in storage_path itself.  Both layouts are
+# read, so a store can be migrated with migrate_to_sharded() while it is in use.
+SHARD_NAME = re.compile('^[0-9a-f]{2}$')
+# Seconds within which a second change to a file or directory may leave its mtime as the first one set it
+MTIME_GRANULARITY = 1.0
+# Without a journal, seconds between scans for the changes of other processes - queries made in
+# between answer from the index, which the changes of this process keep current
+REFRESH_INTERVAL = 1.0
+
+def shard_directory(storage_path, image_id):
+    """
+    @return The directory of the sharded layout that holds the files of an image
+    """
+    digest = hashlib.md5(str(image_id)).hexdigest()
+    return os.path.join(storage_path, digest[0:2], digest[2:4])
+
+def storage_directories(storage_path):
+    """
+    @return A list of storage_path and every shard directory under it
+    """
+    directories = [ storage_path ]
+    for first in sorted(os.listdir(storage_path)):
+        first_path = os.path.join(storage_path, first)
+        if not (SHARD_NAME.match(first) and os.path.isdir(first_path)):
+            continue
+        for second in sorted(os.listdir(first_path)):
+            if SHARD_NAME.match(second) and os.path.isdir(os.path.join(first_path, second)):
+                directories.append(os.path.join(first_path, second))
+    return directories
 
 class FilePersistentImageManager(PersistentImageManager):
     """ TODO: Docstring for PersistentImageManager  """
 
     storage_path = prop("_storage_path")
 
-    def __init__(self, storage_path=STORAGE_PATH):
+    def __init__(self, storage_path=STORAGE_PATH, sharded=True, journal=True, snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         if not os.path.exists(storage_path):
             self.log.debug("Creating directory (%s) for persistent storage" % (storage_path))
@@ -46,8 +92,232 @@ class FilePersistentImageManager(PersistentImageManager):
             # TODO: verify that we can write to this location
             pass
         self.storage_path = storage_path
-        self.metadata_lock = BoundedSemaphore()
+        # Where the files of new images go - existing files are found in either layout
+        self.sharded = sharded
+        # Metadata files are replaced atomically so readers never need these - they only order
+        # the writes (and index updates) for any one image
+        self.metadata_locks = [ BoundedSemaphore() for i in range(METADATA_LOCK_STRIPES) ]
+        # In-memory view of the metadata of every image
+        # This is built once here and then kept current by add_image(), save_image() and
+        # delete_image_with_id().  Before each query the changes made by other processes are
+        # read - from the journal or, without one, from the directories whose mtime moved.
+        self.index_lock = BoundedSemaphore()
+        # Held for a whole scan, so that no query answers from a directory half read by another
+        self._scan_lock = BoundedSemaphore()
+        self._scanned = None
+        self.refresh_interval = REFRESH_INTERVAL
+        self._metadata_index = { }
+        self._query_index = dict([ (key, defaultdict(set)) for key in INDEXED_KEYS ])
+        # With a journal the index is rebuilt from its last snapshot and the records since, and
+        # the .meta files are a copy kept for other tools and for managers without a journal.
+        # Without one, or the first time a journal is used, every .meta file is read.
+        self.journal = None
+        if journal:
+            self.journal = MetadataJournal(storage_path, self._apply_record, self._reset_index,
+                                           self._indexed_metadata, snapshot_interval)
+        if not (self.journal and self.journal.load()):
+            self._load_index()
+            if self.journal:
+                self.journal.snapshot()
+
+    def _load_index(self):
+        self._directory_mtimes = { }
+        self._directory_ids = { }
+        self._directory_children = { }
+        self._file_mtimes = { }
+        self._scan_directory(self.storage_path, 0, cleanup=True)
+        self._scanned = time.time()
+        self.log.debug("Indexed metadata for %d images in (%s)" % (len(self._metadata_index), self.storage_path))
+
+    def _refresh_index(self):
+        # Other processes may have added, saved or deleted images since the index was last read.
+        # Every metadata write renames a file into its directory, which moves the mtime of the
+        # directory, so only the directories whose mtime moved are read again.
+        if self.journal:
+            # Their changes are in the journal - the .meta files are only a copy
+            self.journal.refresh()
+            return
+        self._scan_lock.acquire()
+        try:
+            # A scan stats every directory of the store - queries close together share one
+            if (self._scanned is not None) and (time.time() - self._scanned < self.refresh_interval):
+                return
+            self._scan_directory(self.storage_path, 0)
+            self._scanned = time.time()
+        finally:
+            self._scan_lock.release()
+
+    def _scan_directory(self, directory, depth, cleanup=False):
+        # Caller must hold _scan_lock, or be the constructor
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        if self._directory_mtimes.get(directory) != mtime:
+            filenames = os.listdir(directory)
+            if depth < 2:
+                self._directory_children[directory] = [ os.path.join(directory, filename) for filename in sorted(filenames)
+                                                        if SHARD_NAME.match(filename) and os.path.isdir(os.path.join(directory, filename)) ]
+            self._index_directory(directory, filenames, cleanup)
+            # Only recorded once the directory is indexed.  A change made within MTIME_GRANULARITY
+            # of the last one can leave the mtime where it was - look again next time until the
+            # directory has been quiet for longer than that, and the same goes for the files in it
+            if time.time() - mtime > MTIME_GRANULARITY:
+                self._directory_mtimes[directory] = mtime
+            else:
+                self._directory_mtimes.pop(directory, None)
+        for child in self._directory_children.get(directory, [ ]):
+            self._scan_directory(child, depth + 1, cleanup)
+
+    def _index_directory(self, directory, filenames, cleanup):
+        image_ids = set()
+        for storefileshortname in filenames:
+            storefilename = os.path.join(directory, storefileshortname)
+            if storefileshortname.endswith(TEMP_EXT):
+                if cleanup:
+                    # Left behind by a write that never got as far as its rename
+                    self.log.debug("Removing incomplete metadata file (%s)" % (storefilename))
+                    try:
+                        os.remove(storefilename)
+                    except OSError as e:
+                        self.log.warn("Unable to remove incomplete metadata file: %s" % (e))
+                continue
+            if not storefileshortname.endswith(METADATA_EXT):
+                continue
+            image_id = storefileshortname[:-len(METADATA_EXT)]
+            if (directory != self.storage_path) and os.path.isfile(self._flat_path(image_id, METADATA_EXT)):
+                # A migration was interrupted - the flat file is the one image_with_id() reads
+                continue
+            image_ids.add(image_id)
+            try:
+                mtime = os.stat(storefilename).st_mtime
+                if (self._file_mtimes.get(storefilename) == mtime) and (image_id in self._metadata_index):
+                    continue
+                self._index_metadata(self._metadata_from_file(storefilename))
+                if time.time() - mtime > MTIME_GRANULARITY:
+                    self._file_mtimes[storefilename] = mtime
+                else:
+                    self._file_mtimes.pop(storefilename, None)
+            except Exception as e:
+                self.log.warn("Could not extract image metadata from file (%s): %s" % (storefilename, e))
+        for image_id in self._directory_ids.get(directory, set()) - image_ids:
+            # Deleted, unless it only moved to the other layout
+            self._file_mtimes.pop(os.path.join(directory, image_id + METADATA_EXT), None)
+            if not self._existing_path(image_id, METADATA_EXT):
+                self.index_lock.acquire()
+                try:
+                    self._unindex_id(image_id)
+                finally:
+                    self.index_lock.release()
+        self._directory_ids[directory] = image_ids
+
+    def storage_directories(self):
+        return storage_directories(self.storage_path)
+
+    def _flat_path(self, image_id, ext):
+        return os.path.join(self.storage_path, str(image_id) + ext)
+
+    def _sharded_path(self, image_id, ext):
+        return os.path.join(shard_directory(self.storage_path, image_id), str(image_id) + ext)
+
+    def _existing_path(self, image_id, ext):
+        # The flat layout is looked at first - migrate_to_sharded() only ever moves files out of it
+        for path in (self._flat_path(image_id, ext), self._sharded_path(image_id, ext)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _path_for(self, image_id, ext):
+        # Where the file is now or, if there is none yet, where the layout puts new files
+        path = self._existing_path(image_id, ext)
+        if path:
+            return path
+        return self._sharded_path(image_id, ext) if self.sharded else self._flat_path(image_id, ext)
+
+    def _apply_record(self, image_id, metadata):
+        if metadata is None:
+            self.index_lock.acquire()
+            try:
+                self._unindex_id(image_id)
+            finally:
+                self.index_lock.release()
+        else:
+            self._index_metadata(metadata)
+
+    def _reset_index(self):
+        self.index_lock.acquire()
+        try:
+            self._metadata_index = { }
+            self._query_index = dict([ (key, defaultdict(set)) for key in INDEXED_KEYS ])
+        finally:
+            self.index_lock.release()
+
+    def _indexed_metadata(self):
+        # Indexed records are replaced, never changed in place, so a shallow copy is a consistent view
+        self.index_lock.acquire()
+        try:
+            return dict(self._metadata_index)
+        finally:
+            self.index_lock.release()
 
+    def _record(self, image_id, metadata):
+        # Caller must hold the metadata lock for the image
+        # Make a change to the metadata of an image - None deletes it
+        if self.journal:
+            self.journal.append(image_id, metadata)
+        else:
+            self._apply_record(image_id, metadata)
+
+    def _index_metadata(self, metadata):
+        # metadata is expected to be a private copy - we hold on to it
+        image_id = metadata['identifier']
+        self.index_lock.acquire()
+        try:
+            self._unindex_id(image_id)
+            self._metadata_index[image_id] = metadata
+            for key in INDEXED_KEYS:
+                try:
+                    self._query_index[key][metadata.get(key)].add(image_id)
+                except TypeError:
+                    # Unhashable value - queries on this key fall back to a scan of the candidates
+                    pass
+        finally:
+            self.index_lock.release()
+
+    def _unindex_id(self, image_id):
+        # Caller must hold index_lock
+        metadata = self._metadata_index.pop(image_id, None)
+        if metadata is None:
+            return
+        for key in INDEXED_KEYS:
+            try:
+                ids = self._query_index[key].get(metadata.get(key))
+            except TypeError:
+                continue
+            if ids is not None:
+                ids.discard(image_id)
+                if len(ids) == 0:
+                    del self._query_index[key][metadata.get(key)]
+
+    def _candidate_ids(self, query):
+        # Caller must hold index_lock
+        # Returns the smallest set of identifiers that can possibly satisfy the query
+        if 'identifier' in query:
+            return set([ query['identifier'] ]) if query['identifier'] in self._metadata_index else set()
+        candidates = None
+        for key in INDEXED_KEYS:
+            if key not in query:
+                continue
+            try:
+                ids = self._query_index[key].get(query[key], set())
+            except TypeError:
+                continue
+            candidates = set(ids) if candidates is None else candidates.intersection(ids)
+            if len(candidates) == 0:
+                break
+        if candidates is None:
+            candidates = set(self._metadata_index.keys())
+        return candidates
 
     def _image_from_metadata(self, metadata):
         # Given the retrieved metadata from mongo, return a PersistentImage type object
@@ -60,24 +330,93 @@ class FilePersistentImageManager(PersistentImageManager):
         # We don't actually want a 'type' property in the resulting PersistentImage object
         del metadata['type']
 
-        for key in image.metadata().union(metadata.keys()):
-            setattr(image, key, metadata.get(key))
-
         #set ourselves as the manager
         image.persistent_manager = self
 
+        self._populate_image(image, metadata)
+
         return image
 
 
     def _metadata_from_file(self, metadatafile):
-        self.metadata_lock.acquire()
+        with open(metadatafile, 'r') as mdf:
+            return json.load(mdf)
+
+    def _metadata_lock_for_id(self, image_id):
+        return self.metadata_locks[hash(image_id) % len(self.metadata_locks)]
+
+    def _write_file(self, path, contents):
+        # The new contents go to a temporary file that is fsync()ed and then renamed over the
+        # old one, so a crash leaves either the previous contents or the new, never a mix
+        self._make_directory(os.path.dirname(path))
+        fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix=TEMP_EXT, dir=os.path.dirname(path))
         try:
-            mdf = open(metadatafile, 'r')
-            metadata = json.load(mdf)
-            mdf.close()
-        finally:
-            self.metadata_lock.release()
-        return metadata
+            try:
+                os.write(fd, contents)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            # mkstemp creates the file 0600 - keep the permissions metadata files have always had
+            os.chmod(temp_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _make_directory(self, path):
+        # Other threads may be creating the same shard directory
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    def _blob_path(self, image_id, key):
+        # Blobs are written next to the metadata of their image
+        metadata_path = self._path_for(image_id, METADATA_EXT)
+        return os.path.join(os.path.dirname(metadata_path), str(image_id) + '.' + key)
+
+    def _read_existing(self, image_id, ext, reader):
+        # Call reader with the file of an image in whichever layout it is in, trying the flat layout
+        # first so that a file moved by migrate_to_sharded() in the meantime is still found
+        error = None
+        for path in (self._flat_path(image_id, ext), self._sharded_path(image_id, ext)):
+            try:
+                with open(path, 'r') as image_file:
+                    return reader(image_file)
+            except IOError as e:
+                error = e
+        raise error
+
+    def _write_metadata(self, image):
+        # Caller must hold the metadata lock for the image
+        image_id = str(image.identifier)
+        image.modified = time.time()
+        meta = self._metadata_for_image(image)
+        serialized_meta = json.dumps(meta)
+
+        # Blobs go first so that metadata on disk never refers to a blob that is not there yet
+        # Only those set since the last save are written - a status update leaves them alone
+        blobs = image.dirty_blobs()
+        for key, value in blobs.items():
+            if value is None:
+                blob_path = self._existing_path(image_id, '.' + key)
+                if blob_path:
+                    os.remove(blob_path)
+            else:
+                self._write_file(self._blob_path(image_id, key), json.dumps(value))
+        # The journal record is what counts - the .meta file follows it
+        # Index exactly what a later read of the file would return
+        self._record(image_id, json.loads(serialized_meta))
+        self._write_file(self._path_for(image_id, METADATA_EXT), serialized_meta)
+        image.blobs_saved(blobs)
+        self.log.debug("Saved metadata for image (%s): %s" % (image_id, meta))
+
+    def load_blob(self, image_id, key):
+        try:
+            return self._read_existing(image_id, '.' + key, json.load)
+        except IOError:
+            return None
 
 
     def image_with_id(self, image_id):
@@ -88,35 +427,98 @@ class FilePersistentImageManager(PersistentImageManager):
 
         @return TODO
         """
-        metadatafile = self.storage_path + '/' + image_id + METADATA_EXT
+        if self.journal:
+            # Another process may have changed the image - its record is in the journal
+            self._refresh_index()
+            self.index_lock.acquire()
+            try:
+                metadata = deepcopy(self._metadata_index.get(image_id))
+            finally:
+                self.index_lock.release()
+            return self._image_from_metadata(metadata) if metadata else None
+
         try:
-            metadata = self._metadata_from_file(metadatafile)
+            metadata = self._read_existing(image_id, METADATA_EXT, json.load)
         except Exception as e:
             self.log.debug('Exception caught: %s' % e)
             return None
 
+        # The file is authoritative - another process may have updated it
+        self._index_metadata(deepcopy(metadata))
         return self._image_from_metadata(metadata)
 
+    def _is_managed(self, image_id):
+        if self.journal:
+            self._refresh_index()
+            return image_id in self._metadata_index
+        return self._existing_path(image_id, METADATA_EXT) is not None
+
+
+    def _matching_ids(self, query):
+        # Caller must hold index_lock
+        matches = [ ]
+        for image_id in self._candidate_ids(query):
+            metadata = self._metadata_index[image_id]
+            match = True
+            for querykey in query:
+                if (querykey not in metadata) or (metadata[querykey] != query[querykey]):
+                    match = False
+                    break
+            if match:
+                matches.append(image_id)
+        return matches
 
     def images_from_query(self, query):
-        images = [ ]
-        for storefileshortname in os.listdir(self.storage_path):
-            storefilename = self.storage_path + '/' + storefileshortname
-            if re.search(METADATA_EXT, storefilename):
-                try:
-                    metadata = self._metadata_from_file(storefilename)
-                    match = True
-                    for querykey in query:
-                        if metadata[querykey] != query[querykey]:
-                            match = False
-                            break
-                    if match:
-                        images.append(self._image_from_metadata(metadata))
-                except:
-                    self.log.warn("Could not extract image metadata from file (%s)" % (storefilename))
+        self._refresh_index()
+        self.index_lock.acquire()
+        try:
+            # Never hand out the indexed dict itself - images mutate their attributes in place
+            matches = [ deepcopy(self._metadata_index[image_id]) for image_id in self._matching_ids(query) ]
+        finally:
+            self.index_lock.release()
+
+        return [ self._image_from_metadata(metadata) for metadata in matches ]
+
+    def image_ids_from_query(self, query):
+        self._refresh_index()
+        self.index_lock.acquire()
+        try:
+            return self._matching_ids(query)
+        finally:
+            self.index_lock.release()
+
+    def metadata_from_query(self, query, ranges=None, after=None, fields=None):
+        self._refresh_index()
+        self.index_lock.acquire()
+        try:
+            image_ids = sorted(self._matching_ids(query))
+        finally:
+            self.index_lock.release()
+
+        for image_id in image_ids[bisect.bisect_right(image_ids, after) if after else 0:]:
+            # Indexed records are replaced on save, never changed in place, so this one stays
+            # as it is while we look at it - though the image may have gone in the meantime
+            self.index_lock.acquire()
+            try:
+                metadata = self._metadata_index.get(image_id)
+            finally:
+                self.index_lock.release()
+            if metadata and self._in_ranges(metadata, ranges):
+                yield deepcopy(self._project(metadata, fields))
 
-        return images              
 
+    def child_image_ids(self, image_id):
+        if not image_id:
+            return [ ]
+        self._refresh_index()
+        self.index_lock.acquire()
+        try:
+            children = set()
+            for key in ('base_image_id', 'target_image_id'):
+                children.update(self._query_index[key].get(image_id, ()))
+            return list(children)
+        finally:
+            self.index_lock.release()
 
     def add_image(self, image):
         """
@@ -127,21 +529,26 @@ class FilePersistentImageManager(PersistentImageManager):
         @return TODO
         """
         image.persistent_manager = self
-        basename = self.storage_path + '/' + str(image.identifier)
-        metadata_path = basename + METADATA_EXT
-        body_path = basename + BODY_EXT
+        body_path = self._path_for(image.identifier, BODY_EXT)
         image.data = body_path
         try:
-            if not os.path.isfile(metadata_path):
-                open(metadata_path, 'w').close()
-                self.log.debug('Created file %s' % metadata_path)
+            self._make_directory(os.path.dirname(body_path))
             if not os.path.isfile(body_path):
                 open(body_path, 'w').close()
                 self.log.debug('Created file %s' % body_path)
         except IOError as e:
             self.log.debug('Exception caught: %s' % e)
 
-        self.save_image(image)
+        # The metadata file is created by its first write rather than left empty in the meantime
+        lock = self._metadata_lock_for_id(str(image.identifier))
+        lock.acquire()
+        try:
+            self._write_metadata(image)
+        except Exception as e:
+            self.log.debug('Exception caught: %s' % e)
+            raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        finally:
+            lock.release()
 
     def save_image(self, image):
         """
@@ -152,26 +559,19 @@ class FilePersistentImageManager(PersistentImageManager):
         @return TODO
         """
         image_id = str(image.identifier)
-        metadata_path = self.storage_path + '/' + image_id + METADATA_EXT
-        if not os.path.isfile(metadata_path):
-            raise ImageFactoryException('Image %s not managed, use "add_image()" first.' % image_id)
-        try:
-            meta = {'type': type(image).__name__}
-            for mdprop in image.metadata():
-                meta[mdprop] = getattr(image, mdprop, None)
- 
-            self.metadata_lock.acquire()
-            try:
-                mdf = open(metadata_path, 'w')
-                json.dump(meta, mdf)
-                mdf.close()
-            finally:
-                self.metadata_lock.release()
-
-            self.log.debug("Saved metadata for image (%s): %s" % (image_id, meta))
+        lock = self._metadata_lock_for_id(image_id)
+        lock.acquire()
+        try:
+            if not self._is_managed(image_id):
+                raise ImageFactoryException('Image %s not managed, use "add_image()" first.' % image_id)
+            self._write_metadata(image)
+        except ImageFactoryException:
+            raise
         except Exception as e:
             self.log.debug('Exception caught: %s' % e)
             raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        finally:
+            lock.release()
 
     def delete_image_with_id(self, image_id):
         """
@@ -181,11 +581,112 @@ class FilePersistentImageManager(PersistentImageManager):
 
         @return TODO
         """
-        basename = self.storage_path + '/' + image_id
-        metadata_path = basename + METADATA_EXT
-        body_path = basename + BODY_EXT
+        lock = self._metadata_lock_for_id(image_id)
+        lock.acquire()
         try:
-            os.remove(metadata_path)
-            os.remove(body_path)
-        except Exception as e:
-            self.log.warn('Unable to delete file: %s' % e)
+            self.index_lock.acquire()
+            try:
+                # The body is wherever the image says it is
+                body_path = self._metadata_index.get(image_id, { }).get('data')
+            finally:
+                self.index_lock.release()
+            self._record(image_id, None)
+            body_path = body_path or self._path_for(image_id, BODY_EXT)
+            paths = [ self._existing_path(image_id, METADATA_EXT), body_path ]
+            # Compressed copy made for downloads and its marker, if any
+            paths += [ body_path + ext for ext in BODY_COMPANION_EXTS ]
+            paths += [ self._existing_path(image_id, '.' + key) for key in BLOB_METADATA ]
+            # Each file on its own - one that is missing or stuck must not leave the rest behind
+            for path in paths:
+                if not (path and os.path.exists(path)):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    self.log.warn('Unable to delete file: %s' % e)
+        finally:
+            lock.release()
+
+    def migrate_to_sharded(self):
+        """
+        Move the files of images kept in the flat layout of earlier releases into the sharded
+        layout.  This can be run while the store is in use - lookups find an image in either
+        layout throughout.  Metadata and blobs always move.  A body only moves with them when
+        its image is in a final state and no other image is built on it, since a running build
+        or the backing file of an overlay may refer to it by its path.  Running this again moves
+        what was left behind.
+
+        @return A dict with the number of images moved and the number whose bodies were left in place
+        """
+        moved = 0
+        bodies_left = 0
+        for filename in os.listdir(self.storage_path):
+            if not filename.endswith(METADATA_EXT):
+                continue
+            image_id = filename[:-len(METADATA_EXT)]
+            lock = self._metadata_lock_for_id(image_id)
+            lock.acquire()
+            try:
+                body_moved = self._migrate_image(image_id)
+            except Exception as e:
+                self.log.warn("Unable to migrate image (%s) to the sharded layout: %s" % (image_id, e))
+                continue
+            finally:
+                lock.release()
+            if body_moved is None:
+                continue
+            moved += 1
+            if not body_moved:
+                bodies_left += 1
+        self.log.info("Moved %d images to the sharded layout in (%s), leaving %d bodies in place" % (moved, self.storage_path, bodies_left))
+        return dict(moved=moved, bodies_left=bodies_left)
+
+    def _migrate_image(self, image_id):
+        # Caller must hold the metadata lock for the image
+        # Returns whether the body moved or None if the image was not in the flat layout
+        flat_metadata_path = self._flat_path(image_id, METADATA_EXT)
+        try:
+            metadata = self._metadata_from_file(flat_metadata_path)
+        except IOError:
+            return None
+        if self.journal:
+            # The file is only a copy and may be behind the journal after a crash
+            self.index_lock.acquire()
+            try:
+                metadata = deepcopy(self._metadata_index.get(image_id, metadata))
+            finally:
+                self.index_lock.release()
+        self._make_directory(shard_directory(self.storage_path, image_id))
+        # Blobs first - load_blob() finds them in either place until the metadata follows
+        for key in BLOB_METADATA:
+            if os.path.isfile(self._flat_path(image_id, '.' + key)):
+                os.rename(self._flat_path(image_id, '.' + key), self._sharded_path(image_id, '.' + key))
+
+        flat_body_path = self._flat_path(image_id, BODY_EXT)
+        sharded_body_path = self._sharded_path(image_id, BODY_EXT)
+        # An interrupted run may have moved the body without recording it or, in earlier
+        # releases, recorded the move and died before the body followed
+        unfinished = (((metadata.get('data') == flat_body_path) and os.path.isfile(sharded_body_path) and
+                       not os.path.isfile(flat_body_path)) or
+                      ((metadata.get('data') == sharded_body_path) and os.path.isfile(flat_body_path)))
+        move_body = unfinished or ((metadata.get('data') == flat_body_path) and (metadata.get('status') in TERMINAL_STATUSES) and
+                     not self.image_ids_from_query({'backing_image_id': image_id}) and
+                     not [ child_id for child_id in self.child_image_ids(image_id)
+                           if self._metadata_index.get(child_id, { }).get('status') not in TERMINAL_STATUSES ])
+        if move_body:
+            # The body moves before the metadata records it and the flat metadata goes last, so an
+            # interruption leaves the flat metadata in place and the next run moves what is left
+            # and records it - the journal never names a body that is not there
+            if os.path.isfile(flat_body_path):
+                os.rename(flat_body_path, sharded_body_path)
+            for ext in BODY_COMPANION_EXTS:
+                if os.path.isfile(flat_body_path + ext):
+                    os.rename(flat_body_path + ext, sharded_body_path + ext)
+            metadata['data'] = sharded_body_path
+            self._record(image_id, metadata)
+            self._write_file(self._sharded_path(image_id, METADATA_EXT), json.dumps(metadata))
+            os.remove(flat_metadata_path)
+        else:
+            os.rename(flat_metadata_path, self._sharded_path(image_id, METADATA_EXT))
+        self.log.debug("Moved image (%s) to (%s)" % (image_id, shard_directory(self.storage_path, image_id)))
+        return move_body
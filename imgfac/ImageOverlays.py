@@ -0,0 +1,120 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# TargetImage bodies can be qcow2 overlays backed by the raw body of their BaseImage, so that
+# starting a TargetImage costs a few KB of metadata rather than a copy of the whole BaseImage.
+# The BaseImage body must then never change or go away - an image's backing_image_id names
+# the image its body depends on, and images are only deleted when nothing depends on them.
+# Plugins that need a standalone file call flatten() first.
+
+import logging
+import os
+import json
+from ReservationManager import ReservationManager
+from ImageFactoryException import ImageFactoryException
+
+log = logging.getLogger(__name__)
+
+QCOW2_MAGIC = 'QFI\xfb'
+
+class ImageInUseException(ImageFactoryException):
+    """ Raised when asked to delete an image that the bodies of other images depend on """
+    pass
+
+class ImageNotCompleteException(ImageFactoryException):
+    """ Raised when asked to flatten an image that may still be written to """
+    pass
+
+def _qemu_img(args):
+    # FactoryUtils pulls in guestfs - only import it when qemu-img is run
+    from FactoryUtils import subprocess_check_output
+    return subprocess_check_output([ 'qemu-img' ] + args)[0]
+
+def is_overlay(path):
+    """
+    @return True if the file at path is a qcow2 image
+    """
+    try:
+        with open(path, 'rb') as body:
+            return body.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC
+    except IOError:
+        return False
+
+def create_overlay(backing_image, image):
+    """
+    Replace the body of image with an empty qcow2 overlay on the body of backing_image.
+
+    @param backing_image The image whose raw body the overlay reads through to
+    @param image The image to give the overlay body
+    """
+    log.debug("Creating overlay (%s) backed by (%s)" % (image.data, backing_image.data))
+    _qemu_img([ 'create', '-f', 'qcow2', '-o', 'backing_file=%s,backing_fmt=raw' % (backing_image.data), image.data ])
+    image.backing_image_id = backing_image.identifier
+
+def flatten(image, require_complete=False):
+    """
+    Make the body of image a standalone raw file if it is an overlay and save the image.
+    Builders that share the image may call this at the same time - only one converts it.
+    Space for the raw file is reserved with the ReservationManager while it is written.
+
+    @param image The image
+    @param require_complete If True, refuse to convert an image that is not COMPLETE, since
+    its builder may still be writing the overlay
+
+    @return True if the body was converted
+    """
+    if not getattr(image, 'backing_image_id', None):
+        return False
+    if require_complete and (image.status != 'COMPLETE'):
+        raise ImageNotCompleteException("Image (%s) is %s - it can only be flattened once COMPLETE" % (image.identifier, image.status))
+    res_mgr = ReservationManager()
+    lock_name = 'flatten-%s' % (image.identifier)
+    res_mgr.get_named_lock(lock_name)
+    try:
+        # Another builder's copy of this image may have been flattened already
+        if not is_overlay(image.data):
+            image.backing_image_id = None
+            return False
+        log.debug("Flattening overlay (%s)" % (image.data))
+        temp_path = image.data + '.flatten'
+        size = json.loads(_qemu_img([ 'info', '--output=json', image.data ]))['virtual-size']
+        if not res_mgr.reserve_space_for_file(size, temp_path):
+            raise ImageFactoryException("Not enough free space to flatten image (%s) of %d bytes" % (image.identifier, size))
+        try:
+            _qemu_img([ 'convert', '-O', 'raw', image.data, temp_path ])
+            os.rename(temp_path, image.data)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            res_mgr.cancel_reservation_for_file(temp_path)
+        image.backing_image_id = None
+        image.persistent_manager.save_image(image)
+        return True
+    finally:
+        res_mgr.release_named_lock(lock_name)
+
+def dependent_image_ids(pim, image_id):
+    """
+    The images whose bodies are overlays on the body of an image - its reference count.
+
+    @param pim The PersistentImageManager holding the images
+    @param image_id The identifier of the backing image
+
+    @return A list of image identifiers
+    """
+    return pim.image_ids_from_query({'type': 'TargetImage', 'backing_image_id': image_id})
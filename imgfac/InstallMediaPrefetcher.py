@@ -0,0 +1,254 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import ctypes
+import json
+import platform
+import threading
+import time
+from Singleton import Singleton
+from ApplicationConfiguration import ApplicationConfiguration
+
+DEFAULT_INTERVAL = 3600
+DEFAULT_RECENT = 10
+STORAGE_PATH = '/var/lib/imagefactory/storage'
+HISTORY_NAME = 'install_media_history.json'
+# ioprio_set() has no wrapper in libc - its system call number on each architecture
+IOPRIO_SET = { 'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+               'ppc64': 273, 'ppc64le': 273, 's390x': 282 }
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def lower_io_priority():
+    """
+    Move the calling thread, and the processes it starts from then on, to the idle I/O
+    scheduling class, so that it only gets the disk when nothing else wants it.
+
+    @return True if the priority was changed
+    """
+    number = IOPRIO_SET.get(platform.machine())
+    if not number:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # A process id of 0 is the calling thread
+        return libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+class InstallMediaPrefetcher(Singleton):
+    """
+    Prepares install media in the background so that builds find it cached.
+
+    OS plugins that cache install media record() every build that needed it and whether it
+    was cached and current.  Every install_media_prefetch_interval seconds a thread at idle I/O
+    priority has the plugins prepare the media for the templates listed in
+    install_media_prefetch and for the install_media_prefetch_recent templates built most
+    recently.  Plugins leave media that is cached and current alone, so a pass only downloads
+    what is missing or stale.  The recent templates, their use counts and the counts over all
+    install media ever used are kept in the image storage directory so that a restart does not
+    forget them.  An install_media_prefetch_interval
+    of 0 turns prefetching off - uses are still counted.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        appconfig = ApplicationConfiguration().configuration
+        self.interval = float(appconfig.get('install_media_prefetch_interval', DEFAULT_INTERVAL))
+        self.recent = int(appconfig.get('install_media_prefetch_recent', DEFAULT_RECENT))
+        self.templates = list(appconfig.get('install_media_prefetch', [ ]))
+        storage_path = appconfig.get('image_manager_args', { }).get('storage_path', STORAGE_PATH)
+        self.history_path = os.path.join(storage_path, HISTORY_NAME)
+        self._lock = threading.Lock()
+        self._worker = None
+        history = self._load_history()
+        self.entries = history['media']
+        # Never pruned with the entries, so the overall hit rate covers every build
+        self.hits = history['hits']
+        self.misses = history['misses']
+        self.passes = 0
+        self.failures = 0
+
+    def start(self):
+        """
+        Start the thread that prefetches every install_media_prefetch_interval seconds.
+        """
+        if (self.interval <= 0) or self._worker:
+            return
+        self._worker = threading.Thread(target=self._work, name='install-media-prefetch')
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def _load_history(self):
+        try:
+            with open(self.history_path) as history_file:
+                history = json.load(history_file)
+        except (IOError, ValueError):
+            history = { }
+        if 'media' not in history:
+            # Earlier releases kept only the entries
+            history = {'media': history}
+        entries = history['media']
+        history.setdefault('hits', sum([ entry['hits'] for entry in entries.values() ]))
+        history.setdefault('misses', sum([ entry['misses'] for entry in entries.values() ]))
+        return history
+
+    def _save_history(self):
+        # Caller must hold _lock
+        try:
+            with open(self.history_path + '.tmp', 'w') as history:
+                json.dump({'media': self.entries, 'hits': self.hits, 'misses': self.misses}, history)
+            os.rename(self.history_path + '.tmp', self.history_path)
+        except (IOError, OSError) as e:
+            self.log.warn("Unable to save install media history (%s): %s" % (self.history_path, e))
+
+    def record(self, key, template, hit, files, prefetch=False):
+        """
+        Called by OS plugins each time install media is needed.
+
+        @param key Names the install media, for example Fedora-17-x86_64-iso
+        @param template The XML of a template that uses the install media
+        @param hit True if the install media was cached and current, False if it was generated
+        @param files The paths of the cached install media
+        @param prefetch True if the install media was needed by a prefetch rather than a build
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if not entry:
+                entry = self.entries[key] = {'hits': 0, 'misses': 0, 'prefetched': 0,
+                                             'last_used': None, 'last_prefetched': None}
+            entry['template'] = template
+            entry['files'] = list(files)
+            if prefetch:
+                entry['last_prefetched'] = now
+                if not hit:
+                    entry['prefetched'] += 1
+            else:
+                entry['last_used'] = now
+                entry['hits' if hit else 'misses'] += 1
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            self._save_history()
+        finally:
+            self._lock.release()
+
+    def _cached_size(self, files):
+        # Returns the bytes of install media cached, or None if none of it is
+        size = None
+        for path in files:
+            try:
+                size = (size or 0) + os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def report(self):
+        """
+        @return A dict of the number of builds that found install media cached and current and
+        that had to generate it, the hit rate and the number of prefetch passes and failures, with
+        the same counts, the bytes cached, the number of prefetches that generated media and the
+        times of the last use and prefetch of each install media still remembered.  The overall
+        counts include install media that has since been forgotten.
+        """
+        self._lock.acquire()
+        try:
+            entries = dict([ (key, dict(entry)) for key, entry in self.entries.items() ])
+            hits = self.hits
+            misses = self.misses
+        finally:
+            self._lock.release()
+        for entry in entries.values():
+            del entry['template']
+            entry['size'] = self._cached_size(entry.pop('files'))
+            uses = entry['hits'] + entry['misses']
+            entry['hit_rate'] = (float(entry['hits']) / uses) if uses else None
+        return {'hits': hits, 'misses': misses, 'hit_rate': (float(hits) / (hits + misses)) if (hits + misses) else None,
+                'passes': self.passes, 'failures': self.failures, 'media': entries}
+
+    def _load_template(self, source):
+        # Template pulls in libxml2 - only import it when prefetching
+        from Template import Template
+        return Template(source)
+
+    def _plugin_for(self, template):
+        from PluginManager import PluginManager
+        return PluginManager().plugin_for_target((template.os_name, template.os_version, template.os_arch))
+
+    def prefetch(self):
+        """
+        Make one pass over the configured and recently built templates.
+
+        @return The number of templates whose install media could not be prepared
+        """
+        started = time.time()
+        self._lock.acquire()
+        try:
+            recent = sorted([ (entry['last_used'], entry['template']) for entry in self.entries.values()
+                              if entry['last_used'] ], reverse=True)[0:self.recent]
+        finally:
+            self._lock.release()
+        configured = set()
+        prepared = set()
+        failures = 0
+        for source in self.templates + [ template for last_used, template in recent ]:
+            try:
+                template = self._load_template(source)
+                if source in self.templates:
+                    configured.add(template.xml)
+                if template.xml in prepared:
+                    continue
+                prepared.add(template.xml)
+                prefetch = getattr(self._plugin_for(template), 'prefetch_install_media', None)
+                if prefetch:
+                    prefetch(template)
+            except Exception as e:
+                failures += 1
+                self.log.warn("Unable to prefetch install media for template (%s): %s" % (source[0:200], e))
+
+        # Forget templates that are neither configured nor among the most recently built - those
+        # built while the pass ran are among the most recent now, whatever the list above says
+        keep = configured | set([ template for last_used, template in recent ])
+        self._lock.acquire()
+        try:
+            for key, entry in self.entries.items():
+                if (entry['template'] not in keep) and ((entry['last_used'] or 0) < started):
+                    del self.entries[key]
+            self._save_history()
+        finally:
+            self._lock.release()
+        self.passes += 1
+        self.failures += failures
+        return failures
+
+    def _work(self):
+        if not lower_io_priority():
+            self.log.info("Unable to lower the I/O priority of install media prefetching")
+        while True:
+            try:
+                self.prefetch()
+            except Exception as e:
+                self.log.warning("Install media prefetch pass failed: %s" % (e))
+            time.sleep(self.interval)
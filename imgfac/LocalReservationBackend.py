@@ -0,0 +1,91 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+from threading import BoundedSemaphore
+from ApplicationConfiguration import ApplicationConfiguration
+from ReservationBackend import ReservationBackend
+from FairQueue import FairQueue
+from NamedLockTable import NamedLockTable
+
+
+class LocalReservationBackend(ReservationBackend):
+    """
+    Keeps queue slots, named locks and the listen port counter in the memory of this process.
+    Each queue is a FairQueue weighted by client_weights.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        appconfig = ApplicationConfiguration().configuration
+        self.weights = appconfig.get('client_weights', { })
+        queue_sizes = dict(local=appconfig.get('max_concurrent_local_sessions', 1),
+                           ec2=appconfig.get('max_concurrent_ec2_sessions', 1))
+        queue_sizes.update(appconfig.get('resource_classes', { }))
+        self._queues = dict([ (name, FairQueue(name, int(size), self.weights)) for name, size in queue_sizes.items() ])
+        self._queues_lock = BoundedSemaphore()
+        self._named_locks = NamedLockTable()
+        self._listen_port = None
+        self._listen_port_lock = BoundedSemaphore()
+
+    def queues(self):
+        return self._queues.keys()
+
+    def queue_size(self, name):
+        return self._queues[name].size
+
+    def add_queue(self, name, size):
+        self._queues_lock.acquire()
+        try:
+            if name in self._queues:
+                return False
+            self._queues[name] = FairQueue(name, int(size), self.weights)
+            return True
+        finally:
+            self._queues_lock.release()
+
+    def enter_queue(self, name, client=None, count=1):
+        self._queues[name].enter(client, count)
+
+    def exit_queue(self, name, count=1):
+        self._queues[name].exit(count)
+
+    def queue_stats(self):
+        return dict([ (name, queue.report()) for name, queue in self._queues.items() ])
+
+    def acquire_lock(self, name, blocking=True, timeout=None, shared=False):
+        return self._named_locks.acquire(name, blocking, timeout, shared)
+
+    def release_lock(self, name):
+        self._named_locks.release(name)
+
+    def lock_stats(self):
+        return self._named_locks.stats()
+
+    def lock_count(self):
+        return len(self._named_locks)
+
+    def next_listen_port(self, min_port, max_port):
+        self._listen_port_lock.acquire()
+        try:
+            if self._listen_port is None:
+                self._listen_port = min_port
+            self._listen_port += 1
+            if self._listen_port > max_port:
+                self._listen_port = min_port
+            return self._listen_port
+        finally:
+            self._listen_port_lock.release()
@@ -0,0 +1,241 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import json
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+SNAPSHOT_PREFIX = 'metadata.snapshot.'
+JOURNAL_PREFIX = 'metadata.journal.'
+LOCK_NAME = 'metadata.lock'
+TEMP_EXT = '.tmp'
+DEFAULT_SNAPSHOT_INTERVAL = 10000
+
+
+class MetadataJournal(object):
+    """
+    Append-only record of the metadata of every image in a directory.
+
+    Each change is a line holding an image identifier and its new metadata, or null for a
+    deleted image, appended and fsync()ed before the change is made anywhere else.  Every
+    snapshot_interval records the current state is written out as a snapshot and a new journal
+    begun, so starting up takes one snapshot read and a replay of the records written since.
+    Snapshots and journals are numbered by generation - journal N holds the changes made after
+    snapshot N.  The previous generation is kept until the next snapshot, which lets a process
+    that missed a snapshot catch up and gives a fallback should the newest snapshot be damaged.
+
+    Several processes may share a journal.  All reads and writes happen under an exclusive
+    flock(), and each process applies the records written by others before its own, so each
+    has the same view.  A line cut short by a crash is dropped by the next process to read it.
+
+    The owner of the journal keeps the state itself - apply(image_id, metadata) is called for
+    every record, with metadata None for a deletion, reset() before a snapshot is applied and
+    state() must return a dict of the current metadata of every image for a new snapshot.
+    """
+
+    def __init__(self, directory, apply, reset, state, snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.directory = directory
+        self.apply = apply
+        self.reset = reset
+        self.state = state
+        self.snapshot_interval = snapshot_interval
+        # The journal being read and written and how far into it we have applied
+        self.generation = 0
+        self.offset = 0
+        # Records in the journal - a snapshot is due when this reaches snapshot_interval
+        self.records = 0
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(directory, LOCK_NAME), 'a')
+
+    @contextmanager
+    def _locked(self):
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def _snapshot_path(self, generation):
+        return os.path.join(self.directory, SNAPSHOT_PREFIX + str(generation))
+
+    def _journal_path(self, generation):
+        return os.path.join(self.directory, JOURNAL_PREFIX + str(generation))
+
+    def _generations(self, prefix):
+        generations = [ ]
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename[len(prefix):].isdigit():
+                generations.append(int(filename[len(prefix):]))
+        return sorted(generations)
+
+    def load(self):
+        """
+        Replace the state with the newest readable snapshot and the records written since.
+
+        @return False if there is no snapshot to start from
+        """
+        with self._locked():
+            return self._load()
+
+    def _load(self):
+        # Caller must hold the locks
+        for filename in os.listdir(self.directory):
+            if filename.startswith(SNAPSHOT_PREFIX) and filename.endswith(TEMP_EXT):
+                os.remove(os.path.join(self.directory, filename))
+        for generation in reversed(self._generations(SNAPSHOT_PREFIX)):
+            try:
+                with open(self._snapshot_path(generation), 'r') as snapshot:
+                    images = json.load(snapshot)
+            except (IOError, ValueError) as e:
+                self.log.error("Unable to read metadata snapshot (%s) - trying an older one: %s" % (self._snapshot_path(generation), e))
+                continue
+            self.reset()
+            for image_id, metadata in images.items():
+                self.apply(image_id, metadata)
+            self.generation = generation
+            self.offset = 0
+            self.records = 0
+            self._catch_up(reload=False)
+            self.log.debug("Loaded metadata for %d images from snapshot %d and %d journal records" % (len(images), generation, self.records))
+            return True
+        return False
+
+    def _catch_up(self, reload=True):
+        # Caller must hold the locks
+        # Apply the records written since we last looked, by this process or any other
+        while True:
+            journal_path = self._journal_path(self.generation)
+            try:
+                journal = open(journal_path, 'r+b')
+            except IOError:
+                journal = None
+            if journal:
+                try:
+                    journal.seek(self.offset)
+                    data = journal.read()
+                    used = self._apply_records(data)
+                    if used < len(data):
+                        # Nothing appends without the lock, so this was cut short by a crash
+                        self.log.warn("Dropping %d bytes of incomplete record from (%s)" % (len(data) - used, journal_path))
+                        journal.truncate(self.offset + used)
+                    self.offset += used
+                finally:
+                    journal.close()
+            elif [ generation for generation in self._generations(SNAPSHOT_PREFIX) if generation > self.generation ]:
+                # We missed more than one snapshot and our journal has been removed
+                if reload:
+                    self._load()
+                else:
+                    self.log.error("Metadata journal %d is missing - changes made after snapshot %d are lost" % (self.generation, self.generation))
+                return
+            if os.path.exists(self._snapshot_path(self.generation + 1)):
+                # Another process made a snapshot - the journal we just finished is the one it covers
+                self.generation += 1
+                self.offset = 0
+                self.records = 0
+                continue
+            return
+
+    def _apply_records(self, data):
+        # Returns the number of bytes of complete records in data
+        used = 0
+        while True:
+            end = data.find('\n', used)
+            if end < 0:
+                return used
+            try:
+                image_id, metadata = json.loads(data[used:end])
+            except ValueError as e:
+                self.log.error("Skipping unreadable metadata journal record: %s" % (e))
+            else:
+                self.apply(image_id, metadata)
+                self.records += 1
+            used = end + 1
+
+    def refresh(self):
+        """
+        Apply any records written by other processes.
+        """
+        with self._locked():
+            self._catch_up()
+
+    def append(self, image_id, metadata):
+        """
+        Durably record new metadata for an image and apply it.
+
+        @param image_id The identifier of the image
+        @param metadata The new metadata dict or None if the image has been deleted
+        """
+        line = json.dumps([ image_id, metadata ]) + '\n'
+        with self._locked():
+            self._catch_up()
+            fd = os.open(self._journal_path(self.generation), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                written = 0
+                while written < len(line):
+                    written += os.write(fd, line[written:])
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.offset += len(line)
+            self.records += 1
+            self.apply(image_id, metadata)
+            if self.records >= self.snapshot_interval:
+                self._snapshot()
+
+    def snapshot(self):
+        """
+        Write the current state as a new snapshot and start a new journal.
+        """
+        with self._locked():
+            self._catch_up()
+            self._snapshot()
+
+    def _snapshot(self):
+        # Caller must hold the locks and have caught up
+        generation = max([ self.generation ] + self._generations(SNAPSHOT_PREFIX) + self._generations(JOURNAL_PREFIX)) + 1
+        snapshot_path = self._snapshot_path(generation)
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(snapshot_path), suffix=TEMP_EXT, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as snapshot:
+                json.dump(self.state(), snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, snapshot_path)
+        except:
+            os.remove(temp_path)
+            raise
+        open(self._journal_path(generation), 'ab').close()
+        # Keep the generation before this one for processes that have yet to catch up
+        for prefix in (SNAPSHOT_PREFIX, JOURNAL_PREFIX):
+            for old_generation in self._generations(prefix):
+                if old_generation < self.generation:
+                    os.remove(os.path.join(self.directory, prefix + str(old_generation)))
+        self.log.debug("Wrote metadata snapshot %d after %d journal records" % (generation, self.records))
+        self.generation = generation
+        self.offset = 0
+        self.records = 0
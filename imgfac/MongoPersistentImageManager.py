@@ -18,7 +18,9 @@ import logging
 import os
 import os.path
 import json
+import time
 import pymongo
+from pymongo.errors import DuplicateKeyError
 from copy import copy
 from props import prop
 from ImageFactoryException import ImageFactoryException
@@ -29,6 +31,11 @@ METADATA_EXT = '.meta'
 BODY_EXT = '.body'
 DB_NAME = "factory_db"
 COLLECTION_NAME = "factory_collection"
+BLOB_COLLECTION_NAME = "factory_blobs"
+# Keys that images are looked up by - each gets an index
+INDEXED_KEYS = ('type', 'status', 'base_image_id', 'target_image_id', 'provider', 'target', 'created', 'modified',
+                'backing_image_id')
+DEFAULT_MAX_POOL_SIZE = 50
 
 
 class MongoPersistentImageManager(PersistentImageManager):
@@ -36,7 +43,7 @@ class MongoPersistentImageManager(PersistentImageManager):
 
     storage_path = prop("_storage_path")
 
-    def __init__(self, storage_path=STORAGE_PATH):
+    def __init__(self, storage_path=STORAGE_PATH, host=None, port=None, max_pool_size=DEFAULT_MAX_POOL_SIZE):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         if not os.path.exists(storage_path):
             self.log.debug("Creating directory (%s) for persistent storage" % (storage_path))
@@ -47,9 +54,17 @@ class MongoPersistentImageManager(PersistentImageManager):
             # TODO: verify that we can write to this location
             pass
         self.storage_path = storage_path
-        self.con = pymongo.Connection()
+        # Every builder thread saves status through this connection - size the pool for it
+        self.con = pymongo.Connection(host, port, max_pool_size=max_pool_size)
         self.db = self.con[DB_NAME]
         self.collection = self.db[COLLECTION_NAME]
+        for key in INDEXED_KEYS:
+            # Does nothing if the index already exists
+            self.collection.ensure_index(key, background=True)
+        # Template and icicle documents, kept out of the image documents so that status updates
+        # and queries never have to carry them
+        self.blobs = self.db[BLOB_COLLECTION_NAME]
+        self.blobs.ensure_index('image_id', background=True)
 
     def _to_mongo_meta(self, meta):
         # Take our view of the metadata and make the mongo view
@@ -78,9 +93,6 @@ class MongoPersistentImageManager(PersistentImageManager):
         # We don't actually want a 'type' property in the resulting PersistentImage object
         del metadata['type']
 
-        for key in image.metadata().union(metadata.keys()):
-            setattr(image, key, metadata.get(key))
-
         #I don't think we want this as it will overwrite the "data" element
         #read from the store.
         #self.add_image(image)
@@ -88,8 +100,22 @@ class MongoPersistentImageManager(PersistentImageManager):
         #just set ourselves as the manager
         image.persistent_manager = self
 
+        self._populate_image(image, metadata)
+
         return image
 
+    def _save_blobs(self, image_id, blobs):
+        for key, value in blobs.items():
+            blob_id = "%s/%s" % (image_id, key)
+            if value is None:
+                self.blobs.remove(blob_id, safe=True)
+            else:
+                self.blobs.save({ '_id': blob_id, 'image_id': image_id, 'value': value }, safe=True)
+
+    def load_blob(self, image_id, key):
+        blob = self.blobs.find_one({ '_id': "%s/%s" % (image_id, key) })
+        return blob['value'] if blob else None
+
 
     def image_with_id(self, image_id):
         """
@@ -120,6 +146,32 @@ class MongoPersistentImageManager(PersistentImageManager):
                 self.log.warn("Found mongo record with no 'type' key - id (%s)" % (image_meta['_id']))
         return images 
 
+    def image_ids_from_query(self, query):
+        # Only fetch the _id of each matching document
+        return [ image_meta['_id'] for image_meta in self.collection.find(query, fields=[ '_id' ]) ]
+
+    def metadata_from_query(self, query, ranges=None, after=None, fields=None):
+        spec = copy(query)
+        for key, (since, until) in (ranges or { }).items():
+            bounds = { '$ne': None }
+            if since is not None:
+                bounds['$gte'] = since
+            if until is not None:
+                bounds['$lt'] = until
+            spec[key] = bounds
+        if after:
+            spec['_id'] = { '$gt': after }
+        # Blobs live in their own collection - _project() fetches them if they are wanted
+        mongo_fields = None if fields is None else [ 'identifier', 'type' ] + list(fields)
+        for image_meta in self.collection.find(spec, fields=mongo_fields).sort('_id', pymongo.ASCENDING):
+            yield self._project(self._from_mongo_meta(image_meta), fields)
+
+    def child_image_ids(self, image_id):
+        if not image_id:
+            return [ ]
+        query = { '$or': [ { 'base_image_id': image_id }, { 'target_image_id': image_id } ] }
+        return [ image_meta['_id'] for image_meta in self.collection.find(query, fields=[ '_id' ]) ]
+
     def add_image(self, image):
         """
         Add a PersistentImage-type object to this PersistenImageManager
@@ -130,10 +182,6 @@ class MongoPersistentImageManager(PersistentImageManager):
 
         @return TODO
         """
-        metadata = self.collection.find_one( { "_id": image.identifier } )
-        if metadata:
-            raise ImageFactoryException("Image %s already managed, use image_with_id() and save_image()" % (image.identifier))
-
         image.persistent_manager = self
         basename = self.storage_path + '/' + str(image.identifier)
         body_path = basename + BODY_EXT
@@ -145,7 +193,20 @@ class MongoPersistentImageManager(PersistentImageManager):
         except IOError as e:
             self.log.debug('Exception caught: %s' % e)
 
-        self._save_image(image)
+        image.modified = time.time()
+        meta = self._metadata_for_image(image)
+        blobs = image.dirty_blobs()
+        try:
+            # The unique _id makes the insert itself the existence check
+            self.collection.insert(self._to_mongo_meta(meta), safe=True)
+            self._save_blobs(str(image.identifier), blobs)
+        except DuplicateKeyError:
+            raise ImageFactoryException("Image %s already managed, use image_with_id() and save_image()" % (image.identifier))
+        except Exception as e:
+            self.log.debug('Exception caught: %s' % e)
+            raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        image.blobs_saved(blobs)
+        self.log.debug("Added metadata for image (%s): %s" % (image.identifier, meta))
 
     def save_image(self, image):
         """
@@ -156,23 +217,25 @@ class MongoPersistentImageManager(PersistentImageManager):
         @return TODO
         """
         image_id = str(image.identifier)
-        metadata = self._from_mongo_meta(self.collection.find_one( { "_id": image_id } ))
-        if not metadata:
+        image.modified = time.time()
+        meta = self._metadata_for_image(image)
+        # Only blobs set since the last save are written - a status update leaves them alone
+        blobs = image.dirty_blobs()
+        try:
+            # No upsert - the update reports whether it matched, which tells us if the image is managed
+            result = self.collection.update( { '_id': image_id }, self._to_mongo_meta(meta), upsert=False, safe=True )
+        except Exception as e:
+            self.log.debug('Exception caught: %s' % e)
+            raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        if not result.get('updatedExisting'):
             raise ImageFactoryException('Image %s not managed, use "add_image()" first.' % image_id)
-        self._save_image(image)
-
-    def _save_image(self, image):
         try:
-            meta = {'type': type(image).__name__}
-            for mdprop in image.metadata():
-                meta[mdprop] = getattr(image, mdprop, None)
-            # Set upsert to true - allows this function to do the initial insert for add_image
-            # We check existence for save_image() already
-            self.collection.update( { '_id': image.identifier}, self._to_mongo_meta(meta), upsert=True )
-            self.log.debug("Saved metadata for image (%s): %s" % (image.identifier, meta))
+            self._save_blobs(image_id, blobs)
         except Exception as e:
             self.log.debug('Exception caught: %s' % e)
             raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        image.blobs_saved(blobs)
+        self.log.debug("Saved metadata for image (%s): %s" % (image_id, meta))
 
     def delete_image_with_id(self, image_id):
         """
@@ -191,5 +254,6 @@ class MongoPersistentImageManager(PersistentImageManager):
 
         try:
             self.collection.remove(image_id)
+            self.blobs.remove({ 'image_id': image_id })
         except Exception as e:
             self.log.warn('Unable to remove mongo record: %s' % e)
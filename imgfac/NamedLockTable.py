@@ -0,0 +1,176 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import time
+from threading import Lock, Condition
+
+UUID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+# The shard directories of the file store
+SHARD = re.compile(r'(?<=/)[0-9a-f]{2}(?=/)')
+# Lock classes beyond this many are counted together under OTHER_CLASS
+MAX_CLASSES = 1000
+OTHER_CLASS = 'other'
+
+
+def lock_class(name):
+    """
+    The name statistics are kept under for a lock.  Locks named for an image, such as the path
+    of its compressed body or its identifier, are counted together.
+
+    @param name The name of the lock
+
+    @return name with identifiers and shard directories replaced by *
+    """
+    return SHARD.sub('*', UUID.sub('*', name))
+
+
+class NamedLockTable(object):
+    """
+    Reader/writer locks created on first use and looked up by name.  A lock is held either
+    exclusively by one holder or shared by any number of them.
+
+    An entry counts its holder and waiters and is dropped when the last of them is done, so
+    locks named for images do not pile up in a long running process.  The time spent waiting
+    for and holding each lock is counted for its lock_class().  Unlike a threading lock, a lock
+    may be released by a thread other than the one that took it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = { }
+        self._stats = { }
+
+    def _record(self, name, **counts):
+        # Caller must hold _lock
+        key = lock_class(name)
+        if (key not in self._stats) and (len(self._stats) >= MAX_CLASSES):
+            key = OTHER_CLASS
+        stats = self._stats.get(key)
+        if not stats:
+            stats = self._stats[key] = {'acquired': 0, 'contended': 0, 'timeouts': 0,
+                                        'wait_total': 0.0, 'wait_max': 0.0, 'hold_total': 0.0, 'hold_max': 0.0}
+        for count, value in counts.items():
+            if count in ('wait', 'hold'):
+                stats[count + '_total'] += value
+                stats[count + '_max'] = max(stats[count + '_max'], value)
+            else:
+                stats[count] += value
+
+    def _blocked(self, entry, shared):
+        # Caller must hold _lock.  Readers also wait behind waiting writers, so that a steady
+        # stream of readers cannot keep a writer out forever.
+        if shared:
+            return entry['writer'] or (entry['writers_waiting'] > 0)
+        return entry['writer'] or (entry['readers'] > 0)
+
+    def acquire(self, name, blocking=True, timeout=None, shared=False):
+        """
+        Take the named lock.
+
+        @param name The name of the lock
+        @param blocking If False, return at once when the lock is held
+        @param timeout Seconds to wait for the lock or None to wait as long as it takes
+        @param shared If True, take the lock shared with other shared holders, otherwise exclusively
+
+        @return True if the lock was taken
+        """
+        started = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(name)
+            if not entry:
+                entry = self._entries[name] = {'writer': False, 'readers': 0, 'writers_waiting': 0, 'refs': 0,
+                                               'acquired_at': [ ], 'condition': Condition(self._lock)}
+            entry['refs'] += 1
+            contended = self._blocked(entry, shared)
+            if contended and blocking:
+                deadline = (started + timeout) if (timeout is not None) else None
+                if not shared:
+                    entry['writers_waiting'] += 1
+                try:
+                    while self._blocked(entry, shared):
+                        if deadline is None:
+                            entry['condition'].wait()
+                            continue
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        entry['condition'].wait(remaining)
+                finally:
+                    if not shared:
+                        entry['writers_waiting'] -= 1
+            now = time.time()
+            if self._blocked(entry, shared):
+                entry['refs'] -= 1
+                if not shared:
+                    # Readers held back by this writer may go ahead
+                    entry['condition'].notify_all()
+                self._record(name, timeouts=1, wait=now - started)
+                return False
+            if shared:
+                entry['readers'] += 1
+            else:
+                entry['writer'] = True
+            entry['acquired_at'].append(now)
+            self._record(name, acquired=1, contended=int(contended), wait=now - started)
+            return True
+        finally:
+            self._lock.release()
+
+    def release(self, name):
+        """
+        Release a lock taken with acquire(), whether it was taken shared or exclusively
+
+        @param name The name of the lock
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(name)
+            if not (entry and (entry['writer'] or entry['readers'])):
+                raise ValueError("Named lock (%s) is not held" % (name))
+            if entry['writer']:
+                entry['writer'] = False
+            else:
+                entry['readers'] -= 1
+            entry['refs'] -= 1
+            # Shared holders are not told apart - the hold times of readers released out of order
+            # are paired up wrongly, which leaves the total right
+            self._record(name, hold=time.time() - entry['acquired_at'].pop(0))
+            if entry['refs'] == 0:
+                del self._entries[name]
+            else:
+                entry['condition'].notify_all()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            return len(self._entries)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        @return A dict of lock classes and how many times their locks were taken, had to be
+        waited for and were given up on, with the total and longest wait and hold in seconds
+        """
+        self._lock.acquire()
+        try:
+            return dict([ (key, dict(stats)) for key, stats in self._stats.items() ])
+        finally:
+            self._lock.release()
@@ -15,66 +15,212 @@
 #   limitations under the License.
 
 import logging
+import time
 from Singleton import Singleton
 from props import prop
-from collections import defaultdict
-from threading import RLock
+from collections import deque
+from threading import RLock, Condition, Thread, currentThread
 from Notification import Notification
+from ApplicationConfiguration import ApplicationConfiguration
 
 class NotificationCenter(Singleton):
-    """ TODO: Docstring for NotificationCenter  """
+    """
+    Posts notifications to the observers registered for them.
+
+    Observers are kept in a table indexed by message and then by sender, so a notification
+    only looks at observers that can possibly want it.  The table is never modified in place -
+    add_observer() and remove_observer() build a new table and swap it in - so posting does not
+    need a lock and a slow observer never holds up registration.
+
+    By default observers are called on the posting thread.  With notification_dispatch set to
+    'async' in the configuration they are called, in posting order, on a dispatch thread instead.
+    Observers that must see every notification posted so far before carrying on can call flush().
+    """
 
     observers = prop("_observers")
 
     def _singleton_init(self, *args, **kwargs):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
-        self.observers = defaultdict(set)
+        # message -> { sender id (None for any sender) -> frozenset of (observer, method, sender) }
+        self.observers = { }
         self.lock = RLock()
+        self.asynchronous = (ApplicationConfiguration().configuration.get('notification_dispatch', 'sync') == 'async')
+        self._queue = deque()
+        self._queue_condition = Condition()
+        self._posted = 0
+        self._dispatched = 0
+        self._dispatch_thread = None
+        # 'ObserverClass.method' -> dict(calls, total_seconds, max_seconds)
+        self._observer_stats = { }
+        self._stats_lock = RLock()
+
+    def _sender_key(self, sender):
+        # Registered observers hold a reference to their sender, so its id() cannot be reused
+        # while anything is registered against it
+        return id(sender) if sender else None
 
     def add_observer(self, observer, method, message='all', sender=None):
         """
-        TODO: Docstring for add_observer
-        
-        @param observer TODO
-        @param method TODO
-        @param message TODO
-        @param sender TODO
+        Register observer to have method called with each matching notification.
+
+        @param observer The object to notify
+        @param method Name of the method of observer to call
+        @param message The message to observe or 'all'
+        @param sender Only notify for notifications from this object - None for any sender
         """
         self.lock.acquire()
-        self.observers[message].add((observer, method, sender))
-        self.lock.release()
+        try:
+            observers = dict(self.observers)
+            senders = dict(observers.get(message, { }))
+            key = self._sender_key(sender)
+            senders[key] = senders.get(key, frozenset()).union([ (observer, method, sender) ])
+            observers[message] = senders
+            self.observers = observers
+        finally:
+            self.lock.release()
 
     def remove_observer(self, observer, method, message='all', sender=None):
         """
-        TODO: Docstring for remove_observer
-        
-        @param observer TODO
-        @param message TODO
-        @param sender TODO
+        Undo a previous add_observer() with the same arguments.
+
+        @param observer The observing object
+        @param method Name of the method of observer
+        @param message The observed message or 'all'
+        @param sender The sender given to add_observer()
         """
         self.lock.acquire()
-        _observer = (observer, method, sender)
-        self.observers[message].discard(_observer)
-        if (len(self.observers[message]) == 0):
-            del self.observers[message]
-        self.lock.release()
+        try:
+            if message not in self.observers:
+                return
+            observers = dict(self.observers)
+            senders = dict(observers[message])
+            key = self._sender_key(sender)
+            remaining = senders.get(key, frozenset()).difference([ (observer, method, sender) ])
+            if len(remaining) > 0:
+                senders[key] = remaining
+            else:
+                senders.pop(key, None)
+            if len(senders) > 0:
+                observers[message] = senders
+            else:
+                del observers[message]
+            self.observers = observers
+        finally:
+            self.lock.release()
+
+    def _observers_for(self, notification):
+        observers = self.observers
+        sender_key = self._sender_key(notification.sender)
+        _observers = set()
+        for message in ('all', notification.message):
+            senders = observers.get(message)
+            if senders:
+                _observers.update(senders.get(None, ()))
+                if sender_key:
+                    _observers.update(senders.get(sender_key, ()))
+        return _observers
+
+    def _notify(self, notification, _observers):
+        for _observer in _observers:
+            started = time.time()
+            try:
+                getattr(_observer[0], _observer[1])(notification)
+            except Exception as e:
+                self.log.exception('Caught exception: posting notification to object (%s) with method (%s)' % (_observer[0], _observer[1]))
+            self._record_latency(_observer, time.time() - started)
+
+    def _record_latency(self, _observer, elapsed):
+        name = '%s.%s' % (type(_observer[0]).__name__, _observer[1])
+        self._stats_lock.acquire()
+        try:
+            stats = self._observer_stats.setdefault(name, dict(calls=0, total_seconds=0.0, max_seconds=0.0))
+            stats['calls'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        finally:
+            self._stats_lock.release()
+
+    def observer_stats(self):
+        """
+        How long each kind of observer has spent handling notifications.
+
+        @return A dict keyed by 'ObserverClass.method' of dicts with calls, total_seconds, mean_seconds and max_seconds
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = { }
+            for name, values in self._observer_stats.items():
+                stats[name] = dict(values)
+                stats[name]['mean_seconds'] = values['total_seconds'] / values['calls']
+            return stats
+        finally:
+            self._stats_lock.release()
 
     def post_notification(self, notification):
         """
-        TODO: Docstring for post_notification
-        
-        @param notification TODO
+        Deliver notification to every observer of its message and sender.
+
+        @param notification The Notification to post
         """
-        self.lock.acquire()
-        _observers = self.observers['all'].union(self.observers[notification.message])
-        for _observer in _observers:
-            _sender = _observer[2]
-            if ((not _sender) or (_sender == notification.sender)):
-                try:
-                    getattr(_observer[0], _observer[1])(notification)
-                except AttributeError as e:
-                    self.log.exception('Caught exception: posting notification to object (%s) with method (%s)' % (_observer[0], _observer[1]))
-        self.lock.release()
+        # Observers are chosen when the notification is posted, not when it is delivered
+        _observers = self._observers_for(notification)
+        if not _observers:
+            return
+        if not self.asynchronous:
+            self._notify(notification, _observers)
+            return
+        self._queue_condition.acquire()
+        try:
+            if not self._dispatch_thread:
+                self._dispatch_thread = Thread(target=self._dispatch, name='notification-dispatch')
+                self._dispatch_thread.setDaemon(True)
+                self._dispatch_thread.start()
+            self._queue.append((notification, _observers))
+            self._posted += 1
+            self._queue_condition.notifyAll()
+        finally:
+            self._queue_condition.release()
+
+    def _dispatch(self):
+        while True:
+            self._queue_condition.acquire()
+            try:
+                while len(self._queue) == 0:
+                    self._queue_condition.wait()
+                notification, _observers = self._queue.popleft()
+            finally:
+                self._queue_condition.release()
+            self._notify(notification, _observers)
+            self._queue_condition.acquire()
+            try:
+                self._dispatched += 1
+                self._queue_condition.notifyAll()
+            finally:
+                self._queue_condition.release()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every notification posted before this call has been delivered.
+        Returns at once when dispatch is synchronous or when called by an observer.
+
+        @param timeout Seconds to wait or None to wait forever
+
+        @return True if everything was delivered, False on timeout
+        """
+        if currentThread() is self._dispatch_thread:
+            return True
+        deadline = (time.time() + timeout) if timeout else None
+        self._queue_condition.acquire()
+        try:
+            target = self._posted
+            while self._dispatched < target:
+                remaining = (deadline - time.time()) if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue_condition.wait(remaining)
+            return True
+        finally:
+            self._queue_condition.release()
 
     def post_notification_with_info(self, message, sender, user_info=None):
         """
@@ -0,0 +1,214 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+import time
+import copy
+from Singleton import Singleton
+from ApplicationConfiguration import ApplicationConfiguration
+from NotificationCenter import NotificationCenter
+from PersistentImage import NOTIFICATIONS, TERMINAL_STATUSES
+
+DEFAULT_WINDOW = 2
+
+class PersistenceQueue(Singleton):
+    """
+    Saves the images that are being built from a background thread.
+
+    Builders watch() the images they work on.  A change of status or progress then queues a
+    save for persistence_window seconds later, and further changes made in the meantime go
+    out with that save rather than adding their own, so an image reporting progress many
+    times a second is still written at most once per window.  The background save writes a
+    copy of the image taken at the latest change, so that plugins updating status_detail in
+    place from their own threads never change it under the save.  Such updates go out with
+    the next change of status or progress.
+
+    Final states are written with save(), which saves in the calling thread.  It drops any
+    save queued for the image and waits for one already underway, so the last state set is
+    always the last one written.  flush() saves everything that is queued, for a clean
+    shutdown.  A persistence_window of 0 turns the queue off, leaving only the saves that
+    builders make themselves.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.window = float(ApplicationConfiguration().configuration.get('persistence_window', DEFAULT_WINDOW))
+        self.notification_center = NotificationCenter()
+        # image_id -> (image, snapshot to save, time the save is due) for images with a save queued
+        self._pending = { }
+        # Identifiers of images being saved right now
+        self._saving = set()
+        self._condition = threading.Condition()
+        self._worker = None
+        self.saved = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def watch(self, image):
+        """
+        Queue a save of image each time its status or progress changes until it reaches a final status.
+
+        @param image A PersistentImage that has been added to its persistence manager
+        """
+        if self.window <= 0:
+            return
+        for message in NOTIFICATIONS:
+            self.notification_center.add_observer(self, 'image_changed', message, sender=image)
+
+    def unwatch(self, image):
+        """
+        Undo a previous watch().  Saves already queued still happen.
+
+        @param image The watched image
+        """
+        for message in NOTIFICATIONS:
+            self.notification_center.remove_observer(self, 'image_changed', message, sender=image)
+
+    def image_changed(self, notification):
+        image = notification.sender
+        if image.status in TERMINAL_STATUSES:
+            # The builder saves final states itself with save()
+            return
+        self._condition.acquire()
+        try:
+            if image.identifier in self._pending:
+                # The queued save goes out with this state instead
+                due = self._pending[image.identifier][2]
+                self._pending[image.identifier] = (image, self._snapshot(image), due)
+                self.coalesced += 1
+                return
+            self._pending[image.identifier] = (image, self._snapshot(image), time.time() + self.window)
+            if not self._worker:
+                self._worker = threading.Thread(target=self._work, name='persistence-queue')
+                self._worker.setDaemon(True)
+                self._worker.start()
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def _snapshot(self, image):
+        # A copy of image as it is now for the background save.  Copying a dict is a single
+        # step under the interpreter lock - serializing one, as the save does, is not
+        snapshot = copy.copy(image)
+        # Blobs the snapshot saves stay dirty on the image and are written again by its next save
+        snapshot._dirty_blobs = set(image._dirty_blobs)
+        snapshot._unloaded_blobs = set(image._unloaded_blobs)
+        if isinstance(image.status_detail, dict):
+            snapshot.status_detail = dict(image.status_detail)
+        if isinstance(getattr(image, 'parameters', None), dict):
+            snapshot.parameters = dict(image.parameters)
+        return snapshot
+
+    def save(self, image):
+        """
+        Save image now, in this thread.  Images in a final status are no longer watched afterwards.
+
+        @param image The image to save
+        """
+        self._condition.acquire()
+        try:
+            # Whatever was queued is the same state or an older one
+            if self._pending.pop(image.identifier, None):
+                self.coalesced += 1
+            while image.identifier in self._saving:
+                self._condition.wait()
+            self._saving.add(image.identifier)
+        finally:
+            self._condition.release()
+        try:
+            try:
+                image.persistent_manager.save_image(image)
+            except:
+                self._saved(image, failed=True)
+                raise
+            self._saved(image)
+        finally:
+            if image.status in TERMINAL_STATUSES:
+                self.unwatch(image)
+
+    def flush(self):
+        """
+        Save every image with a save queued, in this thread.
+        """
+        self._condition.acquire()
+        try:
+            images = [ image for image, snapshot, due in self._pending.values() ]
+        finally:
+            self._condition.release()
+        for image in images:
+            try:
+                self.save(image)
+            except Exception as e:
+                self.log.warning("Unable to save image (%s) while flushing queued saves: %s" % (image.identifier, e))
+
+    def stats(self):
+        """
+        @return A dict of the number of saves queued, saves made, saves made unnecessary by a
+        later change and failed saves
+        """
+        self._condition.acquire()
+        try:
+            return dict(queued=len(self._pending), saved=self.saved, coalesced=self.coalesced, failed=self.failed)
+        finally:
+            self._condition.release()
+
+    def _saved(self, image, failed=False):
+        self._condition.acquire()
+        try:
+            self._saving.discard(image.identifier)
+            if failed:
+                self.failed += 1
+            else:
+                self.saved += 1
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def _next_save(self):
+        # Caller must hold _condition
+        # Returns the snapshot of the image whose save is due, or None and the number of seconds until one will be
+        now = time.time()
+        soonest = None
+        for image_id, (image, snapshot, due) in self._pending.items():
+            if image_id in self._saving:
+                # Waits for the save that is underway - we are woken when it finishes
+                continue
+            if due <= now:
+                del self._pending[image_id]
+                self._saving.add(image_id)
+                return snapshot, None
+            soonest = (due - now) if (soonest is None) else min(soonest, due - now)
+        return None, soonest
+
+    def _work(self):
+        while True:
+            self._condition.acquire()
+            try:
+                image, wait = self._next_save()
+                while not image:
+                    self._condition.wait(wait)
+                    image, wait = self._next_save()
+            finally:
+                self._condition.release()
+
+            try:
+                image.persistent_manager.save_image(image)
+            except Exception as e:
+                self.log.warning("Background save of image (%s) failed: %s" % (image.identifier, e))
+                self._saved(image, failed=True)
+            else:
+                self._saved(image)
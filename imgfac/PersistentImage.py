@@ -17,13 +17,31 @@
 from props import prop
 import uuid
 import logging
+import time
 from Notification import Notification
 from NotificationCenter import NotificationCenter
 
 
-METADATA =  ( 'identifier', 'data', 'template', 'icicle', 'status_detail', 'status', 'percent_complete', 'parameters' )
+METADATA =  ( 'identifier', 'data', 'template', 'icicle', 'status_detail', 'status', 'percent_complete', 'parameters',
+              'created', 'modified' )
 STATUS_STRINGS = ('NEW','PENDING', 'BUILDING', 'COMPLETE', 'FAILED', 'DELETING', 'DELETED', 'DELETEFAILED')
+# Once an image enters one of these it will not change status again without outside intervention
+TERMINAL_STATUSES = ('COMPLETE', 'FAILED', 'DELETED', 'DELETEFAILED')
 NOTIFICATIONS = ('image.status', 'image.percentage')
+# Large values that rarely change once set
+# Managers store these apart from the rest of the metadata so that saving a status change or
+# listing images never has to touch them, and images only load them when they are first used
+BLOB_METADATA = ('template', 'icicle')
+
+
+def blob_property(key, doc=None):
+    def fget(self):
+        return self._blob_value(key)
+    def fset(self, value):
+        setattr(self, '_' + key, value)
+        self._unloaded_blobs.discard(key)
+        self._dirty_blobs.add(key)
+    return property(fget, fset, None, doc)
 
 
 class PersistentImage(object):
@@ -33,9 +51,11 @@ class PersistentImage(object):
     persistence_manager = prop("_persistence_manager")
     identifier = prop("_identifier")
     data = prop("_data")
-    template = prop("_template")
-    icicle = prop("_icicle")
+    template = blob_property('template', "The template the image was built from.")
+    icicle = blob_property('icicle', "The ICICLE describing the contents of the image.")
     status_detail = prop("_status_detail")
+    created = prop("_created")
+    modified = prop("_modified")
 
     def status():
         doc = "A string value."
@@ -83,11 +103,17 @@ class PersistentImage(object):
     def __init__(self, image_id=None):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.notification_center = NotificationCenter()
+        # Blob values that are still only in the persistence manager, and those changed since the last save
+        self._unloaded_blobs = set()
+        self._dirty_blobs = set()
         # We have never had use for the UUID object itself - make this a string
         # TODO: Root out all places where were str() convert this elsewhere
         self.identifier = image_id if image_id else str(uuid.uuid4())
         self.persistence_manager = None
         self.data = None
+        # Seconds since the epoch - persistence managers update modified each time they save the image
+        self.created = time.time()
+        self.modified = self.created
         # 'activity' should be set to a single line indicating, in as much detail as reasonably possible,
         #   what it is that the plugin operating on this image is doing at any given time.
         # 'error' should remain None unless an exception or other fatal error has occurred.  Error may
@@ -102,3 +128,38 @@ class PersistentImage(object):
     def metadata(self):
         self.log.debug("Executing metadata in class (%s) my metadata is (%s)" % (self.__class__, METADATA))
         return METADATA
+
+    def _blob_value(self, key):
+        if key in self._unloaded_blobs:
+            manager = getattr(self, 'persistent_manager', None)
+            setattr(self, '_' + key, manager.load_blob(self.identifier, key) if manager else None)
+            self._unloaded_blobs.discard(key)
+        return getattr(self, '_' + key, None)
+
+    def unload_blobs(self, keys):
+        """
+        Called by persistence managers - the values of keys are to be loaded from the manager on first use.
+
+        @param keys The BLOB_METADATA keys that were not loaded with the rest of the metadata
+        """
+        self._unloaded_blobs.update(keys)
+        self._dirty_blobs.difference_update(keys)
+
+    def dirty_blobs(self):
+        """
+        Called by persistence managers - the blob values set since they were last saved.
+
+        @return A dict of BLOB_METADATA keys and values
+        """
+        return dict([ (key, getattr(self, '_' + key, None)) for key in self._dirty_blobs ])
+
+    def blobs_saved(self, blobs):
+        """
+        Called by persistence managers once the values returned by dirty_blobs() have been stored.
+
+        @param blobs The dict returned by dirty_blobs()
+        """
+        for key, value in blobs.items():
+            # Stays dirty if it was set again while the save was underway
+            if getattr(self, '_' + key, None) is value:
+                self._dirty_blobs.discard(key)
@@ -15,6 +15,7 @@
 #   limitations under the License.
 
 from ApplicationConfiguration import ApplicationConfiguration
+from PersistentImage import BLOB_METADATA
 
 
 class PersistentImageManager(object):
@@ -60,6 +61,122 @@ class PersistentImageManager(object):
         raise NotImplementedError("images_from_query() not implemented - cannot continue")
 
 
+    def image_ids_from_query(self, query):
+        """
+        Return the identifiers of the images matching query without building the images.
+        Managers that can fetch identifiers more cheaply than whole images should override
+        this - the default falls back to images_from_query().
+
+        @param query Dict of metadata keys and the values they must have
+
+        @return A list of image identifiers
+        """
+        return [ image.identifier for image in self.images_from_query(query) ]
+
+    def child_image_ids(self, image_id):
+        """
+        Return the identifiers of the images derived directly from the given image.
+        That is, the TargetImages built from a BaseImage or the ProviderImages pushed
+        from a TargetImage.  Managers that maintain a parent to children index should
+        override this - the default falls back to images_from_query().
+
+        @param image_id The identifier of the parent image
+
+        @return A list of image identifiers
+        """
+        children = self.images_from_query({'base_image_id': image_id})
+        children += self.images_from_query({'target_image_id': image_id})
+        return [ child.identifier for child in children ]
+
+    def metadata_from_query(self, query, ranges=None, after=None, fields=None):
+        """
+        Iterate over the metadata of the images matching query in order of identifier.
+        Nothing is built or read until the caller asks for it, so very large results can be
+        paged through or streamed.  Managers that can search in identifier order should
+        override this - the default sorts the results of image_ids_from_query().
+
+        @param query Dict of metadata keys and the values they must have
+        @param ranges Dict of metadata keys and (since, until) pairs - the value must be at least
+        since and less than until.  Either may be None.
+        @param after Only include images with an identifier greater than this, so that an
+        iteration can resume where an earlier one stopped
+        @param fields The metadata keys to include or None for the whole record, which leaves
+        out BLOB_METADATA.  The identifier and type are always included.
+
+        @return An iterator of metadata dicts
+        """
+        for image_id in sorted(self.image_ids_from_query(query)):
+            if after and image_id <= after:
+                continue
+            image = self.image_with_id(image_id)
+            if not image:
+                continue
+            metadata = self._metadata_for_image(image)
+            if self._in_ranges(metadata, ranges):
+                yield self._project(metadata, fields)
+
+    def _in_ranges(self, metadata, ranges):
+        for key, (since, until) in (ranges or { }).items():
+            value = metadata.get(key)
+            if value is None:
+                return False
+            if ((since is not None) and (value < since)) or ((until is not None) and (value >= until)):
+                return False
+        return True
+
+    def _project(self, metadata, fields):
+        # Reduce a metadata record to the fields asked for, fetching blobs if they are among them
+        if fields is None:
+            return dict(metadata)
+        projected = { 'identifier': metadata['identifier'], 'type': metadata['type'] }
+        for key in fields:
+            if key in metadata:
+                projected[key] = metadata[key]
+            elif key in BLOB_METADATA:
+                projected[key] = self.load_blob(metadata['identifier'], key)
+            else:
+                projected[key] = None
+        return projected
+
+    def storage_directories(self):
+        """
+        Return the directories that hold image files.  Managers that spread the files
+        over subdirectories of storage_path should override this.
+
+        @return A list of directory paths
+        """
+        return [ self.storage_path ]
+
+    def load_blob(self, image_id, key):
+        """
+        Return the stored value of one of the BLOB_METADATA keys of an image.
+        Images call this the first time the value is used.
+
+        @param image_id The identifier of the image
+        @param key The metadata key
+
+        @return The value or None if none was stored
+        """
+        raise NotImplementedError("load_blob() not implemented - cannot continue")
+
+    def _metadata_for_image(self, image):
+        # The metadata record for image - BLOB_METADATA keys are stored separately, see dirty_blobs()
+        meta = {'type': type(image).__name__}
+        for mdprop in image.metadata():
+            if mdprop not in BLOB_METADATA:
+                meta[mdprop] = getattr(image, mdprop, None)
+        return meta
+
+    def _populate_image(self, image, metadata):
+        # Set the attributes of image from a metadata record
+        # Records written before blobs were split out carry them inline - those are taken as they are
+        # and marked dirty so that the next save moves them out of the record
+        for key in image.metadata().union(metadata.keys()):
+            if (key in BLOB_METADATA) and (key not in metadata):
+                continue
+            setattr(image, key, metadata.get(key))
+        image.unload_blobs([ key for key in BLOB_METADATA if key not in metadata ])
+
     def add_image(self, image):
         """
         TODO: Docstring for add_image
@@ -20,6 +20,7 @@ import os
 import json
 from Singleton import Singleton
 from ImageFactoryException import ImageFactoryException
+from ReservationManager import ReservationManager
 
 PLUGIN_TYPES = ('OS', 'CLOUD')
 INFO_FILE_EXTENSION = '.info'
@@ -81,6 +82,8 @@ class PluginManager(Singleton):
                             self.log.warn(msg)
                     self._plugins[plugin_name] = md
                     self._types[md['type'].upper()].append(plugin_name)
+                    for resource_class, size in md.get('resource_classes', { }).items():
+                        ReservationManager().declare_queue(resource_class, size)
                     self.log.info('Plugin (%s) loaded...' % plugin_name)
             except KeyError as e:
                 msg = 'Invalid metadata for plugin (%s). Missing entry for %s.' % (plugin_name, e)
@@ -119,6 +122,23 @@ class PluginManager(Singleton):
                     fp.close()
                 return metadata
 
+    def resources_for(self, delegate, kind):
+        """
+        The resource classes a plugin needs for a kind of job, from the resources entry of its
+        .info file.  For example, {"base_image": {"local": 1}} takes one slot of the local
+        queue for the whole of each base image build.
+
+        @param delegate An instance of the delegate class of the plugin
+        @param kind The kind of job - base_image, target_image, provider_image, snapshot or delete
+
+        @return A dict of resource class names and the number of slots needed in each
+        """
+        module = type(delegate).__module__.split('.')
+        if (len(module) < 2) or (module[0] != PKG_STR):
+            return { }
+        metadata = self._plugins.get(module[1]) or { }
+        return dict(metadata.get('resources', { }).get(kind, { }))
+
     def plugin_for_target(self, target):
         """
         Looks up the plugin for a given target and returns an instance of the 
@@ -0,0 +1,169 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from ApplicationConfiguration import ApplicationConfiguration
+
+
+class ReservationBackend(object):
+    """
+    Abstract base class for where the ReservationManager keeps its queue slots, named locks,
+    listen ports and disk reservations.
+
+    Backends that are not shared hold everything in the memory of this process and the
+    ReservationManager keeps its own record of disk reservations.  Shared backends are seen
+    by every imagefactoryd using them - the ReservationManager reads the reservations of the
+    others from the backend before deciding whether a file fits.
+    """
+
+    _default_backend = None
+
+    # True if other processes see what this backend holds
+    shared = False
+
+    @classmethod
+    def default_backend(cls):
+        if not cls._default_backend:
+            appconfig = ApplicationConfiguration().configuration
+            class_name = appconfig.get('reservation_backend', 'local').capitalize() + "ReservationBackend"
+            kwargs = appconfig.get('reservation_backend_args', { })
+            backend_module = __import__(class_name, globals(), locals(), [ class_name ], -1)
+            backend_class = getattr(backend_module, class_name)
+            cls._default_backend = backend_class(**kwargs)
+        return cls._default_backend
+
+    def __init__(self):
+        raise NotImplementedError("ReservationBackend is an abstract class.  You must instantiate a real backend.")
+
+    def queues(self):
+        """
+        @return A list of the names of the queues
+        """
+        raise NotImplementedError("queues() not implemented - cannot continue")
+
+    def queue_size(self, name):
+        """
+        @param name The name of the queue
+
+        @return The number of slots in the queue
+        """
+        raise NotImplementedError("queue_size() not implemented - cannot continue")
+
+    def add_queue(self, name, size):
+        """
+        Create a queue unless one of that name exists already.
+
+        @param name The name of the queue
+        @param size The number of slots in the queue
+
+        @return True if the queue was created
+        """
+        raise NotImplementedError("add_queue() not implemented - cannot continue")
+
+    def enter_queue(self, name, client=None, count=1):
+        """
+        Take slots in the named queue, waiting until it is the turn of the client and they are free.
+
+        @param name The name of the queue
+        @param client The client the slots are taken for, which decides its place in the queue
+        @param count The number of slots to take
+        """
+        raise NotImplementedError("enter_queue() not implemented - cannot continue")
+
+    def exit_queue(self, name, count=1):
+        """
+        Give up slots taken with enter_queue()
+
+        @param name The name of the queue
+        @param count The number of slots to give up
+        """
+        raise NotImplementedError("exit_queue() not implemented - cannot continue")
+
+    def queue_stats(self):
+        """
+        @return A dict of the size, slots in use, waiters and wait times of each queue
+        """
+        raise NotImplementedError("queue_stats() not implemented - cannot continue")
+
+    def acquire_lock(self, name, blocking=True, timeout=None, shared=False):
+        """
+        Take the named lock.
+
+        @param name The name of the lock
+        @param blocking If False, return at once when the lock is held
+        @param timeout Seconds to wait for the lock or None to wait as long as it takes
+        @param shared If True, take the lock shared with other shared holders, otherwise exclusively
+
+        @return True if the lock was taken
+        """
+        raise NotImplementedError("acquire_lock() not implemented - cannot continue")
+
+    def release_lock(self, name):
+        """
+        Release a lock taken with acquire_lock(), whether it was taken shared or exclusively
+
+        @param name The name of the lock
+        """
+        raise NotImplementedError("release_lock() not implemented - cannot continue")
+
+    def lock_stats(self):
+        """
+        @return A dict of lock classes and the contention seen on their named locks - see NamedLockTable
+        """
+        raise NotImplementedError("lock_stats() not implemented - cannot continue")
+
+    def lock_count(self):
+        """
+        @return The number of named locks held or waited for
+        """
+        raise NotImplementedError("lock_count() not implemented - cannot continue")
+
+    def next_listen_port(self, min_port, max_port):
+        """
+        @param min_port The lowest port to hand out
+        @param max_port The highest port to hand out
+
+        @return The port after the one last handed out, wrapping around to min_port
+        """
+        raise NotImplementedError("next_listen_port() not implemented - cannot continue")
+
+    def reservations(self, mount_path):
+        """
+        Only called on shared backends.
+
+        @param mount_path The mount point the reservations are on
+
+        @return A dict of the bytes reserved for each file on the mount by every process
+        """
+        raise NotImplementedError("reservations() not implemented - cannot continue")
+
+    def add_reservation(self, mount_path, filepath, size):
+        """
+        Record a reservation, replacing any earlier one for the file.  Only called on shared
+        backends, while holding the named lock for the mount.
+
+        @param mount_path The mount point holding filepath
+        @param filepath The file the space is reserved for
+        @param size The number of bytes reserved
+        """
+        raise NotImplementedError("add_reservation() not implemented - cannot continue")
+
+    def remove_reservation(self, filepath):
+        """
+        Forget the reservation for a file.  Only called on shared backends.
+
+        @param filepath The file the space was reserved for
+        """
+        raise NotImplementedError("remove_reservation() not implemented - cannot continue")
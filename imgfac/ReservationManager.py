@@ -15,9 +15,20 @@
 import logging
 import os
 import os.path
+import re
+import select
+import time
 from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ReservationBackend import ReservationBackend
+from imgfac.ImageFactoryException import ImageFactoryException
 from threading import BoundedSemaphore
 
+MOUNTINFO = '/proc/self/mountinfo'
+# Seconds for which a sample of the free space on a filesystem is used before taking another
+DEFAULT_SAMPLE_TTL = 5
+# Held on shared backends while deciding whether a file fits on a mount
+RESERVATION_LOCK = 'reservations-%s'
+
 class ReservationManager(object):
     """ TODO: Docstring for ReservationManager """
     instance = None
@@ -56,7 +67,7 @@ class ReservationManager(object):
     @property
     def queues(self):
         """The property queues"""
-        return self._queues.keys()
+        return self.backend.queues()
     ### END Properties
 
     def __new__(cls, *p, **k):
@@ -66,13 +77,14 @@ class ReservationManager(object):
             i.log = logging.getLogger('%s.%s' % (__name__, i.__class__.__name__))
             i.default_minimum = cls.DEFAULT_MINIMUM
             i._mounts = dict()
+            i._mounts_lock = BoundedSemaphore()
             i.appconfig = ApplicationConfiguration().configuration
-            i._queues = dict(local=BoundedSemaphore(i.appconfig.get('max_concurrent_local_sessions', 1)),
-                             ec2=BoundedSemaphore(i.appconfig.get('max_concurrent_ec2_sessions', 1)))
-            i._named_locks = { } 
-            i._named_locks_lock = BoundedSemaphore()
-            i._listen_port = cls.MIN_PORT
-            i._listen_port_lock = BoundedSemaphore()
+            i.sample_ttl = float(i.appconfig.get('free_space_sample_ttl', DEFAULT_SAMPLE_TTL))
+            i._mount_points = None
+            i._mountinfo = None
+            i._mountinfo_poll = None
+            i._mount_points_lock = BoundedSemaphore()
+            i.backend = ReservationBackend.default_backend()
             cls.instance = i
         return cls.instance
 
@@ -83,14 +95,49 @@ class ReservationManager(object):
         pass
 
     def get_next_listen_port(self):
-        self._listen_port_lock.acquire()
-        try:
-            self._listen_port += 1
-            if self._listen_port > self.MAX_PORT:
-                self._listen_port = self.MIN_PORT
-            return self._listen_port
-        finally:
-            self._listen_port_lock.release()
+        return self.backend.next_listen_port(self.MIN_PORT, self.MAX_PORT)
+
+    def _new_mount(self, min_free):
+        # Besides the reservations each mount keeps their total, and a sample of the free space
+        # and of how much of the reserved files had been written when it was taken, so that
+        # checking the space available never has to look at each reserved file
+        return {'min_free': min_free, 'reservations': dict(), 'reserved': 0,
+                'available': 0, 'consumed': dict(), 'consumed_total': 0, 'sampled': None}
+
+    def _sample(self, mount_path, mount):
+        # Caller must hold _mounts_lock
+        # Between samples, reserved files that grow use up free space and consumed space in equal
+        # measure, so available_space_for_path() stays right until the sample expires
+        if (mount['sampled'] is not None) and (time.time() - mount['sampled'] < self.sample_ttl):
+            return
+        consumed = dict()
+        for filepath in mount['reservations'].keys():
+            try:
+                consumed[filepath] = os.path.getsize(filepath)
+            except os.error:
+                consumed[filepath] = 0
+        stat = os.statvfs(mount_path)
+        mount['available'] = stat.f_bavail * stat.f_frsize
+        mount['consumed'] = consumed
+        mount['consumed_total'] = sum(consumed.values())
+        mount['sampled'] = time.time()
+
+    def _sync_reservations(self, mount_path, mount):
+        # Caller must hold _mounts_lock
+        # Take up the reservations other processes made on a shared backend - files new to us
+        # count as empty until the next sample
+        reservations = self.backend.reservations(mount_path)
+        consumed = dict([ (filepath, size) for filepath, size in mount['consumed'].items() if filepath in reservations ])
+        mount['reservations'] = reservations
+        mount['reserved'] = sum(reservations.values())
+        mount['consumed'] = consumed
+        mount['consumed_total'] = sum(consumed.values())
+
+    def _available(self, mount_path, mount):
+        # Caller must hold _mounts_lock
+        self._sample(mount_path, mount)
+        remaining = mount['reserved'] - mount['consumed_total']
+        return mount['available'] - (remaining if remaining > 0 else 0)
 
     def reserve_space_for_file(self, size, filepath):
         """
@@ -100,14 +147,30 @@ class ReservationManager(object):
         @param filepath TODO
         """
         mount_path = self._mount_for_path(filepath)
-        mount = self._mounts.setdefault(mount_path,
-                {'min_free': self.default_minimum, 'reservations': dict()})
-        available = self.available_space_for_path(mount_path) - mount['min_free']
-        if(size < available):
-            mount['reservations'].update({filepath:size})
-            return True
-        else:
-            return False
+        shared = self.backend.shared
+        if shared:
+            self.backend.acquire_lock(RESERVATION_LOCK % mount_path)
+        try:
+            self._mounts_lock.acquire()
+            try:
+                mount = self._mounts.setdefault(mount_path, self._new_mount(self.default_minimum))
+                if shared:
+                    self._sync_reservations(mount_path, mount)
+                min_free = mount['min_free'] if (mount['min_free'] is not None) else self.default_minimum
+                available = self._available(mount_path, mount) - min_free
+                if(size < available):
+                    if shared:
+                        self.backend.add_reservation(mount_path, filepath, size)
+                    mount['reserved'] += size - mount['reservations'].get(filepath, 0)
+                    mount['reservations'].update({filepath:size})
+                    return True
+                else:
+                    return False
+            finally:
+                self._mounts_lock.release()
+        finally:
+            if shared:
+                self.backend.release_lock(RESERVATION_LOCK % mount_path)
 
     def cancel_reservation_for_file(self, filepath, quiet=True):
         """
@@ -117,10 +180,15 @@ class ReservationManager(object):
         """
         mount_path = self._mount_for_path(filepath)
 
+        self._mounts_lock.acquire()
         try:
             mount = self._mounts.get(mount_path)
+            if self.backend.shared:
+                self.backend.remove_reservation(filepath)
             try:
-                del mount['reservations'][filepath]
+                size = mount['reservations'].pop(filepath)
+                mount['reserved'] -= size
+                mount['consumed_total'] -= mount['consumed'].pop(filepath, 0)
             except (TypeError, KeyError), e:
                 if(quiet):
                     self.log.warn('No reservation for %s to cancel!' % filepath)
@@ -131,13 +199,41 @@ class ReservationManager(object):
                 self.log.warn('No reservations exist on %s!' % mount_path)
             else:
                 raise e
+        finally:
+            self._mounts_lock.release()
+
+    def _unescape_mount_point(self, field):
+        # mountinfo writes space, tab, newline and backslash in paths as octal escapes
+        return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+    def _current_mount_points(self):
+        # The set of mount points, read from /proc/self/mountinfo when first needed and again only
+        # after the kernel reports a change to it, or None where there is no mountinfo
+        self._mount_points_lock.acquire()
+        try:
+            if self._mountinfo is None:
+                try:
+                    self._mountinfo = open(MOUNTINFO, 'r')
+                except IOError:
+                    return None
+                self._mountinfo_poll = select.poll()
+                self._mountinfo_poll.register(self._mountinfo, select.POLLPRI | select.POLLERR)
+            elif (self._mount_points is not None) and not self._mountinfo_poll.poll(0):
+                return self._mount_points
+            self._mountinfo.seek(0)
+            self._mount_points = frozenset([ self._unescape_mount_point(line.split(' ')[4])
+                                             for line in self._mountinfo.read().splitlines() if line ])
+            return self._mount_points
+        finally:
+            self._mount_points_lock.release()
 
     def _mount_for_path(self, path):
         path = os.path.abspath(path)
+        mount_points = self._current_mount_points()
         while path != os.path.sep:
-            if os.path.ismount(path):
+            if (path in mount_points) if (mount_points is not None) else os.path.ismount(path):
                 return path
-            path = os.path.abspath(os.path.join(path, os.pardir))
+            path = os.path.dirname(path)
         return path
 
     def add_path(self, path, min_free=None):
@@ -149,8 +245,11 @@ class ReservationManager(object):
         """
         if(isinstance(path, str)):
             mount_path = self._mount_for_path(path)
-            mount = self._mounts.setdefault(mount_path,
-                    {'min_free':min_free, 'reservations': dict()})
+            self._mounts_lock.acquire()
+            try:
+                mount = self._mounts.setdefault(mount_path, self._new_mount(min_free))
+            finally:
+                self._mounts_lock.release()
             if(not mount):
                 raise RuntimeError("Unable to add path (%s)." % path)
         else:
@@ -163,6 +262,7 @@ class ReservationManager(object):
         @param path Filesystem path string to remove.
         """
         mount_path = self._mount_for_path(path)
+        self._mounts_lock.acquire()
         try:
             del self._mounts[mount_path]
         except KeyError, e:
@@ -170,82 +270,175 @@ class ReservationManager(object):
                 self.log.warn('%s not in reservation list.' % mount_path)
             else:
                 raise e
+        finally:
+            self._mounts_lock.release()
+
+    def space_freed(self, path):
+        """
+        Tell the ReservationManager that files were removed from the filesystem holding path,
+        so that the next check of the space available samples it again rather than waiting
+        for the free_space_sample_ttl of the last sample to run out.
+
+        @param path Filesystem path string
+        """
+        mount_path = self._mount_for_path(path)
+        self._mounts_lock.acquire()
+        try:
+            mount = self._mounts.get(mount_path)
+            if mount:
+                mount['sampled'] = None
+        finally:
+            self._mounts_lock.release()
+
+    def min_free_for_path(self, path):
+        """
+        The number of bytes that must be left free on the filesystem holding path.
+
+        @param path Filesystem path string
+
+        @return The min_free of the mount if one was set with add_path(), otherwise default_minimum
+        """
+        mount = self._mounts.get(self._mount_for_path(path))
+        if mount and (mount['min_free'] is not None):
+            return mount['min_free']
+        return self.default_minimum
 
     def available_space_for_path(self, path):
         """
-        TODO: Docstring for available_space_for_path
+        Bytes free on the filesystem holding path, less what is still to be written to the
+        files reserved on it.  The free space is sampled at most once every free_space_sample_ttl
+        seconds - reservations made and cancelled in between are accounted for at once.
 
-        @param path TODO
+        @param path Filesystem path string
 
-        @return TODO
+        @return The number of bytes or None if the path has not been added
         """
         mount_path = self._mount_for_path(path)
-        if(mount_path in self._mounts):
-            reservations = self._mounts[mount_path]['reservations'].values()
-            reservation_total = sum(reservations)
-            consumed_total = 0
-            for filepath in self._mounts[mount_path]['reservations'].keys():
-                try:
-                    consumed_total += os.path.getsize(filepath)
-                except os.error:
-                    self.log.warn('%s does not exist.' % filepath)
-            remaining = reservation_total - consumed_total
-            stat = os.statvfs(path)
-            available = stat.f_bavail * stat.f_frsize
-            return available - (remaining if remaining > 0 else 0)
-        else:
-            return None
+        self._mounts_lock.acquire()
+        try:
+            mount = self._mounts.get(mount_path)
+            if mount is None:
+                return None
+            if self.backend.shared:
+                self._sync_reservations(mount_path, mount)
+            return self._available(mount_path, mount)
+        finally:
+            self._mounts_lock.release()
 
-    def enter_queue(self, name=None):
+    def declare_queue(self, name, size):
+        """
+        Add a queue for a resource class, such as one a plugin declares in its .info file.
+        Queues named in the resource_classes configuration keep their configured size.
+
+        @param name - The name of the resource class
+        @param size - The number of slots for the class when it is not configured
+        """
+        if self.backend.add_queue(name, size):
+            self.log.debug("Added queue (%s) with (%d) slots" % (name, size))
+
+    def enter_queue(self, name=None, client=None, count=1):
         """
         Tries to acquire a semaphore for the named queue. Blocks until a slot opens up.
         If no name is given or a queue for the given name is not found, the default 'local' 
         queue will be used.
+        Waiters get slots in weighted fair order across clients - see client_weights.
 
         @param name - The name of the queue to enter. See the queues property of ReservationManager.
+        @param client - The client the slots are for
+        @param count - The number of slots to take
         """
         if(name):
             self.log.debug("ENTERING queue: (%s)" % (name))
-            self._queues[name].acquire()
+            self.backend.enter_queue(name, client, count)
             self.log.debug("SUCCESS ENTERING queue: (%s)" % (name))
 
-    def exit_queue(self, name=None):
+    def exit_queue(self, name=None, count=1):
         """
         Releases semaphore for the named queue. This opens up a slot for waiting members of the queue.
         If no name is given or a queue for the given name is not found, the default 'local' 
         queue will be used.
 
         @param name - The name of the queue to enter. See the queues property of ReservationManager.
+        @param count - The number of slots to give up
         """
         if(name):
             self.log.debug("EXITING queue: (%s)" % (name))
-            self._queues[name].release()
+            self.backend.exit_queue(name, count)
             self.log.debug("SUCCESS EXITING queue: (%s)" % (name))
 
-    def get_named_lock(self, name):
+    def enter_queues(self, needs, client=None):
+        """
+        Take slots in several queues, such as the resource classes a plugin needs for a job.
+        Queues are always entered in name order so that two callers can not each hold what the
+        other is waiting for.
+
+        @param needs - A dict of queue names and the number of slots needed in each
+        @param client - The client the slots are for
+        """
+        unknown = [ name for name in needs if name not in self.queues ]
+        if unknown:
+            raise ImageFactoryException("Unknown resource classes (%s) - declare them in resource_classes" % (', '.join(unknown)))
+        entered = [ ]
+        try:
+            for name in sorted(needs.keys()):
+                self.enter_queue(name, client, needs[name])
+                entered.append(name)
+        except:
+            self.exit_queues(dict([ (name, needs[name]) for name in entered ]))
+            raise
+
+    def exit_queues(self, needs):
+        """
+        Give up slots taken with enter_queues()
+
+        @param needs - The dict given to enter_queues()
+        """
+        for name in sorted(needs.keys(), reverse=True):
+            self.exit_queue(name, needs[name])
+
+    def named_lock_stats(self):
+        """
+        How long named locks were waited for and held, to show which of them limit throughput.
+        Locks named for images are counted together - the identifiers in their names are
+        replaced with *.
+
+        @return A dict of the number of locks in use and the counts and times for each lock class
+        """
+        return {'active': self.backend.lock_count(), 'locks': self.backend.lock_stats()}
+
+    def queue_stats(self):
+        """
+        @return A dict of the size, slots in use, number of waiters and wait times of each queue
+        """
+        return self.backend.queue_stats()
+
+    def get_named_lock(self, name, blocking=True, timeout=None, shared=False):
         """
         Get the named lock.
-        If the semaphore representing the lock does not exit, create it in a thread safe way.
-        Note that this is always a blocking call that will wait until the lock is available.
+        The lock is created on first use and dropped once nothing holds or waits for it.
+        By default this is a blocking call that will wait until the lock is available.
+        Shared holders of a lock run alongside each other but not alongside an exclusive holder,
+        and wait behind exclusive waiters that came before them.
 
         @param name - The name of the lock
-        """
-        # Global critical section
-        self._named_locks_lock.acquire()
-        if not name in self._named_locks:
-            self._named_locks[name] = BoundedSemaphore()
-        self._named_locks_lock.release()
-        # End global critical section
+        @param blocking - If False, return at once when the lock is held elsewhere
+        @param timeout - Seconds to wait for the lock or None to wait as long as it takes
+        @param shared - If True, take the lock shared rather than exclusively
 
-        self.log.debug("Grabbing named lock (%s)" % name)
-        self._named_locks[name].acquire()
-        self.log.debug("Got named lock (%s)" % name)
+        @return True if the lock was taken
+        """
+        self.log.debug("Grabbing %s named lock (%s)" % ('shared' if shared else 'exclusive', name))
+        if self.backend.acquire_lock(name, blocking, timeout, shared):
+            self.log.debug("Got named lock (%s)" % name)
+            return True
+        self.log.debug("Gave up on named lock (%s)" % name)
+        return False
 
     def release_named_lock(self, name):
         """
-        Release a named lock acquired with get_named_lock()
+        Release a named lock acquired with get_named_lock(), whether shared or exclusive
 
         @param name - The name of the lock
         """
         self.log.debug("Releasing named lock (%s)" % name)
-        self._named_locks[name].release()
+        self.backend.release_lock(name)
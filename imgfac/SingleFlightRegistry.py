@@ -0,0 +1,123 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import hashlib
+import json
+from threading import BoundedSemaphore
+from Singleton import Singleton
+from NotificationCenter import NotificationCenter
+from PersistentImage import TERMINAL_STATUSES
+
+# Parameters that differ between otherwise identical requests without changing what gets built
+IGNORED_PARAMETERS = ('callbacks', )
+
+
+def flight_key(kind, *parts):
+    """
+    A key that is equal for builds that would produce the same result.
+
+    @param kind The kind of build, such as 'base_image'
+    @param parts Anything else that determines the result - must be JSON serializable or have a meaningful str()
+
+    @return A string
+    """
+    canonical = [ kind ]
+    for part in parts:
+        if isinstance(part, dict):
+            part = dict([ (key, value) for key, value in part.items() if key not in IGNORED_PARAMETERS ])
+        canonical.append(part)
+    return "%s-%s" % (kind, hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str)).hexdigest())
+
+
+def sharing_image_ids(pim, image):
+    """
+    The other ProviderImages that refer to the same image on the provider as image.  A
+    ProviderImage that followed an identical push is given the identifier_on_provider of
+    the image it followed, so the image on the provider may only be deleted with the last
+    of them.
+
+    @param pim The PersistentImageManager holding the images
+    @param image The ProviderImage
+
+    @return A list of image identifiers
+    """
+    if not getattr(image, 'identifier_on_provider', None):
+        return [ ]
+    query = {'type': 'ProviderImage', 'provider': image.provider,
+             'identifier_on_provider': image.identifier_on_provider}
+    return [ image_id for image_id in pim.image_ids_from_query(query) if image_id != image.identifier ]
+
+
+class SingleFlightRegistry(Singleton):
+    """
+    Tracks the builds currently in flight in this process by a key describing what they produce.
+
+    The first request for a key becomes its leader and builds normally.  Identical requests that
+    arrive while the leader is still running are told about the leader so they can attach to it
+    instead of doing the same work again.  A key is forgotten as soon as its leader posts a
+    terminal 'image.status' notification.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self._leaders = { }
+        self._keys_by_image = { }
+        self._lock = BoundedSemaphore()
+        NotificationCenter().add_observer(self, 'handle_state_change', 'image.status')
+
+    def handle_state_change(self, notification):
+        if notification.user_info['new_status'] not in TERMINAL_STATUSES:
+            return
+        self._lock.acquire()
+        try:
+            key = self._keys_by_image.pop(notification.sender.identifier, None)
+            if key:
+                del self._leaders[key]
+                self.log.debug("Flight (%s) landed with status (%s)" % (key, notification.user_info['new_status']))
+        finally:
+            self._lock.release()
+
+    def lead_or_follow(self, key, image):
+        """
+        Make image the leader for key unless another build already is.
+
+        @param key A key from flight_key()
+        @param image The image the caller is about to build
+
+        @return The leading image if the caller should follow it, otherwise None
+        """
+        self._lock.acquire()
+        try:
+            leader = self._leaders.get(key)
+            if leader:
+                self.log.debug("Image (%s) is following in-flight image (%s)" % (image.identifier, leader.identifier))
+                return leader
+            self._leaders[key] = image
+            self._keys_by_image[image.identifier] = key
+            return None
+        finally:
+            self._lock.release()
+
+    def in_flight(self):
+        """
+        @return A dict of flight keys and the identifier of the image leading each
+        """
+        self._lock.acquire()
+        try:
+            return dict([ (key, image.identifier) for key, image in self._leaders.items() ])
+        finally:
+            self._lock.release()
@@ -0,0 +1,368 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import stat
+import json
+import sqlite3
+import threading
+import time
+from props import prop
+from ImageFactoryException import ImageFactoryException
+from PersistentImageManager import PersistentImageManager
+from PersistentImage import BLOB_METADATA
+from FilePersistentImageManager import storage_directories
+
+STORAGE_PATH = '/var/lib/imagefactory/storage'
+DATABASE_NAME = 'images.db'
+METADATA_EXT = '.meta'
+BODY_EXT = '.body'
+# Metadata keys that get their own indexed column - everything is also kept in the JSON blob
+INDEXED_COLUMNS = ('type', 'status', 'base_image_id', 'target_image_id', 'provider', 'target', 'backing_image_id')
+# Timestamp keys that get their own indexed column, for range queries
+TIME_COLUMNS = ('created', 'modified')
+# Rows are always written with the columns named - databases created before a column
+# existed have it added at the end
+COLUMNS = ('identifier', ) + INDEXED_COLUMNS + TIME_COLUMNS + ('metadata', )
+# Rows fetched at a time by metadata_from_query()
+QUERY_BATCH_SIZE = 500
+# Seconds a writer waits for another writer before giving up
+BUSY_TIMEOUT = 30
+
+
+class SqlitePersistentImageManager(PersistentImageManager):
+    """
+    Keeps image metadata in a SQLite database and image bodies in storage_path.
+
+    The database runs in WAL mode so that readers never wait on the writer, and every
+    thread gets its own connection.  Each image is one row: the full metadata as JSON plus
+    copies of the commonly queried keys in indexed columns.  Queries are narrowed with the
+    indexed columns and then checked against the full metadata, so any key can be queried.
+    """
+
+    storage_path = prop("_storage_path")
+
+    def __init__(self, storage_path=STORAGE_PATH, database=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        if not os.path.exists(storage_path):
+            self.log.debug("Creating directory (%s) for persistent storage" % (storage_path))
+            os.makedirs(storage_path)
+            os.chmod(storage_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+        elif not os.path.isdir(storage_path):
+            raise ImageFactoryException("Storage location (%s) already exists and is not a directory - cannot init persistence" % (storage_path))
+        self.storage_path = storage_path
+        self.database = database if database else os.path.join(storage_path, DATABASE_NAME)
+        self._local = threading.local()
+        if self._create_schema():
+            # A new database next to an existing file store picks up its images
+            imported = self.import_file_store(storage_path)
+            if imported:
+                self.log.info("Imported %d images from file store (%s)" % (imported, storage_path))
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if not connection:
+            connection = sqlite3.connect(self.database, timeout=BUSY_TIMEOUT)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Safe against application crashes in WAL mode - only a power loss can lose the last commits
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _create_schema(self):
+        # Returns True if the database did not exist before
+        connection = self._connection()
+        with connection:
+            exists = connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='images'").fetchone()
+            # Template and icicle are kept out of the images table so that status updates and
+            # queries never have to read or rewrite them
+            connection.execute('CREATE TABLE IF NOT EXISTS blobs (identifier TEXT, key TEXT, value TEXT NOT NULL, '
+                               'PRIMARY KEY (identifier, key))')
+            if not exists:
+                connection.execute('CREATE TABLE images (identifier TEXT PRIMARY KEY, %s, metadata TEXT NOT NULL)' %
+                                   (', '.join([ '%s TEXT' % (column) for column in INDEXED_COLUMNS ])))
+            present = [ row[1] for row in connection.execute('PRAGMA table_info(images)') ]
+            added = [ column for column in INDEXED_COLUMNS if column not in present ]
+            for column in added:
+                connection.execute('ALTER TABLE images ADD COLUMN %s TEXT' % (column))
+            if added:
+                # Existing rows only have the new columns in their JSON - fill them in so that
+                # queries answered from the columns still find those images
+                for identifier, metadata in connection.execute('SELECT identifier, metadata FROM images').fetchall():
+                    row = self._row_for_metadata(json.loads(metadata))
+                    values = [ row[1 + INDEXED_COLUMNS.index(column)] for column in added ]
+                    connection.execute('UPDATE images SET %s WHERE identifier = ?' % (', '.join([ '%s = ?' % (column) for column in added ])),
+                                       values + [ identifier ])
+            for column in TIME_COLUMNS:
+                if column not in present:
+                    connection.execute('ALTER TABLE images ADD COLUMN %s REAL' % (column))
+            for column in INDEXED_COLUMNS + TIME_COLUMNS:
+                connection.execute('CREATE INDEX IF NOT EXISTS images_%s ON images (%s)' % (column, column))
+        return not exists
+
+    def _row_for_metadata(self, metadata):
+        # Only strings go in the indexed columns - other values are matched against the JSON
+        row = [ metadata['identifier'] ]
+        for column in INDEXED_COLUMNS:
+            value = metadata.get(column)
+            row.append(value if isinstance(value, basestring) else None)
+        for column in TIME_COLUMNS:
+            value = metadata.get(column)
+            row.append(value if isinstance(value, (int, long, float)) else None)
+        row.append(json.dumps(metadata))
+        return row
+
+    def _insert_statement(self, verb='INSERT'):
+        return '%s INTO images (%s) VALUES (%s)' % (verb, ', '.join(COLUMNS), ', '.join([ '?' ] * len(COLUMNS)))
+
+    def _image_from_metadata(self, metadata):
+        # Given the retrieved metadata, return a PersistentImage type object
+        # with us as the persistent_manager.
+
+        image_module = __import__(metadata['type'], globals(), locals(), [metadata['type']], -1)
+        image_class = getattr(image_module, metadata['type'])
+        image = image_class(metadata['identifier'])
+
+        # We don't actually want a 'type' property in the resulting PersistentImage object
+        del metadata['type']
+
+        #set ourselves as the manager
+        image.persistent_manager = self
+
+        self._populate_image(image, metadata)
+
+        return image
+
+    def _save_blobs(self, connection, image_id, blobs):
+        # Runs inside the transaction that writes the metadata row
+        for key, value in blobs.items():
+            if value is None:
+                connection.execute('DELETE FROM blobs WHERE identifier = ? AND key = ?', (image_id, key))
+            else:
+                connection.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (image_id, key, json.dumps(value)))
+
+    def load_blob(self, image_id, key):
+        row = self._connection().execute('SELECT value FROM blobs WHERE identifier = ? AND key = ?',
+                                          (str(image_id), key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def image_with_id(self, image_id):
+        """
+        Retrieve a single image.
+
+        @param image_id The identifier of the image
+
+        @return The image or None if there is no image with that identifier
+        """
+        row = self._connection().execute('SELECT metadata FROM images WHERE identifier = ?', (image_id, )).fetchone()
+        if not row:
+            return None
+        return self._image_from_metadata(json.loads(row[0]))
+
+    def _where(self, query, ranges=None, after=None):
+        # Returns the SQL conditions for the parts of query and ranges that the columns can
+        # answer and whether they answer all of it
+        clauses = [ ]
+        arguments = [ ]
+        for key, value in query.items():
+            if key == 'identifier' or (key in INDEXED_COLUMNS and isinstance(value, basestring)):
+                clauses.append('%s = ?' % (key))
+                arguments.append(value)
+        answered = len(clauses)
+        for key, (since, until) in (ranges or { }).items():
+            if key not in TIME_COLUMNS:
+                continue
+            clauses.append('%s IS NOT NULL' % (key))
+            if since is not None:
+                clauses.append('%s >= ?' % (key))
+                arguments.append(since)
+            if until is not None:
+                clauses.append('%s < ?' % (key))
+                arguments.append(until)
+            answered += 1
+        if after:
+            clauses.append('identifier > ?')
+            arguments.append(after)
+        where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        return where, arguments, (answered == len(query) + len(ranges or { }))
+
+    def image_ids_from_query(self, query):
+        where, arguments, complete = self._where(query)
+        if not complete:
+            return super(SqlitePersistentImageManager, self).image_ids_from_query(query)
+        return [ row[0] for row in self._connection().execute('SELECT identifier FROM images' + where, arguments) ]
+
+    def _matches(self, metadata, query):
+        for querykey in query:
+            if (querykey not in metadata) or (metadata[querykey] != query[querykey]):
+                return False
+        return True
+
+    def images_from_query(self, query):
+        where, arguments, complete = self._where(query)
+        images = [ ]
+        for row in self._connection().execute('SELECT metadata FROM images' + where, arguments):
+            metadata = json.loads(row[0])
+            if self._matches(metadata, query):
+                images.append(self._image_from_metadata(metadata))
+        return images
+
+    def metadata_from_query(self, query, ranges=None, after=None, fields=None):
+        # Fetched in batches, each starting after the last identifier of the one before, so that
+        # no read transaction stays open while the caller works through the results
+        while True:
+            where, arguments, complete = self._where(query, ranges, after)
+            rows = self._connection().execute('SELECT identifier, metadata FROM images%s ORDER BY identifier LIMIT ?' % (where),
+                                              arguments + [ QUERY_BATCH_SIZE ]).fetchall()
+            for image_id, serialized in rows:
+                metadata = json.loads(serialized)
+                if complete or (self._matches(metadata, query) and self._in_ranges(metadata, ranges)):
+                    yield self._project(metadata, fields)
+            if len(rows) < QUERY_BATCH_SIZE:
+                return
+            after = rows[-1][0]
+
+    def child_image_ids(self, image_id):
+        if not image_id:
+            return [ ]
+        rows = self._connection().execute('SELECT identifier FROM images WHERE base_image_id = ? '
+                                          'UNION SELECT identifier FROM images WHERE target_image_id = ?',
+                                          (image_id, image_id))
+        return [ row[0] for row in rows ]
+
+    def add_image(self, image):
+        """
+        Add a PersistentImage-type object to this PersistentImageManager
+        This should only be called with an image that has not yet been added to the store.
+        To retrieve a previously persisted image use image_with_id() or images_from_query()
+
+        @param image The image to add
+        """
+        image.persistent_manager = self
+        body_path = self.storage_path + '/' + str(image.identifier) + BODY_EXT
+        image.data = body_path
+        try:
+            if not os.path.isfile(body_path):
+                open(body_path, 'w').close()
+                self.log.debug('Created file %s' % body_path)
+        except IOError as e:
+            self.log.debug('Exception caught: %s' % e)
+
+        image.modified = time.time()
+        meta = self._metadata_for_image(image)
+        blobs = image.dirty_blobs()
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute(self._insert_statement(), self._row_for_metadata(meta))
+                self._save_blobs(connection, str(image.identifier), blobs)
+        except sqlite3.IntegrityError:
+            raise ImageFactoryException("Image %s already managed, use image_with_id() and save_image()" % (image.identifier))
+        except Exception as e:
+            self.log.debug('Exception caught: %s' % e)
+            raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        image.blobs_saved(blobs)
+        self.log.debug("Added metadata for image (%s): %s" % (image.identifier, meta))
+
+    def save_image(self, image):
+        """
+        Persist the current metadata of an image that was previously added with add_image()
+
+        @param image The image to save
+        """
+        image_id = str(image.identifier)
+        image.modified = time.time()
+        meta = self._metadata_for_image(image)
+        row = self._row_for_metadata(meta)
+        # Only blobs set since the last save are written - a status update leaves them alone
+        blobs = image.dirty_blobs()
+        try:
+            connection = self._connection()
+            with connection:
+                cursor = connection.execute('UPDATE images SET %s WHERE identifier = ?' %
+                                            (', '.join([ '%s = ?' % (column) for column in COLUMNS[1:] ])),
+                                            row[1:] + [ image_id ])
+                updated = cursor.rowcount
+                if updated:
+                    self._save_blobs(connection, image_id, blobs)
+        except Exception as e:
+            self.log.debug('Exception caught: %s' % e)
+            raise ImageFactoryException('Unable to save image metadata: %s' % e)
+        if updated == 0:
+            raise ImageFactoryException('Image %s not managed, use "add_image()" first.' % image_id)
+        image.blobs_saved(blobs)
+        self.log.debug("Saved metadata for image (%s): %s" % (image_id, meta))
+
+    def delete_image_with_id(self, image_id):
+        """
+        Remove an image and its body from the store.
+
+        @param image_id The identifier of the image
+        """
+        body_path = self.storage_path + '/' + image_id + BODY_EXT
+        try:
+            connection = self._connection()
+            # Images imported from a file store keep the body path they had there
+            row = connection.execute('SELECT metadata FROM images WHERE identifier = ?', (image_id, )).fetchone()
+            if row:
+                body_path = json.loads(row[0]).get('data') or body_path
+            with connection:
+                connection.execute('DELETE FROM images WHERE identifier = ?', (image_id, ))
+                connection.execute('DELETE FROM blobs WHERE identifier = ?', (image_id, ))
+        except Exception as e:
+            self.log.warn('Unable to remove database record: %s' % e)
+        for path in (body_path, body_path + '.gz'):
+            try:
+                if os.path.isfile(path):
+                    os.remove(path)
+            except Exception as e:
+                self.log.warn('Unable to delete file: %s' % e)
+
+    def import_file_store(self, source_path):
+        """
+        Copy the metadata of every image in a FilePersistentImageManager store into the database.
+        Existing records with the same identifier are replaced.  Image bodies are not moved - an
+        imported image keeps the data path it had in the file store.
+
+        @param source_path The storage_path of the file store
+
+        @return The number of images imported
+        """
+        rows = [ ]
+        blob_rows = [ ]
+        # File stores may be flat, sharded or part way between the two
+        for directory in storage_directories(source_path):
+            for filename in os.listdir(directory):
+                if not filename.endswith(METADATA_EXT):
+                    continue
+                try:
+                    with open(os.path.join(directory, filename), 'r') as mdf:
+                        metadata = json.load(mdf)
+                    rows.append(self._row_for_metadata(metadata))
+                    for key in BLOB_METADATA:
+                        blob_path = os.path.join(directory, metadata['identifier'] + '.' + key)
+                        if os.path.isfile(blob_path):
+                            with open(blob_path, 'r') as blob_file:
+                                blob_rows.append((metadata['identifier'], key, blob_file.read()))
+                except Exception as e:
+                    self.log.warn("Could not import image metadata from file (%s): %s" % (filename, e))
+        connection = self._connection()
+        with connection:
+            connection.executemany(self._insert_statement('INSERT OR REPLACE'), rows)
+            connection.executemany('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', blob_rows)
+        return len(rows)
@@ -0,0 +1,273 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import errno
+import fcntl
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from ApplicationConfiguration import ApplicationConfiguration
+from ReservationBackend import ReservationBackend
+from LocalReservationBackend import LocalReservationBackend
+
+STORAGE_PATH = '/var/lib/imagefactory/storage'
+DATABASE_NAME = 'reservations.db'
+LOCK_EXT = '.lock'
+DEFAULT_LEASE_TTL = 60
+# Seconds between looks at a lock that is held or a queue that is full
+POLL_INTERVAL = 0.5
+BUSY_TIMEOUT = 30
+# Queues that guard something every host has its own of, such as its libvirt - their slots
+# are counted per host rather than across all of them
+HOST_QUEUES = ('local', )
+
+SCHEMA = ("CREATE TABLE IF NOT EXISTS holders (holder TEXT PRIMARY KEY, host TEXT, pid INTEGER, expires REAL)",
+          "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, holder TEXT)",
+          "CREATE TABLE IF NOT EXISTS shared_locks (name TEXT, holder TEXT)",
+          "CREATE INDEX IF NOT EXISTS shared_locks_name ON shared_locks (name)",
+          "CREATE TABLE IF NOT EXISTS slots (queue TEXT, holder TEXT)",
+          "CREATE INDEX IF NOT EXISTS slots_queue ON slots (queue)",
+          "CREATE TABLE IF NOT EXISTS reservations (filepath TEXT PRIMARY KEY, mount TEXT, size INTEGER, holder TEXT)",
+          "CREATE INDEX IF NOT EXISTS reservations_mount ON reservations (mount)",
+          "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+# Tables whose rows belong to a holder and go when its lease does
+HELD_TABLES = ('locks', 'shared_locks', 'slots', 'reservations')
+
+
+class SqliteReservationBackend(ReservationBackend):
+    """
+    Keeps queue slots, named locks, listen ports and disk reservations in a SQLite database
+    that every imagefactoryd sharing the image storage can reach, so that they neither overbook
+    the disk nor work on the same install media at once.
+
+    Everything held is a lease.  Each process renews its lease every third of lease_ttl
+    seconds from a background thread, and whatever a process holds is taken back once its lease
+    runs out, or at once when it ran on this host and is no longer running.  Every change is
+    made under an fcntl() lock on a file next to the database, which NFS passes on to its lock
+    manager, and the database uses a rollback journal rather than WAL, which needs shared memory.
+
+    Threads of this process wait on the in-memory locks and queues of a LocalReservationBackend
+    before they take a lease, so the database only sees one waiter from each process.
+    """
+
+    shared = True
+
+    def __init__(self, database=None, lease_ttl=DEFAULT_LEASE_TTL):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        if not database:
+            storage_path = ApplicationConfiguration().configuration.get('image_manager_args', { }).get('storage_path', STORAGE_PATH)
+            database = os.path.join(storage_path, DATABASE_NAME)
+        self.database = database
+        self.lease_ttl = float(lease_ttl)
+        self.local = LocalReservationBackend()
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.holder = '%s:%d:%s' % (self.host, self.pid, uuid.uuid4())
+        self._lock = threading.Lock()
+        self._lock_file = open(database + LOCK_EXT, 'a')
+        self._connection = sqlite3.connect(database, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        with self._transaction(expire=False) as cursor:
+            cursor.execute("PRAGMA journal_mode=DELETE")
+            for statement in SCHEMA:
+                cursor.execute(statement)
+        self._renew()
+        self._heartbeat = threading.Thread(target=self._work, name='reservation-lease')
+        self._heartbeat.setDaemon(True)
+        self._heartbeat.start()
+
+    @contextmanager
+    def _transaction(self, expire=True):
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX)
+            try:
+                cursor = self._connection.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    if expire:
+                        self._expire(cursor)
+                    yield cursor
+                except:
+                    cursor.execute("ROLLBACK")
+                    raise
+                cursor.execute("COMMIT")
+            finally:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _expire(self, cursor):
+        # Caller must be in a transaction
+        now = time.time()
+        for holder, host, pid, expires in cursor.execute("SELECT holder, host, pid, expires FROM holders").fetchall():
+            if holder == self.holder:
+                continue
+            if (expires < now) or ((host == self.host) and (pid != self.pid) and not self._alive(pid)):
+                self.log.info("Taking back the leases of (%s)" % (holder))
+                cursor.execute("DELETE FROM holders WHERE holder = ?", (holder, ))
+                for table in HELD_TABLES:
+                    cursor.execute("DELETE FROM %s WHERE holder = ?" % (table), (holder, ))
+
+    def _renew(self):
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE holders SET expires = ? WHERE holder = ?", (time.time() + self.lease_ttl, self.holder))
+            if cursor.rowcount == 0:
+                if hasattr(self, '_heartbeat'):
+                    self.log.error("Lease of (%s) ran out - other processes may have taken what it held" % (self.holder))
+                cursor.execute("INSERT INTO holders VALUES (?, ?, ?, ?)", (self.holder, self.host, self.pid, time.time() + self.lease_ttl))
+
+    def _work(self):
+        while True:
+            time.sleep(self.lease_ttl / 3)
+            try:
+                self._renew()
+            except Exception as e:
+                self.log.warning("Unable to renew lease of (%s): %s" % (self.holder, e))
+
+    def queues(self):
+        return self.local.queues()
+
+    def _queue_key(self, name):
+        return ('%s@%s' % (name, self.host)) if (name in HOST_QUEUES) else name
+
+    def queue_size(self, name):
+        return self.local.queue_size(name)
+
+    def add_queue(self, name, size):
+        return self.local.add_queue(name, size)
+
+    def enter_queue(self, name, client=None, count=1):
+        # Waiters of this process are ordered fairly - between processes it is first come, first served
+        self.local.enter_queue(name, client, count)
+        try:
+            key = self._queue_key(name)
+            size = self.local.queue_size(name)
+            count = min(count, size)
+            while True:
+                with self._transaction() as cursor:
+                    taken = cursor.execute("SELECT COUNT(*) FROM slots WHERE queue = ?", (key, )).fetchone()[0]
+                    if taken + count <= size:
+                        cursor.executemany("INSERT INTO slots VALUES (?, ?)", [ (key, self.holder) ] * count)
+                        return
+                time.sleep(POLL_INTERVAL)
+        except:
+            self.local.exit_queue(name, count)
+            raise
+
+    def exit_queue(self, name, count=1):
+        try:
+            with self._transaction() as cursor:
+                cursor.execute("DELETE FROM slots WHERE rowid IN (SELECT rowid FROM slots WHERE queue = ? AND holder = ? LIMIT ?)",
+                               (self._queue_key(name), self.holder, min(count, self.local.queue_size(name))))
+                if cursor.rowcount == 0:
+                    self.log.warn("Slot in queue (%s) was no longer held" % (name))
+        finally:
+            self.local.exit_queue(name, count)
+
+    def queue_stats(self):
+        stats = self.local.queue_stats()
+        with self._transaction() as cursor:
+            for key, taken in cursor.execute("SELECT queue, COUNT(*) FROM slots GROUP BY queue").fetchall():
+                name = key.split('@')[0]
+                if (name in stats) and (key == self._queue_key(name)):
+                    stats[name]['in_use_everywhere'] = taken
+        return stats
+
+    def _take_lock(self, cursor, name, shared):
+        # Caller must be in a transaction.  A lock is held exclusively by its row in locks or
+        # shared by its rows in shared_locks.
+        if cursor.execute("SELECT 1 FROM locks WHERE name = ?", (name, )).fetchone():
+            return False
+        if shared:
+            cursor.execute("INSERT INTO shared_locks VALUES (?, ?)", (name, self.holder))
+            return True
+        if cursor.execute("SELECT 1 FROM shared_locks WHERE name = ? LIMIT 1", (name, )).fetchone():
+            return False
+        cursor.execute("INSERT INTO locks VALUES (?, ?)", (name, self.holder))
+        return True
+
+    def acquire_lock(self, name, blocking=True, timeout=None, shared=False):
+        # Writers wait ahead of readers in this process - between processes it is first come, first served
+        deadline = (time.time() + timeout) if (timeout is not None) else None
+        if not self.local.acquire_lock(name, blocking, timeout, shared):
+            return False
+        try:
+            while True:
+                with self._transaction() as cursor:
+                    if self._take_lock(cursor, name, shared):
+                        return True
+                if (not blocking) or ((deadline is not None) and (time.time() + POLL_INTERVAL > deadline)):
+                    self.local.release_lock(name)
+                    return False
+                time.sleep(POLL_INTERVAL)
+        except:
+            self.local.release_lock(name)
+            raise
+
+    def release_lock(self, name):
+        try:
+            with self._transaction() as cursor:
+                cursor.execute("DELETE FROM locks WHERE name = ? AND holder = ?", (name, self.holder))
+                if cursor.rowcount == 0:
+                    cursor.execute("DELETE FROM shared_locks WHERE rowid IN (SELECT rowid FROM shared_locks WHERE name = ? AND holder = ? LIMIT 1)",
+                                   (name, self.holder))
+                if cursor.rowcount == 0:
+                    self.log.warn("Named lock (%s) was no longer held" % (name))
+        finally:
+            self.local.release_lock(name)
+
+    def lock_stats(self):
+        # Waits for a lock held by another process count as holding it locally
+        return self.local.lock_stats()
+
+    def lock_count(self):
+        return self.local.lock_count()
+
+    def next_listen_port(self, min_port, max_port):
+        # Ports are only handed out again on the host that listens on them
+        name = 'listen_port@%s' % (self.host)
+        with self._transaction() as cursor:
+            row = cursor.execute("SELECT value FROM counters WHERE name = ?", (name, )).fetchone()
+            port = (row[0] if row else min_port) + 1
+            if port > max_port:
+                port = min_port
+            cursor.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (name, port))
+            return port
+
+    def reservations(self, mount_path):
+        with self._transaction() as cursor:
+            return dict(cursor.execute("SELECT filepath, size FROM reservations WHERE mount = ?", (mount_path, )).fetchall())
+
+    def add_reservation(self, mount_path, filepath, size):
+        with self._transaction() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO reservations VALUES (?, ?, ?, ?)", (filepath, mount_path, size, self.holder))
+
+    def remove_reservation(self, filepath):
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM reservations WHERE filepath = ?", (filepath, ))
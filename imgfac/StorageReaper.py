@@ -0,0 +1,260 @@
+# encoding: utf-8
+
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import re
+import stat
+import threading
+import time
+from Singleton import Singleton
+from ApplicationConfiguration import ApplicationConfiguration
+from ReservationManager import ReservationManager
+from PersistentImageManager import PersistentImageManager
+from PersistentImage import BLOB_METADATA, TERMINAL_STATUSES
+
+DEFAULT_INTERVAL = 60
+DEFAULT_RETENTION = 86400
+# Files touched more recently than this may still be in use and are never removed
+GRACE_PERIOD = 600
+METADATA_EXT = '.meta'
+BODY_EXT = '.body'
+# Written next to an image body by conversions that rename the result over it when they finish
+TEMP_SUFFIXES = ('.tmp', '.tmp.qcow2', '.tmp.vmdk', '.flatten')
+# Compressed copies of image bodies, made for downloads and for EC2 EBS uploads
+GZIP_EXT = '.gz'
+COMPRESSED_MARKER = '-factory-compressed'
+# Storage file names are an image identifier followed by a suffix - temporary metadata files
+# have a leading dot.  Anything else in the directory, such as a database, is left alone.
+STORAGE_FILE = re.compile(r'^\.?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(\..+)$')
+
+ORPHAN = 'orphan'
+INTERMEDIATE = 'intermediate'
+
+def classify(suffix, status):
+    """
+    Decide what a file in the storage directory is for.
+
+    @param suffix The part of the file name after the image identifier
+    @param status The status of the image or None if there is no such image
+
+    @return ORPHAN for a leftover nothing will use again, INTERMEDIATE for a copy kept only to
+    save work later or None for a file that must be kept
+    """
+    if (suffix == METADATA_EXT) or (suffix[1:] in BLOB_METADATA):
+        return None
+    if status is None:
+        return ORPHAN
+    if suffix == BODY_EXT:
+        return ORPHAN if status == 'FAILED' else None
+    if suffix.endswith(TEMP_SUFFIXES):
+        # A build still running may yet rename it into place
+        return ORPHAN if status in TERMINAL_STATUSES else None
+    if suffix.endswith(GZIP_EXT) or suffix.endswith(COMPRESSED_MARKER):
+        if status == 'COMPLETE':
+            return INTERMEDIATE
+        return ORPHAN if status in TERMINAL_STATUSES else None
+    return None
+
+
+class StorageReaper(Singleton):
+    """
+    Frees disk in the image storage directory from a background thread.
+
+    Failed and deleted builds leave image bodies and the temporary and compressed files of the
+    plugins behind.  Each pass removes those orphans once they are older than storage_retention.
+    When the free space the ReservationManager accounts for on the storage filesystem is below
+    its min_free, orphans are removed regardless of age and then the compressed copies of
+    completed images and the entries of the BaseImageCache, least recently used first, until
+    the shortfall is made up.  A storage_reaper_interval of 0 turns the reaper off.
+    """
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        appconfig = ApplicationConfiguration().configuration
+        self.interval = float(appconfig.get('storage_reaper_interval', DEFAULT_INTERVAL))
+        self.retention = float(appconfig.get('storage_retention', DEFAULT_RETENTION))
+        self.cache_enabled = int(appconfig.get('base_image_cache_size', 0)) > 0
+        self.res_mgr = ReservationManager()
+        # Set on the first pass, so that creating the reaper never touches storage
+        self.pim = None
+        self._lock = threading.Lock()
+        self._worker = None
+        self.passes = 0
+        self.removed = 0
+        self.freed = 0
+
+    def start(self):
+        """
+        Start the thread that reaps every storage_reaper_interval seconds.
+        """
+        if (self.interval <= 0) or self._worker:
+            return
+        self._worker = threading.Thread(target=self._work, name='storage-reaper')
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def stats(self):
+        """
+        @return A dict of the number of passes made, files removed or truncated and bytes freed
+        """
+        return dict(passes=self.passes, removed=self.removed, freed=self.freed)
+
+    def _shortfall(self, path):
+        # Bytes that must be freed on the filesystem holding path to get back to its min_free
+        min_free = self.res_mgr.min_free_for_path(path)
+        self.res_mgr.add_path(path, min_free)
+        return min_free - self.res_mgr.available_space_for_path(path)
+
+    def _candidates(self, directories, statuses):
+        # Returns lists of (last used, path, allocated bytes, truncate) for orphans and intermediates, oldest first
+        now = time.time()
+        found = { ORPHAN: [ ], INTERMEDIATE: [ ] }
+        for directory in directories:
+            for filename in os.listdir(directory):
+                match = STORAGE_FILE.match(filename)
+                if not match:
+                    continue
+                if match.group(1) not in statuses:
+                    statuses[match.group(1)] = self._unlisted_status(directory, match.group(1))
+                status = statuses[match.group(1)]
+                kind = classify(match.group(2), status)
+                if not kind:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stats = os.lstat(path)
+                except OSError:
+                    continue
+                if (not stat.S_ISREG(stats.st_mode)) or (path.endswith(BODY_EXT) and (stats.st_size == 0)):
+                    continue
+                last_used = max(stats.st_atime, stats.st_mtime)
+                if now - last_used < GRACE_PERIOD:
+                    continue
+                # The bodies of failed images are emptied - the image still refers to them
+                truncate = (status is not None) and path.endswith(BODY_EXT)
+                found[kind].append((last_used, path, stats.st_blocks * 512, truncate))
+        for kind in found:
+            found[kind].sort()
+        return found[ORPHAN], found[INTERMEDIATE]
+
+    def _unlisted_status(self, directory, image_id):
+        # An image the query did not return may have been made by another process since - only
+        # files with no metadata next to them and no image behind them are orphans
+        try:
+            image = self.pim.image_with_id(image_id)
+        except Exception as e:
+            self.log.debug("Unable to look up image (%s): %s" % (image_id, e))
+            image = None
+        if image:
+            return image.status or ''
+        if os.path.exists(os.path.join(directory, image_id + METADATA_EXT)):
+            return ''
+        return None
+
+    def _remove(self, path, truncate):
+        # Returns False if the file could not be removed
+        try:
+            if truncate:
+                open(path, 'w').close()
+            elif path.endswith(GZIP_EXT):
+                # Holding the lock the EC2 plugin compresses under, and dropping the marker
+                # first, means a half removed copy is never taken for a complete one
+                self.res_mgr.get_named_lock(path)
+                try:
+                    if os.path.exists(path + COMPRESSED_MARKER):
+                        os.remove(path + COMPRESSED_MARKER)
+                    os.remove(path)
+                finally:
+                    self.res_mgr.release_named_lock(path)
+            else:
+                os.remove(path)
+        except (IOError, OSError) as e:
+            self.log.warn("Unable to remove (%s): %s" % (path, e))
+            return False
+        self.log.debug("Removed (%s)" % (path))
+        self.res_mgr.space_freed(path)
+        return True
+
+    def _evict_cached_base_images(self, storage_path, needed):
+        # Creating the BaseImageCache reads its directory - only do that when it is in use
+        if not self.cache_enabled:
+            return 0
+        from BaseImageCache import BaseImageCache
+        cache = BaseImageCache()
+        if os.stat(cache.cache_path).st_dev != os.stat(storage_path).st_dev:
+            # Evicting would not free anything where it is needed
+            return 0
+        freed = 0
+        while freed < needed:
+            size = cache.evict_lru()
+            if not size:
+                break
+            self.removed += 1
+            freed += size
+        return freed
+
+    def reap(self):
+        """
+        Make one pass over the storage directory.
+
+        @return The number of bytes freed
+        """
+        self._lock.acquire()
+        try:
+            if not self.pim:
+                self.pim = PersistentImageManager.default_manager()
+            storage_path = self.pim.storage_path
+            # None means there is no such image - an image yet to be given a status is kept
+            statuses = dict([ (metadata['identifier'], metadata.get('status') or '')
+                              for metadata in self.pim.metadata_from_query({ }, fields=[ 'status' ]) ])
+            orphans, intermediates = self._candidates(self.pim.storage_directories(), statuses)
+            shortfall = self._shortfall(storage_path)
+            if shortfall > 0:
+                self.log.info("Storage (%s) is %d bytes short of its minimum free space" % (storage_path, shortfall))
+            now = time.time()
+            freed = 0
+            for last_used, path, size, truncate in orphans:
+                if (freed >= shortfall) and (now - last_used < self.retention):
+                    # The rest are younger still
+                    break
+                if self._remove(path, truncate):
+                    self.removed += 1
+                    freed += size
+            for last_used, path, size, truncate in intermediates:
+                if freed >= shortfall:
+                    break
+                if self._remove(path, truncate):
+                    self.removed += 1
+                    freed += size
+            if freed < shortfall:
+                freed += self._evict_cached_base_images(storage_path, shortfall - freed)
+            if freed < shortfall:
+                self.log.warn("Storage (%s) is still %d bytes short of its minimum free space" % (storage_path, shortfall - freed))
+            self.passes += 1
+            self.freed += freed
+            return freed
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception as e:
+                self.log.warning("Storage reaper pass failed: %s" % (e))
@@ -18,19 +18,22 @@ from PersistentImage import PersistentImage
 from props import prop
 
 
-METADATA = ('base_image_id', 'target')
+METADATA = ('base_image_id', 'target', 'backing_image_id')
 
 class TargetImage(PersistentImage):
     """ TODO: Docstring for TargetImage  """
 
     base_image_id = prop("_base_image_id")
     target = prop("_target")
+    backing_image_id = prop("_backing_image_id")
     parameters = prop("_parameters")
 
     def __init__(self, image_id=None):
         super(TargetImage, self).__init__(image_id)
         self.base_image_id = None
         self.target = None
+        # Set while the body is a qcow2 overlay on the body of this image - see ImageOverlays
+        self.backing_image_id = None
 
     def metadata(self):
         self.log.debug("Executing metadata in class (%s) my metadata is (%s)" % (self.__class__, METADATA))
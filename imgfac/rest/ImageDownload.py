@@ -0,0 +1,261 @@
+#
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http:/www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+import tempfile
+import time
+import zlib
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ReservationManager import ReservationManager
+from imgfac.rest.bottle import request, HTTPResponse, HTTPError, parse_date
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Compressed copies of an image body are kept next to it with this extension
+GZIP_EXT = '.gz'
+# Made once a compressed copy is complete - the EC2 plugin writes the copy in place and marks it
+# the same way, both under the named lock for the path of the copy
+COMPRESSED_MARKER = '-factory-compressed'
+
+def _http_date(timestamp):
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp))
+
+def _etag(stats):
+    return '"%x-%x-%x"' % (stats.st_ino, stats.st_size, int(stats.st_mtime))
+
+def parse_range(header, size):
+    """
+    Parse a single byte range from a Range header.
+
+    @param header The value of the Range header
+    @param size Size in bytes of the entity
+
+    @return (start, end) with end exclusive, None if the header should be ignored or
+    False if the range cannot be satisfied
+    """
+    if not header or not header.strip().startswith('bytes='):
+        return None
+    ranges = header.strip()[len('bytes='):].split(',')
+    # Clients resuming or splitting a download ask for one range at a time - anything fancier
+    # gets the whole entity, which the RFC permits
+    if len(ranges) != 1:
+        return None
+    try:
+        first, last = [ value.strip() for value in ranges[0].split('-', 1) ]
+        if not first:
+            # Suffix range - the last N bytes
+            length = int(last)
+            if length <= 0:
+                return False
+            return (max(0, size - length), size)
+        start = int(first)
+        end = (int(last) + 1) if last else size
+    except ValueError:
+        return None
+    if (start >= size) or (end <= start):
+        return False
+    return (start, min(end, size))
+
+def _if_range_matches(etag, stats):
+    if_range = request.environ.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    since = parse_date(if_range)
+    return (since is not None) and (since >= int(stats.st_mtime))
+
+def _accepts_gzip():
+    for coding in request.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip() in ('gzip', 'x-gzip', '*'):
+            qvalue = [ part.strip() for part in parts[1:] if part.strip().startswith('q=') ]
+            if (not qvalue) or (float(qvalue[0][2:] or 0) > 0):
+                return True
+    return False
+
+def _file_iter(fileobj, offset, length):
+    try:
+        fileobj.seek(offset)
+        while length > 0:
+            chunk = fileobj.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
+
+def _gzip_iter(fileobj, cache_path):
+    # Compress on the fly and, if cache_path is given, keep the result for the next client
+    # Holes in sparse images compress to almost nothing, so they cost next to no bandwidth
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    res_mgr = ReservationManager()
+    cache_file = None
+    temp_path = None
+    if cache_path:
+        # Concurrent downloads of one image each write their own copy
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(cache_path), suffix='.tmp', dir=os.path.dirname(cache_path))
+            cache_file = os.fdopen(fd, 'wb')
+        except (IOError, OSError) as e:
+            log.debug("Not caching compressed image (%s): %s" % (cache_path, e))
+    if cache_file:
+        # The copy is never larger than the blocks the image has allocated, give or take the
+        # gzip framing - without room for that it is not kept
+        stats = os.fstat(fileobj.fileno())
+        if not res_mgr.reserve_space_for_file(min(stats.st_size, stats.st_blocks * 512) + CHUNK_SIZE, temp_path):
+            log.debug("Not caching compressed image (%s): not enough free space" % (cache_path))
+            cache_file.close()
+            os.remove(temp_path)
+            cache_file = None
+    complete = False
+    try:
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            compressed = compressor.compress(chunk)
+            if compressed:
+                if cache_file:
+                    cache_file.write(compressed)
+                yield compressed
+        compressed = compressor.flush()
+        if cache_file:
+            cache_file.write(compressed)
+        complete = True
+        yield compressed
+    finally:
+        fileobj.close()
+        if cache_file:
+            cache_file.close()
+            # The client may hang up part way through - only keep complete copies
+            if complete:
+                _store_compressed(temp_path, cache_path)
+            else:
+                os.remove(temp_path)
+            res_mgr.cancel_reservation_for_file(temp_path)
+
+def _store_compressed(temp_path, cache_path):
+    # The marker goes before the copy is replaced and comes back after, so a copy is only
+    # served while it is complete
+    res_mgr = ReservationManager()
+    res_mgr.get_named_lock(cache_path)
+    try:
+        if os.path.exists(cache_path + COMPRESSED_MARKER):
+            os.remove(cache_path + COMPRESSED_MARKER)
+        os.rename(temp_path, cache_path)
+        open(cache_path + COMPRESSED_MARKER, 'w').close()
+    except (IOError, OSError) as e:
+        log.debug("Not caching compressed image (%s): %s" % (cache_path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    finally:
+        res_mgr.release_named_lock(cache_path)
+
+def _compressed_copy_current(gzip_path, stats):
+    # A copy without its marker may still be being written
+    try:
+        return (os.stat(gzip_path + COMPRESSED_MARKER).st_mtime >= stats.st_mtime) and os.path.isfile(gzip_path)
+    except OSError:
+        return False
+
+def image_file_response(path, download_name):
+    """
+    Build the response for a raw image download.
+
+    Supports conditional requests (ETag, Last-Modified), single byte ranges with If-Range for
+    resuming or splitting downloads, and gzip content coding for clients that accept it.
+    An up to date compressed copy of the image is served if one exists and is marked complete.
+    Otherwise, when compress_raw_images is enabled, the image is compressed on the fly and the
+    result kept.
+    Ranges are always served from the uncompressed image unless a compressed copy already
+    exists, since an on the fly stream has no stable byte offsets.
+
+    @param path Path of the image body
+    @param download_name File name to suggest to the client
+
+    @return An HTTPResponse
+    """
+    if not os.path.isfile(path):
+        return HTTPError(404, "File does not exist.")
+    if not os.access(path, os.R_OK):
+        return HTTPError(403, "You do not have permission to access this file.")
+
+    stats = os.stat(path)
+    gzip_path = path + GZIP_EXT
+    compress = ApplicationConfiguration().configuration.get('compress_raw_images', False)
+    content_encoding = None
+    if _accepts_gzip():
+        if _compressed_copy_current(gzip_path, stats):
+            # Serve the stored compressed copy as the entity - it has its own validators and ranges
+            path = gzip_path
+            stats = os.stat(gzip_path)
+            content_encoding = 'gzip'
+        elif compress and not request.environ.get('HTTP_RANGE'):
+            content_encoding = 'gzip'
+
+    etag = _etag(stats)
+    if content_encoding and (path != gzip_path):
+        # A different representation of the same body - a strong validator must tell them apart
+        etag = etag[:-1] + '-gzip"'
+    header = { 'Content-Type': 'application/octet-stream',
+               'Content-Disposition': 'attachment; filename="%s"' % download_name,
+               'Last-Modified': _http_date(stats.st_mtime),
+               'ETag': etag,
+               'Vary': 'Accept-Encoding' }
+
+    if request.environ.get('HTTP_IF_NONE_MATCH') == etag:
+        return HTTPResponse(status=304, header=header)
+    ims = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+    if ims:
+        ims = parse_date(ims.split(";")[0].strip())
+        if ims is not None and ims >= int(stats.st_mtime):
+            return HTTPResponse(status=304, header=header)
+
+    if content_encoding and (path != gzip_path):
+        # Compressed on the fly - the length is not known up front
+        header['Content-Encoding'] = 'gzip'
+        if request.method == 'HEAD':
+            return HTTPResponse('', header=header)
+        log.debug("Compressing (%s) for download" % (path))
+        return HTTPResponse(_gzip_iter(open(path, 'rb'), gzip_path), header=header)
+
+    if content_encoding:
+        header['Content-Encoding'] = content_encoding
+    header['Accept-Ranges'] = 'bytes'
+    byte_range = parse_range(request.environ.get('HTTP_RANGE'), stats.st_size)
+    if byte_range is not None and not _if_range_matches(etag, stats):
+        # The client's partial copy is of an older version - start it over
+        byte_range = None
+    if byte_range is False:
+        header['Content-Range'] = 'bytes */%d' % (stats.st_size)
+        return HTTPResponse('', status=416, header=header)
+
+    if byte_range:
+        start, end = byte_range
+        header['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, stats.st_size)
+        header['Content-Length'] = end - start
+        body = '' if request.method == 'HEAD' else _file_iter(open(path, 'rb'), start, end - start)
+        return HTTPResponse(body, status=206, header=header)
+
+    header['Content-Length'] = stats.st_size
+    # A plain file object lets the server use wsgi.file_wrapper, and so sendfile(), if it can
+    body = '' if request.method == 'HEAD' else open(path, 'rb')
+    return HTTPResponse(body, header=header)
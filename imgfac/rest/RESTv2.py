@@ -20,12 +20,21 @@ sys.path.insert(1, '%s/imgfac/rest' % sys.path[0])
 
 import logging
 import os.path
+import json
 from bottle import *
 from imgfac.rest.RESTtools import *
 from imgfac.rest.OAuthTools import oauth_protect
+from imgfac.rest.ImageDownload import image_file_response
+from imgfac.ImageOverlays import flatten, ImageInUseException, ImageNotCompleteException
 from imgfac.BuildDispatcher import BuildDispatcher
+from imgfac.BuildWorkerPool import BuildQueueFullException
 from imgfac.PluginManager import PluginManager
+from imgfac.ReservationManager import ReservationManager
+from imgfac.InstallMediaPrefetcher import InstallMediaPrefetcher
 from imgfac.PersistentImageManager import PersistentImageManager
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.CallbackWorker import CallbackDeliveryService
+from imgfac.PersistenceQueue import PersistenceQueue
 from imgfac.Version import VERSION as VERSION
 from imgfac.picklingtools.xmldumper import *
 from imgfac.Builder import Builder
@@ -37,6 +46,11 @@ rest_api = Bottle(catchall=True)
 IMAGE_TYPES = {'BaseImage': 'base_image', 'TargetImage': 'target_image', 'ProviderImage': 'provider_image',
                'base_images': 'BaseImage', 'target_images': 'TargetImage', 'provider_images': 'ProviderImage'}
 
+# Query parameters that list_images() passes on as metadata the images must have
+LIST_FILTERS = ('status', 'target', 'provider')
+# Timestamp metadata that list_images() can select ranges of with <key>_since and <key>_until
+LIST_TIME_RANGES = ('created', 'modified')
+
 def converted_response(resp_dict):
     if('xml' in request.get_header('Accept', '')):
         response.set_header('Content-Type', request.get_header('Accept', None))
@@ -60,7 +74,7 @@ def api_info():
 @log_request
 @oauth_protect
 @check_accept_header
-def list_images(image_collection, base_image_id=None, target_image_id=None, list_url=None):
+def list_images(image_collection, base_image_id=None, target_image_id=None):
     try:
         _type = IMAGE_TYPES[image_collection]
         if _type:
@@ -72,22 +86,82 @@ def list_images(image_collection, base_image_id=None, target_image_id=None, list
         else:
             raise HTTPResponse(status=404, output='%s not found' % image_collection)
 
-        fetched_images = PersistentImageManager.default_manager().images_from_query(fetch_spec)
-        images = list()
-        _url = list_url if list_url else request.url
-        for image in fetched_images:
-            resp_item = {image_collection[0:-1]:
-                            {'_type':type(image).__name__,
-                            'id':image.identifier,
-                            'href':'%s/%s' % (_url, image.identifier)}
-                        }
-            images.append(resp_item)
-
-        return converted_response({image_collection:images})
+        for key in LIST_FILTERS:
+            if request.query.get(key):
+                fetch_spec[key] = request.query.get(key)
+        ranges = { }
+        for key in LIST_TIME_RANGES:
+            since = query_number(key + '_since', float)
+            until = query_number(key + '_until', float)
+            if (since is not None) or (until is not None):
+                ranges[key] = (since, until)
+        limit = query_number('limit', int)
+        if (limit is not None) and (limit < 1):
+            raise HTTPResponse(status=400, output='limit must be at least 1')
+        fields = [ field.strip() for field in request.query.get('fields', '').split(',') if field.strip() ]
+
+        results = PersistentImageManager.default_manager().metadata_from_query(fetch_spec, ranges=ranges,
+                                                                               after=request.query.get('cursor') or None,
+                                                                               fields=fields)
+        page = { }
+        entries = image_entries(image_collection, results, limit, request.url.split('?')[0], page)
+
+        if('xml' in request.get_header('Accept', '')):
+            resp_dict = {image_collection:list(entries)}
+            resp_dict.update(page)
+            return converted_response(resp_dict)
+        # JSON is written out as the images are read so that large lists never have to be held in memory
+        response.content_type = 'application/json'
+        return streamed_image_list(image_collection, entries, page)
+    except HTTPResponse:
+        raise
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
 
+def query_number(name, number_type):
+    value = request.query.get(name)
+    if not value:
+        return None
+    try:
+        return number_type(value)
+    except ValueError:
+        raise HTTPResponse(status=400, output='%s must be a number' % name)
+
+def image_links(image_collection, image_ids, list_url):
+    return list(image_entries(image_collection, [ {'identifier': image_id} for image_id in image_ids ], None, list_url, { }))
+
+def image_entries(image_collection, results, limit, list_url, page):
+    # Yields the list entry for each of the metadata dicts in results, up to limit of them
+    # If more results remain after that, page['next_cursor'] is set once the entries run out
+    _type = IMAGE_TYPES[image_collection]
+    count = 0
+    last_id = None
+    for metadata in results:
+        if (limit is not None) and (count == limit):
+            page['next_cursor'] = last_id
+            return
+        entry = {'_type':_type,
+                 'id':metadata['identifier'],
+                 'href':'%s/%s' % (list_url, metadata['identifier'])}
+        for key, value in metadata.items():
+            if key not in ('identifier', 'type'):
+                entry[key] = value
+        count += 1
+        last_id = metadata['identifier']
+        yield {image_collection[0:-1]: entry}
+
+def streamed_image_list(image_collection, entries, page):
+    yield '{"%s": [' % (image_collection)
+    separator = ''
+    for entry in entries:
+        yield separator + json.dumps(entry)
+        separator = ', '
+    yield ']'
+    if page:
+        yield ', "next_cursor": %s' % (json.dumps(page['next_cursor']))
+    yield '}'
+
 @rest_api.post('/imagefactory/<image_collection>')
 @rest_api.post('/imagefactory/base_images/<base_image_id>/<image_collection>')
 @rest_api.post('/imagefactory/base_images/<base_image_id>/target_images/<target_image_id>/<image_collection>')
@@ -107,6 +181,9 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
         if(not request_data):
             raise HTTPResponse(status=400, output='%s not found in request.' % image_type)
 
+        # Builds are shared fairly between OAuth clients
+        client = request.params.get('oauth_consumer_key')
+
         req_base_img_id = request_data.get('base_image_id')
         req_target_img_id = request_data.get('target_image_id')
         base_img_id = req_base_img_id if req_base_img_id else base_image_id
@@ -114,13 +191,15 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
 
         if(image_collection == 'base_images'):
             builder = BuildDispatcher().builder_for_base_image(template=request_data.get('template'),
-                                                               parameters=request_data.get('parameters'))
+                                                               parameters=request_data.get('parameters'),
+                                                               client=client)
             image = builder.base_image
         elif(image_collection == 'target_images'):
             builder = BuildDispatcher().builder_for_target_image(target=request_data.get('target'),
                                                                  image_id=base_img_id,
                                                                  template=request_data.get('template'),
-                                                                 parameters=request_data.get('parameters'))
+                                                                 parameters=request_data.get('parameters'),
+                                                                 client=client)
             image = builder.target_image
         elif(image_collection == 'provider_images'):
             _provider = request_data.get('provider')
@@ -132,7 +211,8 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
                                                                    target=_target,
                                                                    image_id=target_img_id,
                                                                    template=request_data.get('template'),
-                                                                   parameters=request_data.get('parameters'))
+                                                                   parameters=request_data.get('parameters'),
+                                                                   client=client)
                 image = builder.provider_image
             else:
                 _credentials = 'REDACTED' if _credentials else None
@@ -149,6 +229,9 @@ def create_image(image_collection, base_image_id=None, target_image_id=None):
 
         response.status = 202
         return converted_response({image_collection[0:-1]:_response})
+    except BuildQueueFullException as e:
+        log.warning(e)
+        raise HTTPResponse(status=503, output=str(e))
     except KeyError as e:
         log.exception(e)
         raise HTTPResponse(status=400, output='Missing value for key: %s' % e)
@@ -167,55 +250,54 @@ def image_with_id(collection_type, image_id, base_image_id=None, target_image_id
     try:
         img_class = IMAGE_TYPES[collection_type]
         if img_class:
-            fetch_spec = {'type': img_class, 'identifier': image_id}
-            try:
-                image = PersistentImageManager.default_manager().images_from_query(fetch_spec)[0]
-                _type = type(image).__name__
-                _response = {'_type': _type,
-                             'id': image.identifier,
-                             'href': request.url}
-                for key in image.metadata():
-                    if key not in ('identifier', 'data', 'base_image_id', 'target_image_id'):
-                        _response[key] = getattr(image, key, None)
-
-                api_url = '%s://%s/imagefactory' % (request.urlparts[0], request.urlparts[1])
-
-                if (_type == "BaseImage"):
-                    _objtype = 'base_image'
-                    _response['target_images'] = list_images('target_images',
-                                                             base_image_id=image.identifier,
-                                                             list_url='%s/target_images' % api_url)
-                elif (_type == "TargetImage"):
-                    _objtype = 'target_image'
-                    base_image_id = image.base_image_id
-                    if (base_image_id):
-                        base_image_href = '%s/base_images/%s' % (api_url, base_image_id)
-                        base_image_dict = {'_type': 'BaseImage', 'id': base_image_id, 'href': base_image_href}
-                        _response['base_image'] = base_image_dict
-                    else:
-                        _response['base_image'] = None
-                    _response['provider_images'] = list_images('provider_images',
-                                                               target_image_id=image.identifier,
-                                                               list_url='%s/provider_images' % api_url)
-                elif (_type == "ProviderImage"):
-                    _objtype = 'provider_image'
-                    target_image_id = image.target_image_id
-                    if (target_image_id):
-                        target_image_href = '%s/target_images/%s' % (api_url, target_image_id)
-                        target_image_dict = {'_type': 'TargetImage', 'id': target_image_id, 'href': target_image_href}
-                        _response['target_image'] = target_image_dict
-                    else:
-                        _response['target_image'] = None
+            pim = PersistentImageManager.default_manager()
+            image = pim.image_with_id(image_id)
+            if (not image) or (type(image).__name__ != img_class):
+                raise HTTPResponse(status=404, output='No %s found with id: %s' % (img_class, image_id))
+            _type = type(image).__name__
+            _response = {'_type': _type,
+                         'id': image.identifier,
+                         'href': request.url}
+            for key in image.metadata():
+                if key not in ('identifier', 'data', 'base_image_id', 'target_image_id'):
+                    _response[key] = getattr(image, key, None)
+
+            api_url = '%s://%s/imagefactory' % (request.urlparts[0], request.urlparts[1])
+
+            if (_type == "BaseImage"):
+                _objtype = 'base_image'
+                target_image_ids = pim.child_image_ids(image.identifier)
+                _response['target_images'] = {'target_images': image_links('target_images',
+                                                                           target_image_ids,
+                                                                           '%s/target_images' % api_url)}
+            elif (_type == "TargetImage"):
+                _objtype = 'target_image'
+                base_image_id = image.base_image_id
+                if (base_image_id):
+                    base_image_href = '%s/base_images/%s' % (api_url, base_image_id)
+                    base_image_dict = {'_type': 'BaseImage', 'id': base_image_id, 'href': base_image_href}
+                    _response['base_image'] = base_image_dict
                 else:
-                    log.error("Returning HTTP status 500 due to unknown image type: %s" % _type)
-                    raise HTTPResponse(status=500, output='Bad type for found object: %s' % _type)
-
-                response.status = 200
-                return converted_response({_objtype: _response})
+                    _response['base_image'] = None
+                provider_image_ids = pim.child_image_ids(image.identifier)
+                _response['provider_images'] = {'provider_images': image_links('provider_images',
+                                                                               provider_image_ids,
+                                                                               '%s/provider_images' % api_url)}
+            elif (_type == "ProviderImage"):
+                _objtype = 'provider_image'
+                target_image_id = image.target_image_id
+                if (target_image_id):
+                    target_image_href = '%s/target_images/%s' % (api_url, target_image_id)
+                    target_image_dict = {'_type': 'TargetImage', 'id': target_image_id, 'href': target_image_href}
+                    _response['target_image'] = target_image_dict
+                else:
+                    _response['target_image'] = None
+            else:
+                log.error("Returning HTTP status 500 due to unknown image type: %s" % _type)
+                raise HTTPResponse(status=500, output='Bad type for found object: %s' % _type)
 
-            except IndexError as e:
-                log.warning(e)
-                raise HTTPResponse(status=404, output='No %s found with id: %s' % (img_class, image_id))
+            response.status = 200
+            return converted_response({_objtype: _response})
         else:
             raise HTTPResponse(status=404, output='Unknown resource type: %s' % collection_type)
     except KeyError as e:
@@ -224,6 +306,8 @@ def image_with_id(collection_type, image_id, base_image_id=None, target_image_id
         else:
             log.exception(e)
             raise HTTPResponse(status=500, output=e)
+    except HTTPResponse as e:
+        raise e
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
@@ -242,8 +326,13 @@ def get_image_file(image_id, base_image_id=None, target_image_id=None, provider_
         image = PersistentImageManager.default_manager().image_with_id(image_id)
         if(not image):
             raise HTTPResponse(status=404, output='No image found with id: %s' % image_id)
-        path, filename = os.path.split(image.data)
-        return static_file(filename, path, download=True)
+        # Clients expect the same raw image they always got, not an overlay on some other image
+        flatten(image, require_complete=True)
+        return image_file_response(image.data, os.path.basename(image.data))
+    except HTTPResponse as e:
+        raise e
+    except ImageNotCompleteException as e:
+        raise HTTPResponse(status=409, output=str(e))
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
@@ -289,6 +378,10 @@ def delete_image_with_id(image_id, collection_type=None, base_image_id=None, tar
                 raise HTTPResponse(status=400, output='Missing required values:%s' % required_values)
             else:
                 builder.delete_image(provider=None, credentials=None, target=None, image_object=image, parameters=None)
+    except HTTPResponse:
+        raise
+    except ImageInUseException as e:
+        raise HTTPResponse(status=409, output=str(e))
     except Exception as e:
         log.exception(e)
         raise HTTPResponse(status=500, output=e)
@@ -320,6 +413,39 @@ def get_plugins(plugin_id=None):
         log.exception(e)
         raise HTTPResponse(status=500, output='%s %s' % (e, traceback.format_exc()))
 
+@rest_api.get('/imagefactory/build_queue')
+@log_request
+@oauth_protect
+@check_accept_header
+def get_build_queue():
+    try:
+        worker_pool = BuildDispatcher().worker_pool
+        response.status = 200
+        return converted_response({'build_queue': {'workers': worker_pool.max_workers,
+                                                   'max_queued': worker_pool.max_queued,
+                                                   'queues': BuildDispatcher().queue_depths(),
+                                                   'wait_times': BuildDispatcher().wait_times(),
+                                                   'resource_classes': ReservationManager().queue_stats(),
+                                                   'named_locks': ReservationManager().named_lock_stats(),
+                                                   'observers': NotificationCenter().observer_stats(),
+                                                   'callbacks': CallbackDeliveryService().stats(),
+                                                   'persistence': PersistenceQueue().stats()}})
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output='%s %s' % (e, traceback.format_exc()))
+
+@rest_api.get('/imagefactory/install_media')
+@log_request
+@oauth_protect
+@check_accept_header
+def get_install_media():
+    try:
+        response.status = 200
+        return converted_response({'install_media': InstallMediaPrefetcher().report()})
+    except Exception as e:
+        log.exception(e)
+        raise HTTPResponse(status=500, output='%s %s' % (e, traceback.format_exc()))
+
 @rest_api.get('/imagefactory/jeos')
 @log_request
 @check_accept_header
@@ -7,6 +7,7 @@ if 'IMGFAC_URL' in os.environ.keys():
 
 # actual utils code
 import json
+import hashlib
 import time
 import requests
 
@@ -103,6 +104,10 @@ def list_installed_packages(imageid):
   storage_path = imgfac_conf['image_manager_args']['storage_path']
   imgfile = imageid + ".body"
   imgfile_path = storage_path + "/" + imgfile
+  if not os.path.isfile(imgfile_path):
+    # Sharded file store
+    digest = hashlib.md5(imageid).hexdigest()
+    imgfile_path = "/".join([storage_path, digest[0:2], digest[2:4], imgfile])
   # Create the guestfs object, attach the disk image and launch the back-end
   g = guestfs.GuestFS()
   g.add_drive(imgfile_path)
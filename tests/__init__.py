@@ -12,3 +12,11 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+
+import os.path
+
+# imgfac/Version.py is generated by setup.py - give a source tree one so that the tests can run
+_version_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'imgfac', 'Version.py')
+if not os.path.exists(_version_py):
+    with open(_version_py, 'w') as version_file:
+        version_file.write('VERSION = "9999"')
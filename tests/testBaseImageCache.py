@@ -0,0 +1,151 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+from imgfac.BaseImageCache import BaseImageCache
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ReservationManager import ReservationManager
+
+BODY_SIZE = 8192
+
+
+class MockReservationManager(object):
+    def __init__(self, free):
+        self.free = free
+        self.reserved = { }
+
+    def reserve_space_for_file(self, size, filepath):
+        if sum(self.reserved.values()) + size > self.free:
+            return False
+        self.reserved[filepath] = size
+        return True
+
+    def cancel_reservation_for_file(self, filepath):
+        self.reserved.pop(filepath, None)
+
+    def space_freed(self, path):
+        pass
+
+
+class testBaseImageCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='imagefactory.unittest.BaseImageCache.')
+        self.app_config = ApplicationConfiguration().configuration
+        self.app_config['base_image_cache_size'] = 2 * BODY_SIZE
+        self.app_config['base_image_cache_path'] = os.path.join(self.tempdir, 'cache')
+        self.cache = self._cache()
+
+    def tearDown(self):
+        BaseImageCache._instance = None
+        self.app_config.pop('base_image_cache_size', None)
+        self.app_config.pop('base_image_cache_path', None)
+        shutil.rmtree(self.tempdir)
+
+    def _cache(self, free=100 * BODY_SIZE):
+        BaseImageCache._instance = None
+        cache = BaseImageCache()
+        cache.res_mgr = MockReservationManager(free)
+        cache._clone_file = shutil.copyfile
+        return cache
+
+    def _body(self, name):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as body:
+            body.write(name[0] * BODY_SIZE)
+        return path
+
+    def testStoreAndClone(self):
+        self.assertTrue(self.cache.store('fedora', self._body('fedora'), icicle='<icicle/>'))
+        destination = os.path.join(self.tempdir, 'clone')
+        entry = self.cache.clone_to('fedora', destination)
+        self.assertEqual(entry['icicle'], '<icicle/>')
+        self.assertEqual(entry['hits'], 1)
+        with open(destination) as clone:
+            self.assertEqual(clone.read(), 'f' * BODY_SIZE)
+        self.assertEqual(self.cache.clone_to('rhel', destination), None)
+        # Entries survive a restart
+        self.assertEqual(self._cache().clone_to('fedora', destination)['hits'], 2)
+
+    def testEntryNotHandedOutWhileStoring(self):
+        during = [ ]
+        def copy(source, destination):
+            during.append(self.cache.clone_to('fedora', os.path.join(self.tempdir, 'clone')))
+            shutil.copyfile(source, destination)
+        self.cache._clone_file = copy
+        self.cache.store('fedora', self._body('fedora'))
+        self.assertEqual(during, [ None ])
+        self.assertEqual(self.cache.size, BODY_SIZE)
+
+    def testLeastRecentlyUsedEvicted(self):
+        self.cache.store('fedora', self._body('fedora'))
+        self.cache.store('rhel', self._body('rhel'))
+        self.cache.clone_to('fedora', os.path.join(self.tempdir, 'clone'))
+        self.cache.store('ubuntu', self._body('ubuntu'))
+        self.assertEqual(self.cache.clone_to('rhel', os.path.join(self.tempdir, 'clone')), None)
+        self.assertNotEqual(self.cache.clone_to('fedora', os.path.join(self.tempdir, 'clone')), None)
+        self.assertEqual(self.cache.evict_lru(), BODY_SIZE)
+        self.assertEqual(self.cache.size, BODY_SIZE)
+
+    def testFreeSpaceHonored(self):
+        self.cache.res_mgr = MockReservationManager(BODY_SIZE)
+        self.cache.store('fedora', self._body('fedora'))
+        self.cache.res_mgr.reserved['elsewhere'] = 1
+        # Entries are evicted for lack of free space as well as for the cap
+        self.assertFalse(self.cache.store('rhel', self._body('rhel')))
+        self.assertEqual(self.cache.clone_to('fedora', os.path.join(self.tempdir, 'clone')), None)
+        self.assertEqual(self.cache.size, 0)
+
+    def testFailedStoreLeavesNothing(self):
+        def fail(source, destination):
+            open(destination, 'w').close()
+            raise IOError("Disk full")
+        self.cache._clone_file = fail
+        self.assertFalse(self.cache.store('fedora', self._body('fedora')))
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(os.listdir(self.cache.cache_path), [ ])
+        self.assertEqual(self.cache.res_mgr.reserved, { })
+
+    def testEvictedSpaceSeenAtOnce(self):
+        # The mock above sees frees at once - the real ReservationManager samples the free space
+        large = 1 << 20
+        res_mgr = ReservationManager()
+        sample_ttl = res_mgr.sample_ttl
+        res_mgr.sample_ttl = 3600
+        res_mgr.add_path(self.tempdir)
+        try:
+            self.cache.res_mgr = res_mgr
+            self.cache.max_size = 100 * large
+            for name in ('fedora', 'rhel', 'ubuntu', 'centos'):
+                with open(os.path.join(self.tempdir, name), 'wb') as body:
+                    body.write(name[0] * large)
+            for name in ('fedora', 'rhel', 'ubuntu'):
+                self.assertTrue(self.cache.store(name, os.path.join(self.tempdir, name)))
+            # Leave room for half an entry - evicting one makes room for the next
+            res_mgr.space_freed(self.tempdir)
+            res_mgr._mounts[res_mgr._mount_for_path(self.tempdir)]['min_free'] = res_mgr.available_space_for_path(self.tempdir) - large / 2
+            self.assertTrue(self.cache.store('centos', os.path.join(self.tempdir, 'centos')))
+            self.assertEqual(self.cache.size, 3 * large)
+            self.assertEqual(self.cache.clone_to('fedora', os.path.join(self.tempdir, 'clone')), None)
+            self.assertNotEqual(self.cache.clone_to('rhel', os.path.join(self.tempdir, 'clone')), None)
+        finally:
+            res_mgr.sample_ttl = sample_ttl
+            res_mgr.remove_path(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+from threading import Event, Thread
+from imgfac.BuildWorkerPool import BuildWorkerPool, BuildJob, BuildQueueFullException
+
+
+class testBuildWorkerPool(unittest.TestCase):
+    def setUp(self):
+        # Start from a fresh single worker pool so that ordering is deterministic
+        BuildWorkerPool._instance = None
+        self.pool = BuildWorkerPool()
+        self.pool.max_workers = 1
+        self.output = [ ]
+        self.release = Event()
+        self.blocker = BuildJob('blocker', 'base_image', self.release.wait)
+        self.pool.submit(self.blocker)
+        while self.blocker.state != 'RUNNING':
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.release.set()
+        BuildWorkerPool._instance = None
+        del self.pool
+
+    def _record(self, name):
+        self.output.append(name)
+
+    def _job(self, name, kind):
+        return BuildJob(name, kind, self._record, kwargs={'name': name})
+
+    def testPriorityOrder(self):
+        jobs = [ self._job('base', 'base_image'), self._job('target', 'target_image'), self._job('provider', 'provider_image') ]
+        for job in jobs:
+            self.pool.submit(job)
+        self.assertEqual(self.pool.queue_depths()['base_image']['queued'], 1)
+        self.release.set()
+        for job in jobs:
+            job.join(10)
+        self.assertEqual(self.output, ['provider', 'target', 'base'])
+
+    def testDependentJobHeld(self):
+        target_job = self._job('target', 'target_image')
+        self.pool.submit(target_job, depends_on=self.blocker)
+        self.assertEqual(self.pool.queue_depths()['target_image']['held'], 1)
+        self.assertTrue(target_job.isAlive())
+        self.release.set()
+        target_job.join(10)
+        self.assertFalse(target_job.isAlive())
+        self.assertEqual(self.output, ['target'])
+
+    def testJobForImage(self):
+        job = BuildJob('base', 'base_image', self._record, kwargs={'name': 'base'}, image_id='abc')
+        self.pool.submit(job)
+        self.assertEqual(id(self.pool.job_for_image('abc')), id(job))
+        self.release.set()
+        job.join(10)
+        self.assertEqual(self.pool.job_for_image('abc'), None)
+
+    def testFairOrderAcrossClients(self):
+        jobs = [ BuildJob(name, 'base_image', self._record, kwargs={'name': name}, client=name[0])
+                 for name in ('a1', 'a2', 'a3', 'b1') ]
+        for job in jobs:
+            self.pool.submit(job)
+        self.release.set()
+        for job in jobs:
+            job.join(10)
+        self.assertEqual(self.output, ['a1', 'b1', 'a2', 'a3'])
+        wait_times = self.pool.wait_times()
+        self.assertEqual(wait_times['entered'], 5)
+        self.assertEqual(wait_times['clients']['a']['entered'], 3)
+        self.assertTrue(wait_times['clients']['b']['wait_max'] > 0)
+
+    def testAdmissionControl(self):
+        self.pool.max_queued = 2
+        self.pool.submit(self._job('base', 'base_image'))
+        self.pool.check_admission(1)
+        self.assertRaises(BuildQueueFullException, self.pool.check_admission, 1)
+        # Jobs submitted without being admitted are checked as they are queued
+        refused = [ ]
+        def submit():
+            try:
+                self.pool.submit(self._job('other', 'base_image'))
+            except BuildQueueFullException:
+                refused.append(True)
+        other = Thread(target=submit)
+        other.start()
+        other.join(10)
+        self.assertEqual(refused, [ True ])
+        # The admitted job still gets in, and deletes always do
+        self.pool.submit(self._job('target', 'target_image'))
+        self.pool.submit(self._job('delete', 'delete'), limited=False)
+        self.assertRaises(BuildQueueFullException, self.pool.submit, self._job('provider', 'provider_image'))
+        self.assertEqual(self.pool.queued_count(), 3)
+
+    def testAdmissionReleased(self):
+        self.pool.max_queued = 2
+        self.pool.check_admission(2)
+        self.assertRaises(BuildQueueFullException, self.pool.check_admission, 1)
+        # A request that queued fewer jobs than it was admitted for gives the rest back
+        self.pool.submit(self._job('base', 'base_image'))
+        self.pool.release_admission()
+        self.pool.check_admission(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import json
+from threading import Thread, Event
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from imgfac.CallbackWorker import CallbackWorker, CallbackDeliveryService
+from imgfac.Notification import Notification
+from imgfac.BaseImage import BaseImage
+
+
+class CallbackServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        server.release.wait(5)
+        if server.failures > 0:
+            server.failures -= 1
+            status = 503
+        else:
+            server.received.append(body['base_image']['status'])
+            status = 204
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class testCallbackWorker(unittest.TestCase):
+    def setUp(self):
+        CallbackDeliveryService._instance = None
+        self.service = CallbackDeliveryService()
+        self.service.max_in_flight = 1
+        self.service.retry_delay = 0.05
+        self.server = CallbackServer(('127.0.0.1', 0), CallbackHandler)
+        self.server.received = [ ]
+        self.server.failures = 0
+        self.server.release = Event()
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.setDaemon(True)
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/callback' % (self.server.server_address[1])
+        self.worker = CallbackWorker(self.url)
+        self.image = BaseImage()
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        CallbackDeliveryService._instance = None
+
+    def _notify(self, status):
+        self.image._status = status
+        self.worker.status_notifier(Notification(message='image.status', sender=self.image,
+                                                 user_info=dict(old_status=None, new_status=status)))
+
+    def testSupersededUpdatesCoalesced(self):
+        self._notify('PENDING')
+        # The server holds the first PUT so that the rest pile up behind it
+        for status in ('BUILDING', 'FAILED', 'COMPLETE'):
+            self._notify(status)
+        self.server.release.set()
+        self.worker.shut_down(blocking=True)
+        self.assertEqual(self.server.received[-1], 'COMPLETE')
+        self.assertTrue(len(self.server.received) < 4)
+        self.assertTrue(self.service.stats()['coalesced'] > 0)
+
+    def testFailedDeliveryRetried(self):
+        self.server.failures = 2
+        self.server.release.set()
+        self._notify('COMPLETE')
+        self.worker.shut_down(blocking=True)
+        self.assertEqual(self.server.received, [ 'COMPLETE' ])
+        self.assertEqual(self.service.stats()['delivered'], 1)
+
+    def testGiveUpAfterRetries(self):
+        self.service.retries = 1
+        self.server.failures = 5
+        self.server.release.set()
+        self._notify('COMPLETE')
+        self.worker.shut_down(blocking=True)
+        self.assertEqual(self.server.received, [ ])
+        self.assertEqual(self.service.stats()['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from threading import Thread
+from imgfac.CompletionRegistry import CompletionRegistry
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.BaseImage import BaseImage
+
+
+class testCompletionRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = CompletionRegistry()
+
+    def tearDown(self):
+        # Leave the shared NotificationCenter as we found it
+        NotificationCenter().remove_observer(self.registry, 'handle_state_change', 'image.status')
+        CompletionRegistry._instance = None
+        del self.registry
+
+    def testSingleton(self):
+        self.assertEqual(id(self.registry), id(CompletionRegistry()))
+
+    def testFutureSetOnTerminalStatus(self):
+        image = BaseImage()
+        future = self.registry.future_for_image(image.identifier)
+        try:
+            image.status = 'BUILDING'
+            self.assertFalse(future.done())
+            self.assertEqual(id(self.registry.live_image(image.identifier)), id(image))
+            image.status = 'COMPLETE'
+            self.assertTrue(future.done())
+            self.assertEqual(id(future.image), id(image))
+        finally:
+            self.registry.discard_future(future)
+
+    def testWaiterWokenFromOtherThread(self):
+        image = BaseImage()
+        future = self.registry.future_for_image(image.identifier)
+        builder_thread = Thread(target=setattr, args=(image, 'status', 'FAILED'))
+        try:
+            builder_thread.start()
+            self.assertTrue(future.wait(10))
+            self.assertEqual(future.image.status, 'FAILED')
+        finally:
+            builder_thread.join()
+            self.registry.discard_future(future)
+
+    def testDiscardedFutureNotSet(self):
+        image = BaseImage()
+        future = self.registry.future_for_image(image.identifier)
+        self.registry.discard_future(future)
+        image.status = 'COMPLETE'
+        self.assertFalse(future.done())
+        self.assertFalse(future.wait(0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
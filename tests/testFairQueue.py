@@ -0,0 +1,83 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+from threading import Thread
+from imgfac.FairQueue import FairQueue, FairTags
+
+
+class testFairQueue(unittest.TestCase):
+    def testTagsFollowWeights(self):
+        tags = FairTags({'heavy': 2})
+        order = sorted([ (tags.stamp(client), client) for client in ['light'] * 4 + ['heavy'] * 4 ])
+        # Heavy gets two turns for each of light's
+        self.assertEqual([ client for finish, client in order[0:6] ],
+                         ['heavy', 'heavy', 'light', 'heavy', 'heavy', 'light'])
+
+    def testIdleClientStartsFromVirtualTime(self):
+        tags = FairTags()
+        for i in range(10):
+            tags.served(tags.stamp('busy'))
+        # A client that was idle gets no credit for it - it queues behind the next busy job
+        self.assertEqual(tags.stamp('idle'), tags.stamp('busy'))
+
+    def _waiter(self, queue, client, output):
+        queue.enter(client)
+        output.append(client)
+        queue.exit()
+
+    def testSlotsHandedOutFairly(self):
+        queue = FairQueue('test', 1)
+        queue.enter('a')
+        output = [ ]
+        waiters = [ ]
+        for client in ('a', 'a', 'a', 'b'):
+            waiter = Thread(target=self._waiter, args=(queue, client, output))
+            waiter.start()
+            waiters.append(waiter)
+            # Queue them in this order
+            while queue.report()['waiting'] < len(waiters):
+                time.sleep(0.01)
+        queue.exit()
+        for waiter in waiters:
+            waiter.join(10)
+        self.assertEqual(output, ['a', 'b', 'a', 'a'])
+        report = queue.report()
+        self.assertEqual((report['in_use'], report['waiting'], report['entered']), (0, 0, 5))
+        self.assertEqual(report['clients']['a']['entered'], 4)
+        self.assertTrue(report['clients']['b']['wait_max'] > 0)
+
+    def testLargeRequestNotStarved(self):
+        queue = FairQueue('test', 2)
+        queue.enter('a')
+        output = [ ]
+        big = Thread(target=lambda: (queue.enter('b', 2), output.append('b'), queue.exit(2)))
+        big.start()
+        while queue.report()['waiting'] < 1:
+            time.sleep(0.01)
+        small = Thread(target=lambda: (queue.enter('b'), output.append('small'), queue.exit()))
+        small.start()
+        while queue.report()['waiting'] < 2:
+            time.sleep(0.01)
+        # There is a free slot, but the small request waits behind the big one
+        self.assertEqual(output, [ ])
+        queue.exit()
+        big.join(10)
+        small.join(10)
+        self.assertEqual(output, ['b', 'small'])
+
+
+if __name__ == '__main__':
+    unittest.main()
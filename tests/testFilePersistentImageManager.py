@@ -0,0 +1,343 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import logging
+import tempfile
+import shutil
+import os
+import json
+from threading import Thread
+from imgfac.FilePersistentImageManager import FilePersistentImageManager, shard_directory
+from imgfac.BaseImage import BaseImage
+from imgfac.TargetImage import TargetImage
+
+
+class testFilePersistentImageManager(unittest.TestCase):
+    """ TODO: Docstring for testFilePersistentImageManager  """
+
+    def __init__(self, methodName='runTest'):
+        super(testFilePersistentImageManager, self).__init__(methodName)
+        logging.basicConfig(level=logging.NOTSET,
+                            format='%(asctime)s \
+                                    %(levelname)s \
+                                    %(name)s \
+                                    pid(%(process)d) \
+                                    Message: %(message)s',
+                            filename='/tmp/imagefactory-unittests.log')
+
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp(prefix='imagefactory.unittest.FilePIM.')
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path)
+
+    def tearDown(self):
+        del self.pim
+        shutil.rmtree(self.storage_path)
+
+    def _path(self, image, ext):
+        return os.path.join(shard_directory(self.storage_path, image.identifier), image.identifier + ext)
+
+    def _add_images(self):
+        base_image = BaseImage()
+        self.pim.add_image(base_image)
+        target_images = [ ]
+        for target in ('mock', 'ec2'):
+            target_image = TargetImage()
+            target_image.target = target
+            target_image.base_image_id = base_image.identifier
+            self.pim.add_image(target_image)
+            target_images.append(target_image)
+        return base_image, target_images
+
+    def testQueryIndexedKeys(self):
+        base_image, target_images = self._add_images()
+        self.assertEqual(len(self.pim.images_from_query({'type': 'BaseImage'})), 1)
+        self.assertEqual(len(self.pim.images_from_query({'type': 'TargetImage'})), 2)
+        found = self.pim.images_from_query({'type': 'TargetImage', 'base_image_id': base_image.identifier})
+        self.assertEqual(set([ image.identifier for image in found ]),
+                         set([ image.identifier for image in target_images ]))
+        found = self.pim.images_from_query({'type': 'TargetImage', 'target': 'ec2'})
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].identifier, target_images[1].identifier)
+        found = self.pim.images_from_query({'identifier': base_image.identifier})
+        self.assertEqual(found[0].identifier, base_image.identifier)
+        self.assertEqual(len(self.pim.images_from_query({'type': 'ProviderImage'})), 0)
+        self.assertEqual(set(self.pim.image_ids_from_query({'type': 'TargetImage', 'base_image_id': base_image.identifier})),
+                         set([ image.identifier for image in target_images ]))
+
+    def testQueryTracksSaveAndDelete(self):
+        base_image, target_images = self._add_images()
+        base_image.status = 'BUILDING'
+        self.pim.save_image(base_image)
+        self.assertEqual(len(self.pim.images_from_query({'status': 'NEW'})), 2)
+        self.assertEqual(len(self.pim.images_from_query({'status': 'BUILDING'})), 1)
+        self.pim.delete_image_with_id(target_images[0].identifier)
+        self.assertEqual(len(self.pim.images_from_query({'type': 'TargetImage'})), 1)
+
+    def testQueryResultsAreIndependentCopies(self):
+        base_image, target_images = self._add_images()
+        found = self.pim.images_from_query({'identifier': base_image.identifier})[0]
+        found.status_detail['activity'] = 'Modified but never saved'
+        found = self.pim.images_from_query({'identifier': base_image.identifier})[0]
+        self.assertNotEqual(found.status_detail['activity'], 'Modified but never saved')
+
+    def testChildImageIds(self):
+        base_image, target_images = self._add_images()
+        self.assertEqual(set(self.pim.child_image_ids(base_image.identifier)),
+                         set([ image.identifier for image in target_images ]))
+        self.assertEqual(self.pim.child_image_ids(target_images[0].identifier), [ ])
+        self.pim.delete_image_with_id(target_images[0].identifier)
+        self.assertEqual(self.pim.child_image_ids(base_image.identifier), [ target_images[1].identifier ])
+
+    def testIndexRebuiltAtStartup(self):
+        base_image, target_images = self._add_images()
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        self.assertEqual(len(pim.images_from_query({'type': 'TargetImage', 'base_image_id': base_image.identifier})), 2)
+
+    def testSaveLeavesCompleteMetadata(self):
+        base_image, target_images = self._add_images()
+
+        def save_repeatedly(image):
+            for i in range(20):
+                image.percent_complete = i
+                self.pim.save_image(image)
+        threads = [ Thread(target=save_repeatedly, args=(image, )) for image in [ base_image ] + target_images ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for directory in self.pim.storage_directories():
+            self.assertEqual([ filename for filename in os.listdir(directory) if filename.endswith('.tmp') ], [ ])
+        for image in [ base_image ] + target_images:
+            with open(self._path(image, '.meta')) as mdf:
+                self.assertEqual(json.load(mdf)['percent_complete'], 19)
+
+    def testIncompleteWriteDiscardedAtStartup(self):
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path, journal=False)
+        base_image, target_images = self._add_images()
+        temp_path = os.path.join(self.storage_path, '.%s.tmp' % (base_image.identifier))
+        with open(temp_path, 'w') as tmpf:
+            tmpf.write('{"identifier": "trunc')
+        pim = FilePersistentImageManager(storage_path=self.storage_path, journal=False)
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertEqual(pim.image_with_id(base_image.identifier).identifier, base_image.identifier)
+
+    def testBlobsStoredSeparately(self):
+        base_image = BaseImage()
+        base_image.template = '<template><name>blob</name></template>'
+        self.pim.add_image(base_image)
+        with open(self._path(base_image, '.meta')) as mdf:
+            self.assertFalse('template' in json.load(mdf))
+        blob_path = self._path(base_image, '.template')
+        blob_mtime = int(os.stat(blob_path).st_mtime)
+        os.utime(blob_path, (blob_mtime - 100, blob_mtime - 100))
+        # A status update does not rewrite the blob
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        self.assertEqual(os.stat(blob_path).st_mtime, blob_mtime - 100)
+        # Loaded on first use
+        loaded = FilePersistentImageManager(storage_path=self.storage_path).image_with_id(base_image.identifier)
+        self.assertTrue('template' in loaded._unloaded_blobs)
+        self.assertEqual(loaded.template, base_image.template)
+        self.assertEqual(loaded.icicle, None)
+        self.pim.delete_image_with_id(base_image.identifier)
+        self.assertFalse(os.path.exists(blob_path))
+
+    def testInlineBlobsMovedOnSave(self):
+        # A store written before there was a journal
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path, journal=False)
+        base_image = BaseImage()
+        self.pim.add_image(base_image)
+        meta_path = self._path(base_image, '.meta')
+        with open(meta_path) as mdf:
+            metadata = json.load(mdf)
+        # As written before template and icicle were stored apart
+        metadata['template'] = '<template/>'
+        with open(meta_path, 'w') as mdf:
+            json.dump(metadata, mdf)
+        for filename in os.listdir(self.storage_path):
+            if filename.startswith('metadata.'):
+                os.remove(os.path.join(self.storage_path, filename))
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        image = pim.image_with_id(base_image.identifier)
+        self.assertEqual(image.template, '<template/>')
+        pim.save_image(image)
+        with open(meta_path) as mdf:
+            self.assertFalse('template' in json.load(mdf))
+        self.assertEqual(pim.image_with_id(base_image.identifier).template, '<template/>')
+
+    def testMetadataFromQueryPages(self):
+        base_image, target_images = self._add_images()
+        ordered_ids = sorted([ image.identifier for image in target_images ])
+        results = self.pim.metadata_from_query({'type': 'TargetImage'}, fields=[ 'target', 'template' ])
+        first = results.next()
+        self.assertEqual(first['identifier'], ordered_ids[0])
+        self.assertEqual(set(first.keys()), set([ 'identifier', 'type', 'target', 'template' ]))
+        rest = list(self.pim.metadata_from_query({'type': 'TargetImage'}, after=first['identifier'], fields=[ ]))
+        self.assertEqual([ metadata['identifier'] for metadata in rest ], ordered_ids[1:])
+        found = list(self.pim.metadata_from_query({'type': 'TargetImage', 'target': 'ec2'}))
+        self.assertEqual([ metadata['identifier'] for metadata in found ], [ target_images[1].identifier ])
+        self.assertEqual(found[0]['base_image_id'], base_image.identifier)
+
+    def testMetadataFromQueryRanges(self):
+        base_image, target_images = self._add_images()
+        since = self.pim.image_with_id(target_images[1].identifier).modified
+        target_images[0].status = 'COMPLETE'
+        self.pim.save_image(target_images[0])
+        found = list(self.pim.metadata_from_query({'type': 'TargetImage'}, ranges={'modified': (since, None)}))
+        self.assertTrue(target_images[0].identifier in [ metadata['identifier'] for metadata in found ])
+        self.assertEqual(list(self.pim.metadata_from_query({}, ranges={'created': (None, base_image.created)})), [ ])
+
+    def testShardedLayout(self):
+        base_image, target_images = self._add_images()
+        self.assertEqual(base_image.data, self._path(base_image, '.body'))
+        self.assertTrue(os.path.isfile(self._path(base_image, '.meta')))
+        self.assertEqual([ filename for filename in os.listdir(self.storage_path) if filename.endswith('.meta') ], [ ])
+        self.pim.delete_image_with_id(base_image.identifier)
+        self.assertFalse(os.path.exists(self._path(base_image, '.meta')))
+        self.assertFalse(os.path.exists(base_image.data))
+
+    def testDeleteWithFilesMissing(self):
+        base_image, target_images = self._add_images()
+        base_image.template = '<template/>'
+        self.pim.save_image(base_image)
+        for ext in ('.gz', '.gz-factory-compressed'):
+            open(base_image.data + ext, 'w').close()
+        os.remove(base_image.data)
+        os.remove(self._path(base_image, '.meta'))
+        self.pim.delete_image_with_id(base_image.identifier)
+        # The missing body and metadata do not keep the compressed copy and blobs around
+        self.assertEqual([ filename for filename in os.listdir(os.path.dirname(base_image.data))
+                           if filename.startswith(base_image.identifier) ], [ ])
+
+    def testMigrateToSharded(self):
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path, sharded=False)
+        base_image, target_images = self._add_images()
+        base_image.template = '<template/>'
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        flat_body = base_image.data
+        self.assertEqual(os.path.dirname(flat_body), self.storage_path)
+        # Not built on by anything that is still running
+        for target_image in target_images:
+            target_image.status = 'COMPLETE'
+            self.pim.save_image(target_image)
+        target_images[1].backing_image_id = target_images[0].identifier
+        self.pim.save_image(target_images[1])
+
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        self.assertEqual(pim.migrate_to_sharded(), {'moved': 3, 'bodies_left': 1})
+        self.assertEqual([ filename for filename in os.listdir(self.storage_path) if filename.endswith('.meta') ], [ ])
+        image = pim.image_with_id(base_image.identifier)
+        self.assertEqual(image.data, self._path(base_image, '.body'))
+        self.assertTrue(os.path.isfile(image.data))
+        self.assertFalse(os.path.exists(flat_body))
+        self.assertEqual(image.template, '<template/>')
+        # An overlay refers to the body of the image it is built on by its path
+        self.assertEqual(pim.image_with_id(target_images[0].identifier).data, target_images[0].data)
+        self.assertTrue(os.path.isfile(target_images[0].data))
+        # Flat layout stores are still read
+        self.assertEqual(len(FilePersistentImageManager(storage_path=self.storage_path).images_from_query({'type': 'TargetImage'})), 2)
+        self.assertEqual(pim.migrate_to_sharded(), {'moved': 0, 'bodies_left': 0})
+
+    def testMigrationResumedAfterInterruption(self):
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path, sharded=False)
+        images = [ ]
+        for i in range(2):
+            image = BaseImage()
+            self.pim.add_image(image)
+            image.status = 'COMPLETE'
+            self.pim.save_image(image)
+            images.append(image)
+        flat_bodies = [ image.data for image in images ]
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        # Dies after the body moved but before the move was recorded
+        record = pim._record
+        def interrupted(image_id, metadata):
+            raise IOError("Interrupted")
+        pim._record = interrupted
+        pim.migrate_to_sharded()
+        pim._record = record
+        self.assertTrue(os.path.isfile(self._path(images[0], '.body')))
+        # A move recorded by an earlier release that died before the body followed
+        os.rename(self._path(images[1], '.body'), flat_bodies[1])
+        metadata = pim._metadata_from_file(flat_bodies[1][:-len('.body')] + '.meta')
+        metadata['data'] = self._path(images[1], '.body')
+        pim._record(images[1].identifier, metadata)
+
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        self.assertEqual(pim.migrate_to_sharded(), {'moved': 2, 'bodies_left': 0})
+        for image, flat_body in zip(images, flat_bodies):
+            data = pim.image_with_id(image.identifier).data
+            self.assertEqual(data, self._path(image, '.body'))
+            self.assertTrue(os.path.isfile(data))
+            self.assertFalse(os.path.exists(flat_body))
+
+    def testJournalRecoversDamagedMetadataFiles(self):
+        base_image, target_images = self._add_images()
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        os.remove(self._path(target_images[0], '.meta'))
+        with open(self._path(base_image, '.meta'), 'w') as mdf:
+            mdf.write('{"identifier": "')
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        self.assertEqual(pim.image_with_id(base_image.identifier).status, 'COMPLETE')
+        self.assertEqual(pim.image_with_id(target_images[0].identifier).target, 'mock')
+        self.assertEqual(len(pim.images_from_query({'base_image_id': base_image.identifier})), 2)
+        # Saving puts the copy right
+        pim.save_image(pim.image_with_id(base_image.identifier))
+        with open(self._path(base_image, '.meta')) as mdf:
+            self.assertEqual(json.load(mdf)['status'], 'COMPLETE')
+
+    def testChangesSeenByOtherManagers(self):
+        base_image, target_images = self._add_images()
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        self.assertEqual(pim.image_with_id(base_image.identifier).status, 'COMPLETE')
+        self.pim.delete_image_with_id(target_images[0].identifier)
+        self.assertEqual(pim.image_with_id(target_images[0].identifier), None)
+
+    def testQueriesSeeOtherManagers(self):
+        pim = FilePersistentImageManager(storage_path=self.storage_path)
+        base_image, target_images = self._add_images()
+        self.assertEqual(len(pim.images_from_query({'base_image_id': base_image.identifier})), 2)
+        self.assertEqual(sorted(pim.child_image_ids(base_image.identifier)),
+                         sorted([ target_image.identifier for target_image in target_images ]))
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        self.assertEqual(pim.image_ids_from_query({'status': 'COMPLETE'}), [ base_image.identifier ])
+        self.pim.delete_image_with_id(target_images[0].identifier)
+        self.assertEqual(len(list(pim.metadata_from_query({'type': 'TargetImage'}))), 1)
+
+    def testQueriesSeeOtherManagersWithoutJournal(self):
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path, journal=False)
+        pim = FilePersistentImageManager(storage_path=self.storage_path, journal=False)
+        self.assertEqual(pim.image_ids_from_query({ }), [ ])
+        base_image, target_images = self._add_images()
+        # Scans are at most refresh_interval apart
+        self.assertEqual(pim.image_ids_from_query({ }), [ ])
+        pim.refresh_interval = 0
+        self.assertEqual(len(pim.images_from_query({'base_image_id': base_image.identifier})), 2)
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        self.assertEqual([ metadata['status'] for metadata in pim.metadata_from_query({'type': 'BaseImage'}, fields=[ 'status' ]) ],
+                         [ 'COMPLETE' ])
+        self.pim.delete_image_with_id(target_images[0].identifier)
+        self.assertEqual(pim.child_image_ids(base_image.identifier), [ target_images[1].identifier ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+import zlib
+from imgfac.rest.bottle import request
+from imgfac.rest.ImageDownload import image_file_response, parse_range
+from imgfac.ApplicationConfiguration import ApplicationConfiguration
+from imgfac.ReservationManager import ReservationManager
+
+
+class testImageDownload(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='imagefactory.unittest.ImageDownload.')
+        self.path = os.path.join(self.tempdir, 'image.body')
+        self.content = ''.join([ chr(i % 256) for i in range(10000) ])
+        with open(self.path, 'wb') as body:
+            body.write(self.content)
+        self.app_config = ApplicationConfiguration().configuration
+
+    def tearDown(self):
+        self.app_config.pop('compress_raw_images', None)
+        shutil.rmtree(self.tempdir)
+
+    def _response(self, **headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper()] = value
+        request.bind(environ)
+        return image_file_response(self.path, 'image.body')
+
+    def _body(self, response):
+        if hasattr(response.output, 'read'):
+            data = response.output.read()
+            response.output.close()
+            return data
+        return ''.join(response.output)
+
+    def testParseRange(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 100))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 1000))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 1000))
+        self.assertEqual(parse_range('bytes=990-2000', 1000), (990, 1000))
+        self.assertEqual(parse_range('bytes=1000-', 1000), False)
+        self.assertEqual(parse_range('bytes=0-1,5-6', 1000), None)
+        self.assertEqual(parse_range('items=0-1', 1000), None)
+        self.assertEqual(parse_range(None, 1000), None)
+
+    def testFullDownload(self):
+        response = self._response()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Content-Length'], str(len(self.content)))
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(self._body(response), self.content)
+
+    def testRangeDownload(self):
+        response = self._response(range='bytes=100-199')
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 100-199/%d' % len(self.content))
+        self.assertEqual(self._body(response), self.content[100:200])
+        response = self._response(range='bytes=20000-')
+        self.assertEqual(response.status, 416)
+
+    def testIfRange(self):
+        etag = self._response().headers['ETag']
+        response = self._response(range='bytes=100-199', if_range=etag)
+        self.assertEqual(response.status, 206)
+        response = self._response(range='bytes=100-199', if_range='"stale"')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self._body(response), self.content)
+
+    def testNotModified(self):
+        etag = self._response().headers['ETag']
+        self.assertEqual(self._response(if_none_match=etag).status, 304)
+
+    def testGzipCompressedAndCached(self):
+        self.app_config['compress_raw_images'] = True
+        response = self._response(accept_encoding='gzip')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        compressed = self._body(response)
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), self.content)
+        # The next client gets the stored copy, which supports ranges
+        response = self._response(accept_encoding='gzip', range='bytes=0-9')
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self._body(response), compressed[0:10])
+
+    def testGzipCopyServedOnlyWhenMarkedComplete(self):
+        # As the EC2 plugin leaves it part way through compressing for an upload
+        with open(self.path + '.gz', 'wb') as partial:
+            partial.write('\x1f\x8b')
+        response = self._response(accept_encoding='gzip')
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(self._body(response), self.content)
+        open(self.path + '.gz-factory-compressed', 'w').close()
+        response = self._response(accept_encoding='gzip')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self._body(response), '\x1f\x8b')
+
+    def testConcurrentGzipDownloads(self):
+        self.app_config['compress_raw_images'] = True
+        first = self._response(accept_encoding='gzip')
+        second = self._response(accept_encoding='gzip')
+        # Interleave the two streams - each writes its own temporary copy
+        first_chunk, second_chunk = first.output.next(), second.output.next()
+        compressed = first_chunk + ''.join(first.output)
+        self.assertEqual(second_chunk + ''.join(second.output), compressed)
+        with open(self.path + '.gz', 'rb') as cached:
+            self.assertEqual(cached.read(), compressed)
+        self.assertTrue(os.path.exists(self.path + '.gz-factory-compressed'))
+        self.assertEqual([ filename for filename in os.listdir(self.tempdir) if filename.endswith('.tmp') ], [ ])
+
+    def testGzipNotUsedUnlessAccepted(self):
+        self.app_config['compress_raw_images'] = True
+        response = self._response(accept_encoding='identity')
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(self._body(response), self.content)
+
+    def testGzipHasItsOwnETag(self):
+        self.app_config['compress_raw_images'] = True
+        etag = self._response().headers['ETag']
+        response = self._response(accept_encoding='gzip')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        # Neither representation validates the other
+        self.assertEqual(self._response(accept_encoding='gzip', if_none_match=etag).status, 200)
+        self.assertEqual(self._response(if_none_match=response.headers['ETag']).status, 200)
+        self._body(response)
+
+    def testGzipNotCachedWithoutSpace(self):
+        self.app_config['compress_raw_images'] = True
+        res_mgr = ReservationManager()
+        res_mgr.add_path(self.tempdir)
+        mount = res_mgr._mounts[res_mgr._mount_for_path(self.tempdir)]
+        min_free = mount['min_free']
+        mount['min_free'] = res_mgr.available_space_for_path(self.tempdir)
+        try:
+            response = self._response(accept_encoding='gzip')
+            self.assertEqual(zlib.decompress(self._body(response), 16 + zlib.MAX_WBITS), self.content)
+        finally:
+            mount['min_free'] = min_free
+        self.assertEqual(sorted(os.listdir(self.tempdir)), [ 'image.body' ])
+        self.assertEqual(mount['reservations'], { })
+
+
+if __name__ == '__main__':
+    unittest.main()
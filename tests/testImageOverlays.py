@@ -0,0 +1,137 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import json
+import tempfile
+import shutil
+from imgfac import ImageOverlays
+from imgfac.ImageOverlays import flatten, dependent_image_ids, ImageNotCompleteException, QCOW2_MAGIC
+from imgfac.ImageFactoryException import ImageFactoryException
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.TargetImage import TargetImage
+
+VIRTUAL_SIZE = 8192
+
+
+class MockReservationManager(object):
+    def __init__(self, free):
+        self.free = free
+        self.reserved = { }
+        self.locks = [ ]
+
+    def reserve_space_for_file(self, size, filepath):
+        if size > self.free:
+            return False
+        self.reserved[filepath] = size
+        return True
+
+    def cancel_reservation_for_file(self, filepath):
+        self.reserved.pop(filepath, None)
+
+    def get_named_lock(self, name):
+        self.locks.append(name)
+
+    def release_named_lock(self, name):
+        self.locks.remove(name)
+
+
+class MockPersistentImageManager(object):
+    def __init__(self):
+        self.saved = [ ]
+
+    def save_image(self, image):
+        self.saved.append(image.identifier)
+
+
+class MockImage(object):
+    def __init__(self, directory, status='COMPLETE'):
+        self.identifier = 'overlay'
+        self.status = status
+        self.backing_image_id = 'base'
+        self.data = os.path.join(directory, 'overlay.body')
+        self.persistent_manager = MockPersistentImageManager()
+        with open(self.data, 'wb') as body:
+            body.write(QCOW2_MAGIC + 'overlay')
+
+
+class testImageOverlays(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='imagefactory.unittest.ImageOverlays.')
+        self.res_mgr = MockReservationManager(10 * VIRTUAL_SIZE)
+        self.commands = [ ]
+        self._reservation_manager = ImageOverlays.ReservationManager
+        self._qemu_img = ImageOverlays._qemu_img
+        ImageOverlays.ReservationManager = lambda: self.res_mgr
+        ImageOverlays._qemu_img = self._mock_qemu_img
+
+    def tearDown(self):
+        ImageOverlays.ReservationManager = self._reservation_manager
+        ImageOverlays._qemu_img = self._qemu_img
+        shutil.rmtree(self.tempdir)
+
+    def _mock_qemu_img(self, args):
+        self.commands.append(args[0])
+        if args[0] == 'info':
+            return json.dumps({'virtual-size': VIRTUAL_SIZE, 'format': 'qcow2'})
+        if args[0] == 'convert':
+            # The output must be written while its space is reserved
+            self.assertEqual(self.res_mgr.reserved, {args[-1]: VIRTUAL_SIZE})
+            with open(args[-1], 'wb') as raw:
+                raw.write('r' * VIRTUAL_SIZE)
+        return ''
+
+    def testFlatten(self):
+        image = MockImage(self.tempdir)
+        self.assertTrue(flatten(image, require_complete=True))
+        self.assertEqual(os.path.getsize(image.data), VIRTUAL_SIZE)
+        self.assertIsNone(image.backing_image_id)
+        self.assertEqual(image.persistent_manager.saved, [ 'overlay' ])
+        self.assertEqual((self.res_mgr.reserved, self.res_mgr.locks), ({ }, [ ]))
+        # Already standalone - nothing left to do
+        self.assertFalse(flatten(image))
+        self.assertEqual(self.commands, [ 'info', 'convert' ])
+
+    def testFlattenRefusedUntilComplete(self):
+        image = MockImage(self.tempdir, status='BUILDING')
+        self.assertRaises(ImageNotCompleteException, flatten, image, require_complete=True)
+        self.assertEqual(self.commands, [ ])
+        # Builders flatten the images they are building themselves
+        self.assertTrue(flatten(image))
+
+    def testFlattenWithoutSpace(self):
+        self.res_mgr.free = VIRTUAL_SIZE - 1
+        image = MockImage(self.tempdir)
+        self.assertRaises(ImageFactoryException, flatten, image)
+        self.assertEqual(self.commands, [ 'info' ])
+        self.assertEqual(image.backing_image_id, 'base')
+        self.assertFalse(os.path.exists(image.data + '.flatten'))
+        self.assertEqual(self.res_mgr.locks, [ ])
+
+    def testDependentImageIds(self):
+        pim = FilePersistentImageManager(storage_path=os.path.join(self.tempdir, 'storage'))
+        overlays = [ ]
+        for backing_image_id in ('base', 'base', None):
+            image = TargetImage()
+            image.backing_image_id = backing_image_id
+            pim.add_image(image)
+            overlays.append(image.identifier)
+        self.assertEqual(sorted(dependent_image_ids(pim, 'base')), sorted(overlays[0:2]))
+        self.assertEqual(dependent_image_ids(pim, 'other'), [ ])
+
+
+if __name__ == '__main__':
+    unittest.main()
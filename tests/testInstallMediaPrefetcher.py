@@ -0,0 +1,117 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+import json
+from imgfac.InstallMediaPrefetcher import InstallMediaPrefetcher
+
+
+class MockTemplate(object):
+    def __init__(self, xml):
+        if 'broken' in xml:
+            raise ValueError("Not a template")
+        self.xml = xml
+        self.os_name, self.os_version, self.os_arch = xml.split('-')[0:3]
+
+
+class MockPlugin(object):
+    def __init__(self):
+        self.prefetched = [ ]
+
+    def prefetch_install_media(self, template):
+        self.prefetched.append(template.xml)
+        InstallMediaPrefetcher().record(template.xml, template.xml, False, [ ], prefetch=True)
+
+
+class testInstallMediaPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='imagefactory.unittest.InstallMediaPrefetcher.')
+        InstallMediaPrefetcher._instance = None
+        self.prefetcher = InstallMediaPrefetcher()
+        self.prefetcher.history_path = os.path.join(self.directory, 'install_media_history.json')
+        self.prefetcher.entries = { }
+        self.prefetcher.hits = self.prefetcher.misses = 0
+        self.prefetcher.templates = [ ]
+        self.prefetcher._load_template = MockTemplate
+        self.plugin = MockPlugin()
+        self.prefetcher._plugin_for = lambda template: self.plugin
+
+    def tearDown(self):
+        InstallMediaPrefetcher._instance = None
+        shutil.rmtree(self.directory)
+
+    def testHitRates(self):
+        iso = os.path.join(self.directory, 'Fedora17x86_64-iso.iso')
+        with open(iso, 'w') as media:
+            media.write('x' * 1024)
+        self.prefetcher.record('Fedora-17-x86_64-iso', 'fedora', False, [ iso, iso + '-oz.iso' ])
+        for i in range(3):
+            self.prefetcher.record('Fedora-17-x86_64-iso', 'fedora', True, [ iso, iso + '-oz.iso' ])
+        self.prefetcher.record('RHEL-6-3-x86_64-url', 'rhel', True, [ ])
+        report = self.prefetcher.report()
+        self.assertEqual((report['hits'], report['misses'], report['hit_rate']), (4, 1, 0.8))
+        fedora = report['media']['Fedora-17-x86_64-iso']
+        self.assertEqual((fedora['hit_rate'], fedora['size']), (0.75, 1024))
+        self.assertEqual(report['media']['RHEL-6-3-x86_64-url']['size'], None)
+        self.assertFalse('template' in fedora)
+
+    def testHistoryKept(self):
+        self.prefetcher.record('Fedora-17-x86_64-iso', 'fedora', False, [ ])
+        history = self.prefetcher._load_history()
+        self.assertEqual(history['media']['Fedora-17-x86_64-iso']['misses'], 1)
+        self.assertEqual((history['hits'], history['misses']), (0, 1))
+
+    def testPrefetchConfiguredAndRecent(self):
+        self.prefetcher.templates = [ 'Fedora-18-x86_64', 'broken' ]
+        self.prefetcher.recent = 2
+        for name in ('Fedora-15-x86_64', 'Fedora-16-x86_64', 'Fedora-17-x86_64', 'Fedora-18-x86_64'):
+            self.prefetcher.record(name, name, True, [ ])
+        self.assertEqual(self.prefetcher.prefetch(), 1)
+        # The configured template was built recently as well - it is only prefetched once
+        self.assertEqual(self.plugin.prefetched, [ 'Fedora-18-x86_64', 'Fedora-17-x86_64' ])
+        # Templates neither configured nor among the most recent are forgotten
+        self.assertEqual(sorted(self.prefetcher.entries.keys()), [ 'Fedora-17-x86_64', 'Fedora-18-x86_64' ])
+        report = self.prefetcher.report()
+        self.assertEqual((report['passes'], report['failures']), (1, 1))
+        self.assertEqual(report['media']['Fedora-18-x86_64']['prefetched'], 1)
+        # Forgotten templates still count towards the overall hit rate
+        self.assertEqual((report['hits'], report['misses']), (4, 0))
+
+    def testBuiltDuringPassKept(self):
+        self.prefetcher.recent = 1
+        self.prefetcher.record('Fedora-16-x86_64', 'Fedora-16-x86_64', True, [ ])
+        self.prefetcher.record('Fedora-17-x86_64', 'Fedora-17-x86_64', True, [ ])
+        # A build that records its media while the pass is still running
+        prefetch = self.plugin.prefetch_install_media
+        def prefetch_install_media(template):
+            prefetch(template)
+            self.prefetcher.record('Fedora-15-x86_64', 'Fedora-15-x86_64', False, [ ])
+        self.plugin.prefetch_install_media = prefetch_install_media
+        self.prefetcher.prefetch()
+        self.assertEqual(sorted(self.prefetcher.entries.keys()), [ 'Fedora-15-x86_64', 'Fedora-17-x86_64' ])
+
+    def testHistoryOfEarlierReleases(self):
+        with open(self.prefetcher.history_path, 'w') as history:
+            json.dump({'Fedora-17-x86_64-iso': {'hits': 3, 'misses': 1}}, history)
+        history = self.prefetcher._load_history()
+        self.assertEqual((history['hits'], history['misses']), (3, 1))
+        self.assertEqual(history['media']['Fedora-17-x86_64-iso']['hits'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
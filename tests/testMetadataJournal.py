@@ -0,0 +1,106 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+from imgfac.MetadataJournal import MetadataJournal, JOURNAL_PREFIX, SNAPSHOT_PREFIX
+
+
+class Images(object):
+    """ The state a journal owner keeps """
+    def __init__(self, directory, snapshot_interval=1000):
+        self.images = { }
+        self.journal = MetadataJournal(directory, self.apply, self.reset, lambda: dict(self.images), snapshot_interval)
+        if not self.journal.load():
+            self.journal.snapshot()
+
+    def apply(self, image_id, metadata):
+        if metadata is None:
+            self.images.pop(image_id, None)
+        else:
+            self.images[image_id] = metadata
+
+    def reset(self):
+        self.images = { }
+
+
+class testMetadataJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='imagefactory.unittest.MetadataJournal.')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _files(self, prefix):
+        return sorted([ filename for filename in os.listdir(self.directory) if filename.startswith(prefix) ])
+
+    def testReplay(self):
+        owner = Images(self.directory)
+        for i in range(5):
+            owner.journal.append('image-%d' % i, {'status': 'NEW'})
+        owner.journal.append('image-1', {'status': 'COMPLETE'})
+        owner.journal.append('image-2', None)
+        self.assertEqual(Images(self.directory).images, owner.images)
+        self.assertEqual(Images(self.directory).images['image-1'], {'status': 'COMPLETE'})
+
+    def testIncompleteRecordDropped(self):
+        owner = Images(self.directory)
+        owner.journal.append('image-0', {'status': 'NEW'})
+        journal_path = os.path.join(self.directory, self._files(JOURNAL_PREFIX)[-1])
+        size = os.path.getsize(journal_path)
+        with open(journal_path, 'a') as journal:
+            journal.write('["image-1", {"sta')
+        recovered = Images(self.directory)
+        self.assertEqual(recovered.images, {'image-0': {'status': 'NEW'}})
+        self.assertEqual(os.path.getsize(journal_path), size)
+        recovered.journal.append('image-2', {'status': 'NEW'})
+        self.assertEqual(sorted(Images(self.directory).images.keys()), [ 'image-0', 'image-2' ])
+
+    def testSnapshots(self):
+        owner = Images(self.directory, snapshot_interval=3)
+        for i in range(10):
+            owner.journal.append('image-%d' % i, {'percent_complete': i})
+        # The current generation and the one before it
+        self.assertEqual(len(self._files(SNAPSHOT_PREFIX)), 2)
+        self.assertEqual(len(self._files(JOURNAL_PREFIX)), 2)
+        self.assertEqual(Images(self.directory).images, owner.images)
+
+    def testDamagedSnapshotFallsBack(self):
+        owner = Images(self.directory, snapshot_interval=3)
+        for i in range(4):
+            owner.journal.append('image-%d' % i, {'percent_complete': i})
+        with open(os.path.join(self.directory, self._files(SNAPSHOT_PREFIX)[-1]), 'w') as snapshot:
+            snapshot.write('{"image-0": ')
+        self.assertEqual(Images(self.directory).images, owner.images)
+
+    def testSharedBetweenProcesses(self):
+        first = Images(self.directory, snapshot_interval=3)
+        second = Images(self.directory, snapshot_interval=3)
+        first.journal.append('image-0', {'status': 'NEW'})
+        second.journal.refresh()
+        self.assertEqual(second.images, first.images)
+        # second misses several snapshots - it reloads from the newest
+        for i in range(10):
+            first.journal.append('image-0', {'percent_complete': i})
+        second.journal.append('image-1', {'status': 'NEW'})
+        first.journal.refresh()
+        self.assertEqual(second.images, first.images)
+        self.assertEqual(second.images['image-0'], {'percent_complete': 9})
+
+
+if __name__ == '__main__':
+    unittest.main()
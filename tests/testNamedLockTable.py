@@ -0,0 +1,109 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+import uuid
+from threading import Thread
+from imgfac.NamedLockTable import NamedLockTable, lock_class
+
+
+class testNamedLockTable(unittest.TestCase):
+    def setUp(self):
+        self.table = NamedLockTable()
+
+    def testIdleEntriesFreed(self):
+        for i in range(100):
+            name = 'flatten-%s' % (uuid.uuid4())
+            self.assertTrue(self.table.acquire(name))
+            self.table.release(name)
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.table.stats()['flatten-*']['acquired'], 100)
+
+    def testEntryKeptWhileWaitedFor(self):
+        self.table.acquire('media')
+        waiter = Thread(target=self.table.acquire, args=('media', ))
+        waiter.start()
+        time.sleep(0.2)
+        self.table.release('media')
+        waiter.join(10)
+        # The waiter holds it now
+        self.assertEqual(len(self.table), 1)
+        self.assertFalse(self.table.acquire('media', blocking=False))
+        self.table.release('media')
+        self.assertEqual(len(self.table), 0)
+        stats = self.table.stats()['media']
+        self.assertEqual((stats['acquired'], stats['contended'], stats['timeouts']), (2, 1, 1))
+        self.assertTrue(stats['wait_max'] >= 0.2)
+        self.assertTrue(stats['hold_max'] >= 0.2)
+
+    def testTimeout(self):
+        self.table.acquire('media')
+        started = time.time()
+        self.assertFalse(self.table.acquire('media', timeout=0.2))
+        self.assertTrue(time.time() - started >= 0.2)
+        self.table.release('media')
+        self.assertEqual(len(self.table), 0)
+        self.assertTrue(self.table.acquire('media', timeout=0.2))
+        self.table.release('media')
+
+    def testSharedHoldersRunTogether(self):
+        self.assertTrue(self.table.acquire('media', shared=True))
+        self.assertTrue(self.table.acquire('media', blocking=False, shared=True))
+        self.assertFalse(self.table.acquire('media', blocking=False))
+        self.table.release('media')
+        self.table.release('media')
+        self.assertTrue(self.table.acquire('media', blocking=False))
+        self.assertFalse(self.table.acquire('media', blocking=False, shared=True))
+        self.table.release('media')
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.table.stats()['media']['acquired'], 3)
+
+    def testWaitingWriterGoesFirst(self):
+        order = [ ]
+        self.table.acquire('media', shared=True)
+        writer = Thread(target=lambda: (self.table.acquire('media'), order.append('writer'), self.table.release('media')))
+        writer.start()
+        time.sleep(0.2)
+        # A new reader waits behind the writer rather than joining the reader holding the lock
+        reader = Thread(target=lambda: (self.table.acquire('media', shared=True), order.append('reader'), self.table.release('media')))
+        reader.start()
+        time.sleep(0.2)
+        self.assertEqual(order, [ ])
+        self.table.release('media')
+        writer.join(10)
+        reader.join(10)
+        self.assertEqual(order, [ 'writer', 'reader' ])
+        self.assertEqual(len(self.table), 0)
+
+    def testWriterTimeoutLetsReadersIn(self):
+        self.table.acquire('media', shared=True)
+        self.assertFalse(self.table.acquire('media', timeout=0.2))
+        self.assertTrue(self.table.acquire('media', blocking=False, shared=True))
+        self.table.release('media')
+        self.table.release('media')
+        self.assertEqual(len(self.table), 0)
+
+    def testReleaseUnheld(self):
+        self.assertRaises(ValueError, self.table.release, 'media')
+
+    def testLockClass(self):
+        image_id = str(uuid.uuid4())
+        self.assertEqual(lock_class('/var/lib/imagefactory/storage/3f/0a/%s.body.gz' % (image_id)),
+                         '/var/lib/imagefactory/storage/*/*/*.body.gz')
+        self.assertEqual(lock_class('Fedora-17-x86_64-url'), 'Fedora-17-x86_64-url')
+
+
+if __name__ == '__main__':
+    unittest.main()
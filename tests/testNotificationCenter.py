@@ -77,9 +77,57 @@ class testNotificationCenter(unittest.TestCase):
         self.assertNotEqual(o2.notification.message, 'test3')
         self.assertNotEqual(o3.notification.message, 'test3')
 
+    def testObserversFilteredBySender(self):
+        o1 = MockObserver()
+        o2 = MockObserver()
+        sender1 = object()
+        sender2 = object()
+        nc = self.notification_center
+        nc.add_observer(o1, 'receive', 'test', sender1)
+        nc.add_observer(o2, 'receive', 'test', sender2)
+        try:
+            nc.post_notification_with_info('test', sender2)
+            self.assertIsNone(o1.notification)
+            self.assertIs(o2.notification.sender, sender2)
+        finally:
+            nc.remove_observer(o1, 'receive', 'test', sender1)
+            nc.remove_observer(o2, 'receive', 'test', sender2)
+        self.assertEqual(len(nc.observers), 0)
+
+    def testAsynchronousDispatch(self):
+        o1 = MockObserver()
+        nc = self.notification_center
+        nc.add_observer(o1, 'receive_all', 'test')
+        nc.asynchronous = True
+        try:
+            for i in range(10):
+                nc.post_notification_with_info('test', self, dict(count=i))
+            self.assertTrue(nc.flush(5))
+            self.assertEqual([ notification.user_info['count'] for notification in o1.notifications ], range(10))
+        finally:
+            nc.asynchronous = False
+            nc.remove_observer(o1, 'receive_all', 'test')
+
+    def testObserverStats(self):
+        o1 = MockObserver()
+        nc = self.notification_center
+        nc.add_observer(o1, 'receive', 'stats_test')
+        try:
+            nc.post_notification_with_info('stats_test', self)
+            nc.post_notification_with_info('stats_test', self)
+        finally:
+            nc.remove_observer(o1, 'receive', 'stats_test')
+        stats = nc.observer_stats()['MockObserver.receive']
+        self.assertTrue(stats['calls'] >= 2)
+        self.assertTrue(stats['max_seconds'] >= stats['mean_seconds'])
+
 class MockObserver(object):
     def __init__(self):
         self.notification = None
+        self.notifications = [ ]
+
+    def receive_all(self, notification):
+        self.notifications.append(notification)
 
     def receive(self, notification):
         self.notification = notification
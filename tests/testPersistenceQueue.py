@@ -0,0 +1,90 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import time
+from threading import Lock
+from imgfac.PersistenceQueue import PersistenceQueue
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.BaseImage import BaseImage
+
+
+class MockPersistentImageManager(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.saves = [ ]
+        self.details = [ ]
+
+    def save_image(self, image):
+        with self.lock:
+            self.saves.append((image.status, image.percent_complete))
+            self.details.append(image.status_detail['activity'])
+
+
+class testPersistenceQueue(unittest.TestCase):
+    def setUp(self):
+        PersistenceQueue._instance = None
+        self.queue = PersistenceQueue()
+        self.queue.window = 0.2
+        self.pim = MockPersistentImageManager()
+        self.image = BaseImage()
+        self.image.persistent_manager = self.pim
+        self.queue.watch(self.image)
+
+    def tearDown(self):
+        self.queue.unwatch(self.image)
+        PersistenceQueue._instance = None
+
+    def testUpdatesCoalesced(self):
+        self.image.status = 'BUILDING'
+        for percent in range(1, 51):
+            self.image.percent_complete = percent
+        self.assertEqual(self.pim.saves, [ ])
+        time.sleep(0.5)
+        self.assertEqual(self.pim.saves, [ ('BUILDING', 50) ])
+        self.assertEqual(self.queue.stats()['coalesced'], 50)
+
+    def testFinalStatusSavedAtOnce(self):
+        self.image.status = 'BUILDING'
+        self.image.status = 'COMPLETE'
+        self.queue.save(self.image)
+        self.assertEqual(self.pim.saves, [ ('COMPLETE', 0) ])
+        self.assertEqual(self.queue.stats()['queued'], 0)
+        # No longer watched
+        self.assertFalse('image.status' in NotificationCenter().observers)
+        time.sleep(0.3)
+        self.assertEqual(len(self.pim.saves), 1)
+
+    def testFlush(self):
+        self.queue.window = 60
+        self.image.status = 'BUILDING'
+        self.queue.flush()
+        self.assertEqual(self.pim.saves, [ ('BUILDING', 0) ])
+        self.assertEqual(self.queue.stats()['queued'], 0)
+
+    def testSnapshotSaved(self):
+        self.image.status_detail = {'activity': 'Starting', 'error': None}
+        self.image.status = 'BUILDING'
+        self.image.status_detail['activity'] = 'Installing'
+        self.image.percent_complete = 10
+        # Changed in place after the last notification - not part of the queued save
+        self.image.status_detail['activity'] = 'Customizing'
+        self.image.status_detail['packages'] = 'kernel'
+        time.sleep(0.5)
+        self.assertEqual(self.pim.saves, [ ('BUILDING', 10) ])
+        self.assertEqual(self.pim.details, [ 'Installing' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
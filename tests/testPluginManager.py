@@ -17,6 +17,7 @@
 import unittest
 import logging
 from imgfac.PluginManager import PluginManager
+from imgfac.ReservationManager import ReservationManager
 import tempfile
 import json
 import os.path
@@ -34,7 +35,9 @@ INFO1 = {
                 "url":"baz1"
             },
             "version":"1.0",
-            "license":"NA"
+            "license":"NA",
+            "resource_classes": {"ifut-guestfs": 3},
+            "resources": {"base_image": {"local": 1, "ifut-guestfs": 1}}
         }
 INFO2 = {
             "type":"cloud",
@@ -109,6 +112,15 @@ class testPluginManager(unittest.TestCase):
         cloud_metadata = self.plugin_mgr.metadata_for_plugin(self.cloud_plugin_name)
         self.assertDictEqual(cloud_metadata, INFO2)
 
+    def testResourcesForPlugin(self):
+        self.assertTrue('ifut-guestfs' in ReservationManager().queues)
+        self.assertEqual(ReservationManager().queue_stats()['ifut-guestfs']['size'], 3)
+        delegate_class = type(self.os_plugin_name, (object, ), { })
+        delegate_class.__module__ = 'imagefactory_plugins.%s.%s' % (self.os_plugin_name, self.os_plugin_name)
+        self.assertEqual(self.plugin_mgr.resources_for(delegate_class(), 'base_image'), {'local': 1, 'ifut-guestfs': 1})
+        self.assertEqual(self.plugin_mgr.resources_for(delegate_class(), 'target_image'), { })
+        self.assertEqual(self.plugin_mgr.resources_for(object(), 'base_image'), { })
+
     @unittest.skip('See comments in code.')
     def testPluginForTarget(self):
         # This code is flawed...
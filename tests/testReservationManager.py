@@ -127,6 +127,45 @@ class testReservationManager(unittest.TestCase):
         else:
             self.fail('Failed to reserve space...')
 
+    def testMountForPath(self):
+        """
+        The mount table and the old walk up the tree with ismount() agree.
+        """
+        mount_path = self.res_mgr._mount_for_path(self.test_file)
+        self.assertTrue(os.path.ismount(mount_path))
+        self.assertTrue(self.test_file.startswith(mount_path))
+        self.assertTrue(mount_path in self.res_mgr._current_mount_points())
+
+    def testFreeSpaceSampled(self):
+        """
+        Reservations count at once while the free space is only sampled once per TTL.
+        """
+        sample_ttl = self.res_mgr.sample_ttl
+        self.res_mgr.sample_ttl = 3600
+        try:
+            size = self.min_free / 10
+            self.res_mgr.add_path(self.test_path, self.min_free)
+            available = self.res_mgr.available_space_for_path(self.test_path)
+            self.assertTrue(self.res_mgr.reserve_space_for_file(size, self.test_file))
+            self.assertEqual(self.res_mgr.available_space_for_path(self.test_path), available - size)
+            self.assertTrue(self.res_mgr.reserve_space_for_file(size * 2, self.test_file))
+            self.assertEqual(self.res_mgr.available_space_for_path(self.test_path), available - (size * 2))
+            self.res_mgr.cancel_reservation_for_file(self.test_file)
+            self.assertEqual(self.res_mgr.available_space_for_path(self.test_path), available)
+        finally:
+            self.res_mgr.sample_ttl = sample_ttl
+
+    def testNamedLockTimeout(self):
+        """
+        Named locks can be tried and waited for with a timeout, and are counted.
+        """
+        self.assertTrue(self.res_mgr.get_named_lock('unittest-lock'))
+        self.assertFalse(self.res_mgr.get_named_lock('unittest-lock', blocking=False))
+        self.assertFalse(self.res_mgr.get_named_lock('unittest-lock', timeout=0.1))
+        self.res_mgr.release_named_lock('unittest-lock')
+        stats = self.res_mgr.named_lock_stats()
+        self.assertEqual(stats['locks']['unittest-lock']['timeouts'], 2)
+
     def testJobQueue(self):
         """
         TODO: Docstring for testJobQueue
@@ -0,0 +1,89 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+from imgfac.SingleFlightRegistry import SingleFlightRegistry, flight_key, sharing_image_ids
+from imgfac.NotificationCenter import NotificationCenter
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.BaseImage import BaseImage
+from imgfac.ProviderImage import ProviderImage
+
+
+class testSingleFlightRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = SingleFlightRegistry()
+
+    def tearDown(self):
+        # Leave the shared NotificationCenter as we found it
+        NotificationCenter().remove_observer(self.registry, 'handle_state_change', 'image.status')
+        SingleFlightRegistry._instance = None
+        del self.registry
+
+    def testFlightKey(self):
+        self.assertEqual(flight_key('base_image', '<template/>', {'a': 1, 'b': 2}),
+                         flight_key('base_image', '<template/>', {'b': 2, 'a': 1}))
+        # Callback URLs do not change what gets built
+        self.assertEqual(flight_key('base_image', '<template/>', {'a': 1}),
+                         flight_key('base_image', '<template/>', {'a': 1, 'callbacks': ['http://example.com']}))
+        self.assertNotEqual(flight_key('base_image', '<template/>', None),
+                            flight_key('target_image', '<template/>', None))
+        self.assertNotEqual(flight_key('base_image', '<template/>', {'a': 1}),
+                            flight_key('base_image', '<template/>', {'a': 2}))
+
+    def testFollowWhileInFlight(self):
+        key = flight_key('base_image', '<template/>')
+        leader = BaseImage()
+        follower = BaseImage()
+        self.assertIsNone(self.registry.lead_or_follow(key, leader))
+        self.assertIs(self.registry.lead_or_follow(key, follower), leader)
+        self.assertEqual(self.registry.in_flight(), {key: leader.identifier})
+
+    def testLandOnTerminalStatus(self):
+        key = flight_key('base_image', '<template/>')
+        leader = BaseImage()
+        self.assertIsNone(self.registry.lead_or_follow(key, leader))
+        leader.status = 'BUILDING'
+        self.assertIn(key, self.registry.in_flight())
+        leader.status = 'FAILED'
+        self.assertNotIn(key, self.registry.in_flight())
+        # The next identical request leads a new build
+        second = BaseImage()
+        self.assertIsNone(self.registry.lead_or_follow(key, second))
+
+    def testDeleteAfterCoalescing(self):
+        storage_path = tempfile.mkdtemp(prefix='imagefactory.unittest.SingleFlightRegistry.')
+        try:
+            pim = FilePersistentImageManager(storage_path=storage_path)
+            images = [ ]
+            for identifier_on_provider in ('ami-1', 'ami-1', 'ami-2'):
+                image = ProviderImage()
+                image.provider = 'ec2-us-east-1'
+                image.identifier_on_provider = identifier_on_provider
+                pim.add_image(image)
+                images.append(image)
+            leader, follower, other = images
+            # The follower was given the image of its leader on the provider
+            self.assertEqual(sharing_image_ids(pim, leader), [ follower.identifier ])
+            self.assertEqual(sharing_image_ids(pim, other), [ ])
+            # Once either is deleted the other is the last to refer to it
+            pim.delete_image_with_id(leader.identifier)
+            self.assertEqual(sharing_image_ids(pim, follower), [ ])
+        finally:
+            shutil.rmtree(storage_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
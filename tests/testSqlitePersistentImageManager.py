@@ -0,0 +1,173 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import tempfile
+import shutil
+import os.path
+import json
+import sqlite3
+from threading import Thread
+from imgfac.SqlitePersistentImageManager import SqlitePersistentImageManager
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.ImageFactoryException import ImageFactoryException
+from imgfac.BaseImage import BaseImage
+from imgfac.TargetImage import TargetImage
+
+
+class testSqlitePersistentImageManager(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp(prefix='imagefactory.unittest.SqlitePIM.')
+        self.pim = SqlitePersistentImageManager(storage_path=self.storage_path)
+
+    def tearDown(self):
+        del self.pim
+        shutil.rmtree(self.storage_path)
+
+    def _add_images(self, pim=None):
+        pim = pim if pim else self.pim
+        base_image = BaseImage()
+        pim.add_image(base_image)
+        target_images = [ ]
+        for target in ('mock', 'ec2'):
+            target_image = TargetImage()
+            target_image.target = target
+            target_image.base_image_id = base_image.identifier
+            pim.add_image(target_image)
+            target_images.append(target_image)
+        return base_image, target_images
+
+    def testQuery(self):
+        base_image, target_images = self._add_images()
+        self.assertEqual(len(self.pim.images_from_query({'type': 'BaseImage'})), 1)
+        found = self.pim.images_from_query({'type': 'TargetImage', 'base_image_id': base_image.identifier})
+        self.assertEqual(set([ image.identifier for image in found ]),
+                         set([ image.identifier for image in target_images ]))
+        found = self.pim.images_from_query({'type': 'TargetImage', 'target': 'ec2'})
+        self.assertEqual([ image.identifier for image in found ], [ target_images[1].identifier ])
+        # Keys without a column are matched against the stored metadata
+        found = self.pim.images_from_query({'type': 'BaseImage', 'percent_complete': 0})
+        self.assertEqual(len(found), 1)
+        self.assertEqual(len(self.pim.images_from_query({'type': 'ProviderImage'})), 0)
+        self.assertEqual(set(self.pim.image_ids_from_query({'type': 'TargetImage', 'base_image_id': base_image.identifier})),
+                         set([ image.identifier for image in target_images ]))
+
+    def testSaveAndDelete(self):
+        base_image, target_images = self._add_images()
+        base_image.status = 'COMPLETE'
+        self.pim.save_image(base_image)
+        self.assertEqual(self.pim.image_with_id(base_image.identifier).status, 'COMPLETE')
+        self.assertEqual(len(self.pim.images_from_query({'status': 'NEW'})), 2)
+        self.pim.delete_image_with_id(target_images[0].identifier)
+        self.assertIsNone(self.pim.image_with_id(target_images[0].identifier))
+        self.assertEqual(self.pim.child_image_ids(base_image.identifier), [ target_images[1].identifier ])
+        self.assertRaises(ImageFactoryException, self.pim.save_image, target_images[0])
+        self.assertRaises(ImageFactoryException, self.pim.add_image, base_image)
+
+    def testConcurrentWriters(self):
+        base_image, target_images = self._add_images()
+
+        def save_repeatedly(image):
+            for i in range(20):
+                image.percent_complete = i
+                self.pim.save_image(image)
+        threads = [ Thread(target=save_repeatedly, args=(image, )) for image in [ base_image ] + target_images ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for image in [ base_image ] + target_images:
+            self.assertEqual(self.pim.image_with_id(image.identifier).percent_complete, 19)
+
+    def testImportFileStore(self):
+        file_path = tempfile.mkdtemp(prefix='imagefactory.unittest.SqlitePIM.')
+        try:
+            base_image, target_images = self._add_images(FilePersistentImageManager(storage_path=file_path))
+            # A new database in an existing file store imports it
+            pim = SqlitePersistentImageManager(storage_path=file_path)
+            self.assertEqual(set(pim.child_image_ids(base_image.identifier)),
+                             set([ image.identifier for image in target_images ]))
+            self.assertEqual(self.pim.import_file_store(file_path), 3)
+            self.assertEqual(len(self.pim.images_from_query({'type': 'TargetImage'})), 2)
+        finally:
+            shutil.rmtree(file_path)
+
+    def testBlobs(self):
+        base_image, target_images = self._add_images()
+        base_image.template = '<template/>'
+        base_image.icicle = '<icicle/>'
+        self.pim.save_image(base_image)
+        loaded = self.pim.image_with_id(base_image.identifier)
+        self.assertTrue('template' in loaded._unloaded_blobs)
+        self.assertEqual(loaded.template, '<template/>')
+        # Saving without touching a blob keeps it, clearing one removes it
+        loaded.icicle = None
+        loaded.status = 'COMPLETE'
+        self.pim.save_image(loaded)
+        loaded = self.pim.image_with_id(base_image.identifier)
+        self.assertEqual((loaded.status, loaded.template, loaded.icicle), ('COMPLETE', '<template/>', None))
+        self.pim.delete_image_with_id(base_image.identifier)
+        self.assertIsNone(self.pim.load_blob(base_image.identifier, 'template'))
+
+    def testImportFileStoreBlobs(self):
+        file_path = tempfile.mkdtemp(prefix='imagefactory.unittest.SqlitePIM.')
+        try:
+            base_image = BaseImage()
+            base_image.template = '<template/>'
+            FilePersistentImageManager(storage_path=file_path).add_image(base_image)
+            self.pim.import_file_store(file_path)
+            self.assertEqual(self.pim.image_with_id(base_image.identifier).template, '<template/>')
+        finally:
+            shutil.rmtree(file_path)
+
+    def testMetadataFromQueryPages(self):
+        base_image, target_images = self._add_images()
+        ordered_ids = sorted([ image.identifier for image in target_images ])
+        results = self.pim.metadata_from_query({'type': 'TargetImage'}, fields=[ 'target', 'template' ])
+        first = results.next()
+        self.assertEqual(first['identifier'], ordered_ids[0])
+        self.assertEqual(set(first.keys()), set([ 'identifier', 'type', 'target', 'template' ]))
+        rest = list(self.pim.metadata_from_query({'type': 'TargetImage'}, after=first['identifier'], fields=[ ]))
+        self.assertEqual([ metadata['identifier'] for metadata in rest ], ordered_ids[1:])
+        found = list(self.pim.metadata_from_query({'type': 'TargetImage', 'target': 'ec2'}))
+        self.assertEqual([ metadata['identifier'] for metadata in found ], [ target_images[1].identifier ])
+        self.assertEqual(found[0]['base_image_id'], base_image.identifier)
+
+    def testMetadataFromQueryRanges(self):
+        base_image, target_images = self._add_images()
+        since = self.pim.image_with_id(target_images[1].identifier).modified
+        target_images[0].status = 'COMPLETE'
+        self.pim.save_image(target_images[0])
+        found = list(self.pim.metadata_from_query({'type': 'TargetImage'}, ranges={'modified': (since, None)}))
+        self.assertTrue(target_images[0].identifier in [ metadata['identifier'] for metadata in found ])
+        self.assertEqual(list(self.pim.metadata_from_query({}, ranges={'created': (None, base_image.created)})), [ ])
+
+    def testBackingImageColumnAdded(self):
+        # A database from before backing_image_id had its own column
+        database = os.path.join(self.storage_path, 'old.sqlite')
+        connection = sqlite3.connect(database)
+        with connection:
+            connection.execute('CREATE TABLE images (identifier TEXT PRIMARY KEY, type TEXT, status TEXT, base_image_id TEXT, '
+                               'target_image_id TEXT, provider TEXT, target TEXT, metadata TEXT NOT NULL)')
+            for identifier, backing_image_id in (('overlay', 'base'), ('copy', None)):
+                metadata = {'identifier': identifier, 'type': 'TargetImage', 'backing_image_id': backing_image_id}
+                connection.execute('INSERT INTO images (identifier, type, metadata) VALUES (?, ?, ?)',
+                                   (identifier, 'TargetImage', json.dumps(metadata)))
+        connection.close()
+        pim = SqlitePersistentImageManager(storage_path=self.storage_path, database=database)
+        self.assertEqual(pim.image_ids_from_query({'type': 'TargetImage', 'backing_image_id': 'base'}), [ 'overlay' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
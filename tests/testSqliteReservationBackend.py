@@ -0,0 +1,134 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+import subprocess
+import time
+from threading import Thread
+from imgfac.SqliteReservationBackend import SqliteReservationBackend
+from imgfac.ReservationManager import ReservationManager
+
+
+class testSqliteReservationBackend(unittest.TestCase):
+    """ Two backends on one database stand in for two imagefactoryd processes """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='imagefactory.unittest.SqliteReservationBackend.')
+        self.database = os.path.join(self.directory, 'reservations.db')
+        self.first = SqliteReservationBackend(database=self.database)
+        self.second = SqliteReservationBackend(database=self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _holder_gone(self, backend, pid=None, expires=None):
+        # Make the lease of backend look like that of a process that died
+        cursor = backend._connection.cursor()
+        if expires is not None:
+            cursor.execute("UPDATE holders SET expires = ? WHERE holder = ?", (expires, backend.holder))
+        if pid is not None:
+            cursor.execute("UPDATE holders SET pid = ? WHERE holder = ?", (pid, backend.holder))
+
+    def testNamedLockExcludesOtherProcesses(self):
+        order = [ ]
+        self.first.acquire_lock('install-media')
+        waiter = Thread(target=lambda: (self.second.acquire_lock('install-media'), order.append('second')))
+        waiter.start()
+        time.sleep(1)
+        order.append('first')
+        self.first.release_lock('install-media')
+        waiter.join(10)
+        self.assertEqual(order, [ 'first', 'second' ])
+        self.second.release_lock('install-media')
+
+    def testSharedLockAcrossProcesses(self):
+        third = SqliteReservationBackend(database=self.database)
+        self.assertTrue(self.first.acquire_lock('install-media', shared=True))
+        self.assertTrue(self.second.acquire_lock('install-media', blocking=False, shared=True))
+        self.assertFalse(third.acquire_lock('install-media', blocking=False))
+        self.first.release_lock('install-media')
+        self.second.release_lock('install-media')
+        self.assertTrue(third.acquire_lock('install-media', blocking=False))
+        self.assertFalse(self.first.acquire_lock('install-media', blocking=False, shared=True))
+        third.release_lock('install-media')
+
+    def testExpiredLeaseReleasesLock(self):
+        self.first.acquire_lock('install-media')
+        self._holder_gone(self.first, expires=time.time() - 1)
+        self.second.acquire_lock('install-media')
+        self.second.release_lock('install-media')
+
+    def testDeadProcessReleasesLock(self):
+        finished = subprocess.Popen([ 'true' ])
+        finished.wait()
+        self.first.acquire_lock('install-media')
+        self._holder_gone(self.first, pid=finished.pid)
+        self.second.acquire_lock('install-media')
+        self.second.release_lock('install-media')
+
+    def testQueueSlotsShared(self):
+        for backend in (self.first, self.second):
+            backend.add_queue('upload', 1)
+        self.first.enter_queue('upload')
+        entered = [ ]
+        waiter = Thread(target=lambda: (self.second.enter_queue('upload'), entered.append(True)))
+        waiter.start()
+        time.sleep(1)
+        self.assertEqual(entered, [ ])
+        self.assertEqual(self.second.queue_stats()['upload']['in_use_everywhere'], 1)
+        self.first.exit_queue('upload')
+        waiter.join(10)
+        self.assertEqual(entered, [ True ])
+        self.second.exit_queue('upload')
+
+    def testListenPortsShared(self):
+        port = self.first.next_listen_port(1025, 65535)
+        self.assertEqual(self.second.next_listen_port(1025, 65535), port + 1)
+
+    def testReservationsShared(self):
+        self.first.add_reservation('/', '/images/first.body', 100)
+        self.second.add_reservation('/', '/images/second.body', 200)
+        self.assertEqual(self.first.reservations('/'), {'/images/first.body': 100, '/images/second.body': 200})
+        self._holder_gone(self.second, expires=time.time() - 1)
+        self.assertEqual(self.first.reservations('/'), {'/images/first.body': 100})
+        self.first.remove_reservation('/images/first.body')
+        self.assertEqual(self.first.reservations('/'), { })
+
+    def testReservationManagerCountsOtherProcesses(self):
+        res_mgr = ReservationManager()
+        backend, sample_ttl = res_mgr.backend, res_mgr.sample_ttl
+        res_mgr.backend, res_mgr.sample_ttl = self.first, 3600
+        path = tempfile.mkdtemp(prefix='imagefactory.unittest.SqliteReservationBackend.')
+        try:
+            res_mgr.add_path(path, 0)
+            available = res_mgr.available_space_for_path(path)
+            self.second.add_reservation(res_mgr._mount_for_path(path), os.path.join(path, 'other.body'), 4096)
+            self.assertEqual(res_mgr.available_space_for_path(path), available - 4096)
+            self.assertTrue(res_mgr.reserve_space_for_file(1024, os.path.join(path, 'mine.body')))
+            self.assertTrue(os.path.join(path, 'mine.body') in self.second.reservations(res_mgr._mount_for_path(path)))
+            res_mgr.cancel_reservation_for_file(os.path.join(path, 'mine.body'))
+            self.assertFalse(os.path.join(path, 'mine.body') in self.second.reservations(res_mgr._mount_for_path(path)))
+        finally:
+            self.second.remove_reservation(os.path.join(path, 'other.body'))
+            res_mgr.remove_path(path)
+            res_mgr.backend, res_mgr.sample_ttl = backend, sample_ttl
+            os.rmdir(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
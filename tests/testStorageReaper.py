@@ -0,0 +1,115 @@
+#   Copyright 2012 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+import os
+import os.path
+import tempfile
+import shutil
+import time
+import uuid
+from imgfac.StorageReaper import StorageReaper, classify, ORPHAN, INTERMEDIATE
+from imgfac.FilePersistentImageManager import FilePersistentImageManager
+from imgfac.BaseImage import BaseImage
+
+
+class testStorageReaper(unittest.TestCase):
+    def setUp(self):
+        self.storage_path = tempfile.mkdtemp(prefix='imagefactory.unittest.StorageReaper.')
+        self.pim = FilePersistentImageManager(storage_path=self.storage_path)
+        StorageReaper._instance = None
+        self.reaper = StorageReaper()
+        self.reaper.pim = self.pim
+        self.reaper.cache_enabled = False
+        self.shortfall = 0
+        self.reaper._shortfall = lambda path: self.shortfall
+
+    def tearDown(self):
+        StorageReaper._instance = None
+        shutil.rmtree(self.storage_path)
+
+    def _file(self, name, age, size=4096, directory=None):
+        path = os.path.join(directory or self.storage_path, name)
+        with open(path, 'wb') as leftover:
+            leftover.write('x' * size)
+        then = time.time() - age
+        os.utime(path, (then, then))
+        return path
+
+    def _image(self, status):
+        image = BaseImage()
+        self.pim.add_image(image)
+        image.status = status
+        self.pim.save_image(image)
+        return image
+
+    def testClassify(self):
+        self.assertEqual(classify('.body', 'FAILED'), ORPHAN)
+        self.assertEqual(classify('.body', 'COMPLETE'), None)
+        self.assertEqual(classify('.body.tmp.qcow2', 'BUILDING'), None)
+        self.assertEqual(classify('.body.tmp.qcow2', 'FAILED'), ORPHAN)
+        self.assertEqual(classify('.body.gz', 'COMPLETE'), INTERMEDIATE)
+        self.assertEqual(classify('.body.gz-factory-compressed', 'DELETEFAILED'), ORPHAN)
+        self.assertEqual(classify('.body', None), ORPHAN)
+        self.assertEqual(classify('.meta', None), None)
+        self.assertEqual(classify('.template', None), None)
+
+    def testOrphansAfterRetention(self):
+        failed = self._image('FAILED')
+        building = self._image('BUILDING')
+        failed_body = self._file(failed.identifier + '.body', 2 * 86400, directory=os.path.dirname(failed.data))
+        failed_temp = self._file(failed.identifier + '.body.tmp', 2 * 86400, directory=os.path.dirname(failed.data))
+        building_temp = self._file(building.identifier + '.body.tmp', 2 * 86400, directory=os.path.dirname(building.data))
+        recent = self._file(str(uuid.uuid4()) + '.body', 3600)
+        unrelated = self._file('images.db', 2 * 86400)
+        self.reaper.reap()
+        self.assertEqual(os.path.getsize(failed_body), 0)
+        self.assertFalse(os.path.exists(failed_temp))
+        self.assertTrue(os.path.exists(building_temp))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(unrelated))
+        self.assertTrue(os.path.exists(os.path.join(os.path.dirname(failed.data), failed.identifier + '.meta')))
+
+    def testPressureEvictsLeastRecentlyUsed(self):
+        complete = self._image('COMPLETE')
+        orphan = self._file(str(uuid.uuid4()) + '.body', 3600)
+        older = self._file(complete.identifier + '.body.gz', 7200)
+        marker = self._file(complete.identifier + '.body.gz-factory-compressed', 7200, size=0)
+        other = self._image('COMPLETE')
+        newer = self._file(other.identifier + '.body.gz', 3600)
+        self.shortfall = 6000
+        self.reaper.reap()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(older))
+        self.assertFalse(os.path.exists(marker))
+        self.assertTrue(os.path.exists(newer))
+        self.assertEqual(self.reaper.stats()['removed'], 2)
+
+    def testImagesOfOtherProcessesKept(self):
+        for journal in (True, False):
+            # A manager without the journal only writes .meta files, which this one does not read
+            other = FilePersistentImageManager(storage_path=self.storage_path, journal=journal)
+            image = BaseImage()
+            other.add_image(image)
+            image.status = 'COMPLETE'
+            other.save_image(image)
+            body = self._file(image.identifier + '.body', 2 * 86400, size=102400, directory=os.path.dirname(image.data))
+            self.reaper.reap()
+            self.assertTrue(os.path.exists(body))
+            self.assertEqual(os.path.getsize(body), 102400)
+        self.assertEqual(self.reaper.stats()['removed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()